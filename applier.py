@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+""" Applies the patches of a BatchPatch release on Windows, Linux and macOS.
+
+    python apply.py [-j jobs] [folder]
+
+    This file is copied next to the patches together with a JSON file of the same name, which lists the new files and
+    the patches that can create them. Several patches are decoded at once, and the CRC of each new file is calculated
+    while the decoder is writing it, so that a damaged result is never left in place of the real file. Only the
+    standard library is used, so that the script runs on any Python 3 installation.
+"""
+
+__author__ = 'Soulweaver'
+
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import zlib
+
+
+class PatchRunner:
+    FORMAT_VERSION = 1
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, plan, bundle_dir, work_dir):
+        self.plan = plan
+        self.bundle_dir = bundle_dir
+        self.work_dir = work_dir
+        self.decoders = {}
+        self.print_lock = threading.Lock()
+
+    def find_decoders(self):
+        """ Looks up the decoder of each backend. On Windows, the executables shipped with the patches are used. On
+            other systems, a decoder installed on the system is preferred, since the shipped ones are Windows builds.
+            Returns the names of the decoders that could not be found.
+        """
+        missing = []
+        for name, decoder in self.plan['backends'].items():
+            bundled = os.path.join(self.bundle_dir, decoder['executable'])
+            if os.name == 'nt' and os.path.isfile(bundled):
+                self.decoders[name] = bundled
+                continue
+
+            installed = shutil.which(decoder['command'])
+            if installed is not None:
+                self.decoders[name] = installed
+            elif os.path.isfile(bundled) and os.access(bundled, os.X_OK):
+                self.decoders[name] = bundled
+            else:
+                missing.append(decoder['command'])
+
+        return missing
+
+    def run(self, jobs):
+        counts = {'patched': 0, 'skipped': 0, 'failed': 0}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            for result in executor.map(self.apply, self.plan['targets']):
+                counts[result] += 1
+
+        return counts
+
+    def apply(self, target):
+        new_path = self.get_path(self.work_dir, target['new'])
+        if os.path.exists(new_path):
+            self.report('{} already exists, skipping...'.format(target['new']))
+            return 'skipped'
+
+        # The candidates are listed newest first, so the smallest patch is used when several old files are present.
+        for candidate in target['candidates']:
+            old_path = self.get_path(self.work_dir, candidate['old'])
+            if os.path.isfile(old_path):
+                break
+        else:
+            self.report('No old version of {} present in folder, skipping...'.format(target['new']))
+            return 'skipped'
+
+        self.report('Patching {}...'.format(candidate['old']))
+        temp_path = new_path + '.part'
+        temp_old_path = None
+        try:
+            if os.name == 'nt' and not candidate['windows_safe']:
+                # The Windows build of xdelta can't open files with names outside the ANSI codepage.
+                temp_old_path = os.path.join(self.work_dir, candidate['temp_old'])
+                temp_path = os.path.join(self.work_dir, candidate['temp_new'])
+                shutil.copyfile(old_path, temp_old_path)
+                old_path = temp_old_path
+
+            crc = self.decode(candidate, old_path, temp_path)
+            if crc is None:
+                self.report('Patching {} failed!'.format(candidate['old']))
+                return 'failed'
+
+            if target['crc32'] is not None and crc != target['crc32']:
+                self.report('Patching {} failed! The CRC of the result is {}, expected {}.'.format(
+                    candidate['old'], crc, target['crc32']))
+                return 'failed'
+
+            os.replace(temp_path, new_path)
+            return 'patched'
+        except OSError as e:
+            self.report('Patching {} failed! {}'.format(candidate['old'], e.strerror))
+            return 'failed'
+        finally:
+            for path in (temp_path, temp_old_path):
+                if path is not None and os.path.exists(path):
+                    os.unlink(path)
+
+    def decode(self, candidate, old_path, new_path):
+        """ Runs the decoder, and returns the CRC of the decoded file, or None if the decoder failed. """
+        if candidate.get('full') is not None:
+            # The new file was shipped as it is, since its patch would have been nearly as large.
+            return self.copy(self.get_path(self.bundle_dir, candidate['full']), new_path)
+
+        if candidate.get('segments') is not None:
+            return self.decode_segments(candidate, old_path, new_path)
+
+        decoder = self.plan['backends'][candidate['backend']]
+        cmd = self.get_decode_command(candidate, old_path, candidate['patch'], new_path)
+
+        if not decoder['stream']:
+            proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if proc.returncode != 0:
+                return None
+            return self.crc32(new_path)
+
+        with open(new_path, 'wb') as f:
+            crc = self.stream(cmd, f, 0)
+        return format(crc & 0xFFFFFFFF, '08x') if crc is not None else None
+
+    def decode_segments(self, candidate, old_path, new_path):
+        """ Decodes a patch that was split into segments. Each segment is decoded against its own range of the old
+            file, which is copied into a temporary file first, and the results are written one after another. The
+            temporary file is named after the candidate, so that pairs sharing the patch can be decoded at the same
+            time.
+        """
+        temp_old_path = os.path.join(self.work_dir, candidate['temp_segment'])
+        crc = 0
+        try:
+            with open(new_path, 'wb') as f:
+                for segment in candidate['segments']:
+                    self.extract(old_path, temp_old_path, segment['source_offset'], segment['source_length'])
+                    crc = self.stream(self.get_decode_command(candidate, temp_old_path, segment['patch'], new_path),
+                                      f, crc)
+                    if crc is None:
+                        return None
+        finally:
+            if os.path.exists(temp_old_path):
+                os.unlink(temp_old_path)
+
+        return format(crc & 0xFFFFFFFF, '08x')
+
+    def get_decode_command(self, candidate, old_path, patch, new_path):
+        decoder = self.plan['backends'][candidate['backend']]
+        values = {
+            'old': old_path,
+            'patch': self.get_path(self.bundle_dir, patch),
+            'new': new_path
+        }
+        return [self.decoders[candidate['backend']]] + [arg.format(**values) for arg in decoder['arguments']]
+
+    def stream(self, cmd, f, crc):
+        """ Runs a decoder that writes to its standard output, and writes the output into f. Returns the CRC updated
+            with the output, or None if the decoder failed.
+        """
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        with proc.stdout:
+            while True:
+                chunk = proc.stdout.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                f.write(chunk)
+
+        if proc.wait() != 0:
+            return None
+        return crc
+
+    def extract(self, source, destination, offset, length):
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            src.seek(offset)
+            while length > 0:
+                chunk = src.read(min(length, self.CHUNK_SIZE))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                length -= len(chunk)
+
+    def copy(self, source, destination):
+        crc = 0
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            while True:
+                chunk = src.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                dst.write(chunk)
+        return format(crc & 0xFFFFFFFF, '08x')
+
+    def crc32(self, path):
+        crc = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(self.CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+        return format(crc & 0xFFFFFFFF, '08x')
+
+    def report(self, msg):
+        with self.print_lock:
+            print(msg, flush=True)
+
+    @staticmethod
+    def get_path(base_dir, relpath):
+        return os.path.join(base_dir, *relpath.split('/'))
+
+
+def main():
+    default_plan = os.path.splitext(os.path.realpath(__file__))[0] + '.json'
+    parser = argparse.ArgumentParser(description='Applies the patches of this folder.')
+    parser.add_argument('folder', nargs='?', default=None,
+                        help='The folder with the old files. Default: the folder this script is in.')
+    parser.add_argument('-j', '--jobs', type=int, default=min(4, os.cpu_count() or 1),
+                        help='How many files to patch at the same time. Default: the number of CPUs, up to 4.')
+    parser.add_argument('--plan', default=default_plan, help='The list of patches to apply.')
+    args = parser.parse_args()
+
+    with open(args.plan, 'r', encoding='utf-8') as fh:
+        plan = json.load(fh)
+    if plan.get('format') != PatchRunner.FORMAT_VERSION:
+        print('The patch list {} is not supported by this script.'.format(args.plan))
+        return 1
+
+    bundle_dir = os.path.dirname(os.path.realpath(args.plan))
+    runner = PatchRunner(plan, bundle_dir, args.folder if args.folder is not None else bundle_dir)
+    missing = runner.find_decoders()
+    if len(missing) > 0:
+        print('{} was not found! It is required for this script to work!'.format(', '.join(missing)))
+        return 1
+
+    counts = runner.run(max(1, args.jobs))
+    print('Finished, with {} files patched, {} skipped and {} failed.'.format(
+        counts['patched'], counts['skipped'], counts['failed']))
+    return 1 if counts['failed'] > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import os
+import threading
+import time
+import zipfile
+import zlib
+
+
+class PatchArchive:
+    """ A ZIP archive that files can be added to from several threads while the rest of the patches are still being
+        created. Files that don't compress well, like xdelta output, are stored as they are instead of spending time
+        on deflating them again.
+    """
+    PROBE_SIZE = 1024 * 1024
+    MIN_SAVINGS = 0.05
+
+    def __init__(self, path, base_dir=None, replaced=()):
+        """ With a base_dir, an existing archive is extended instead of being written from scratch. Its entries are
+            kept as long as the files in base_dir they were made from haven't changed, except for the replaced ones.
+        """
+        self.path = path
+        self.members = set()
+        self.lock = threading.Lock()
+        self.zipped = None
+        if base_dir is not None and os.path.isfile(path):
+            self.zipped = self.open_existing(base_dir, set(replaced))
+        if self.zipped is None:
+            self.zipped = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+    def open_existing(self, base_dir, replaced):
+        """ Opens the archive for appending, and drops everything from the first entry that is out of date onwards,
+            so that those files are written again after the new ones. The scripts are added last, so usually only
+            they have to be written again. Returns None if the archive can't be read.
+        """
+        try:
+            # Append mode would add a new archive after the end of a damaged one instead of failing.
+            if not zipfile.is_zipfile(self.path):
+                return None
+            zipped = zipfile.ZipFile(self.path, 'a', zipfile.ZIP_DEFLATED)
+        except (OSError, zipfile.BadZipFile):
+            return None
+
+        entries = zipped.infolist()
+        kept = 0
+        while kept < len(entries) and entries[kept].filename not in replaced and \
+                PatchArchive.is_current(entries[kept], os.path.join(base_dir, entries[kept].filename)):
+            kept += 1
+
+        if kept < len(entries):
+            # The entries after the kept ones are overwritten by the next ones written, and the rest of the file is
+            # cut off when the archive is closed.
+            zipped.filelist = entries[:kept]
+            zipped.NameToInfo = {entry.filename: entry for entry in entries[:kept]}
+            zipped.start_dir = entries[kept].header_offset
+            # Makes sure the shortened directory is written even if nothing is added.
+            zipped._didModify = True
+
+        self.members.update(entry.filename for entry in entries[:kept])
+        return zipped
+
+    def add(self, path, arcname):
+        """ Adds a file to the archive unless one with the same name is already there. Returns the compression type
+            used, or None if the file was already present.
+        """
+        compress_type = PatchArchive.choose_compression(path)
+
+        with self.lock:
+            if arcname in self.members:
+                return None
+
+            self.zipped.write(path, arcname, compress_type)
+            self.members.add(arcname)
+
+        return compress_type
+
+    def contains(self, arcname):
+        with self.lock:
+            return arcname in self.members
+
+    def close(self):
+        with self.lock:
+            self.zipped.close()
+
+    @staticmethod
+    def is_current(entry, path):
+        """ Whether the file still has the size and the modification time it had when it was added. ZIP entries only
+            store the time to two seconds.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+
+        date_time = time.localtime(stat.st_mtime)[0:6]
+        date_time = date_time[0:5] + (date_time[5] // 2 * 2,)
+        return stat.st_size == entry.file_size and date_time == entry.date_time
+
+    @staticmethod
+    def choose_compression(path):
+        """ Compresses a sample from the start of the file quickly, and only deflates the whole file if the sample
+            got meaningfully smaller.
+        """
+        with open(path, 'rb') as f:
+            sample = f.read(PatchArchive.PROBE_SIZE)
+
+        if len(sample) == 0:
+            return zipfile.ZIP_STORED
+
+        if len(zlib.compress(sample, 1)) <= len(sample) * (1 - PatchArchive.MIN_SAVINGS):
+            return zipfile.ZIP_DEFLATED
+
+        return zipfile.ZIP_STORED
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import os
+import subprocess
+
+
+class DeltaBackend:
+    """ A program that creates patch files from a pair of files, and the matching decoder that the generated script
+        uses to apply them. Subclasses describe the command lines of each program.
+    """
+    name = None
+    patch_ext = None
+    # The size of the largest file the encoder can handle at once, or None if there is no limit.
+    max_size = None
+
+    def __init__(self, location):
+        self.location = location
+        self.version = None
+
+    def get_executables(self):
+        """ The executables that have to be distributed with the patches for them to be applied. """
+        return [self.location]
+
+    def get_encoder_executables(self):
+        return [self.location]
+
+    def is_available(self):
+        executables = set(self.get_encoder_executables() + self.get_executables())
+        return all(os.path.isfile(e) and os.access(e, os.X_OK) for e in executables)
+
+    def supports(self, size):
+        """ Whether the encoder can handle files of the given size. """
+        return self.max_size is None or size <= self.max_size
+
+    def get_options(self, size):
+        """ The options affecting the contents of the patch, for files of the given size. Patches created with
+            different options or different versions of the encoder are not considered interchangeable.
+        """
+        return []
+
+    def get_encode_command(self, source, target, destination, verbosity, size):
+        raise NotImplementedError()
+
+    def get_decode_command(self, source, patch, destination):
+        raise NotImplementedError()
+
+    def get_stream_decode_command(self, source, patch):
+        """ A decoding command line that writes the new file to the standard output, or None if the decoder can't
+            do that.
+        """
+        return None
+
+    def get_script_decode_command(self, source, patch, destination):
+        """ The decoding command line as it should be written into the Windows batch script. """
+        raise NotImplementedError()
+
+    def get_script_stream_decode_command(self, source, patch):
+        """ Like get_script_decode_command, but writing the new file to the standard output, or None if the decoder
+            can't do that. Only pairs whose decoder can are split into segments.
+        """
+        return None
+
+    def get_runner_decoder(self):
+        """ How the Python apply runner calls the decoder. The arguments are format strings for the old file, the
+            patch and the new file. If stream is set, the decoder writes the new file to its standard output instead.
+            The command is the name of the decoder when it is installed on the system.
+        """
+        raise NotImplementedError()
+
+    def get_version(self):
+        if self.version is None:
+            try:
+                proc = subprocess.run(self.get_version_command(), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            except (OSError, IOError):
+                return None
+
+            lines = proc.stdout.decode(errors='replace').strip().splitlines()
+            self.version = lines[0] if len(lines) > 0 else ''
+
+        return self.version
+
+    def get_version_command(self):
+        return [self.location, '-V']
+
+
+class XdeltaBackend(DeltaBackend):
+    """ Uses xdelta3. Without a profile, every pair is encoded with the maximum compression level and the default
+        windows. The profiles pick the compression level, the source window (-B), the input window (-W) and the
+        secondary compressor (-S) based on the size of the files instead.
+    """
+    name = 'xdelta3'
+    patch_ext = 'vcdiff'
+    profiles = ['fast', 'balanced', 'smallest']
+
+    MIB = 1024 * 1024
+    DEFAULT_SOURCE_WINDOW = 64 * MIB
+    MAX_SOURCE_WINDOW = 2048 * MIB
+    MAX_INPUT_WINDOW = 16 * MIB
+
+    def __init__(self, location, profile=None):
+        super().__init__(location)
+        self.profile = profile
+
+    def get_options(self, size):
+        if self.profile is None:
+            return ['-9']
+
+        if self.profile == 'fast':
+            # Stick to the default windows, and skip the secondary compression.
+            return ['-1', '-S', 'none']
+
+        # A source window covering the whole file lets xdelta find matches across the entire file, instead of only
+        # near the same position. It's rounded up to a power of two to keep the option values tidy.
+        source_window = XdeltaBackend.DEFAULT_SOURCE_WINDOW
+        while source_window < size and source_window < XdeltaBackend.MAX_SOURCE_WINDOW:
+            source_window *= 2
+
+        if self.profile == 'balanced':
+            # The highest levels take much longer on small files without saving much.
+            options = ['-9' if size >= 256 * XdeltaBackend.MIB else '-5',
+                       '-B', str(min(source_window, 512 * XdeltaBackend.MIB)), '-S', 'djw']
+        else:
+            # The lzma secondary compressor requires an xdelta build with lzma support, for decoding as well.
+            options = ['-9', '-B', str(source_window), '-S', 'lzma']
+
+        if size > XdeltaBackend.MAX_INPUT_WINDOW:
+            options[3:3] = ['-W', str(XdeltaBackend.MAX_INPUT_WINDOW)]
+        return options
+
+    def get_encode_command(self, source, target, destination, verbosity, size):
+        cmd = [
+            self.location,
+            '-e',        # Create patch
+        ] + self.get_options(size) + [
+            '-s',        # Read from file
+            source,      # Old file
+            target,      # New file
+            destination  # Patch destination
+        ]
+
+        if verbosity == 'verbose':
+            cmd.insert(2, '-v')
+        elif verbosity == 'quiet':
+            cmd.insert(2, '-q')
+
+        return cmd
+
+    def get_decode_command(self, source, patch, destination):
+        return [self.location, '-d', '-f', '-s', source, patch, destination]
+
+    def get_stream_decode_command(self, source, patch):
+        return [self.location, '-d', '-c', '-s', source, patch]
+
+    def get_script_decode_command(self, source, patch, destination):
+        return '"{}" -d -v -s "{}" "{}" "{}"'.format(os.path.basename(self.location), source, patch, destination)
+
+    def get_script_stream_decode_command(self, source, patch):
+        return '"{}" -d -c -s "{}" "{}"'.format(os.path.basename(self.location), source, patch)
+
+    def get_runner_decoder(self):
+        return {
+            'executable': os.path.basename(self.location),
+            'command': 'xdelta3',
+            'arguments': ['-d', '-c', '-s', '{old}', '{patch}'],
+            'stream': True
+        }
+
+
+class ZstdBackend(DeltaBackend):
+    """ Uses the --patch-from mode of zstd. The long distance matching window is limited to 2 GiB, so very large files
+        are better served by xdelta.
+    """
+    name = 'zstd'
+    patch_ext = 'zst'
+    max_size = 2048 * 1024 * 1024
+
+    def get_options(self, size):
+        return ['-19', '--long=31']
+
+    def get_encode_command(self, source, target, destination, verbosity, size):
+        cmd = [self.location, '-19', '--long=31', '-f', '--patch-from=' + source, target, '-o', destination]
+
+        if verbosity == 'verbose':
+            cmd.insert(1, '-v')
+        elif verbosity == 'quiet':
+            cmd.insert(1, '-q')
+
+        return cmd
+
+    def get_decode_command(self, source, patch, destination):
+        return [self.location, '-d', '-q', '-f', '--long=31', '--patch-from=' + source, patch, '-o', destination]
+
+    def get_stream_decode_command(self, source, patch):
+        return [self.location, '-d', '-q', '-c', '--long=31', '--patch-from=' + source, patch]
+
+    def get_script_decode_command(self, source, patch, destination):
+        return '"{}" -d -f --long=31 --patch-from="{}" "{}" -o "{}"'.format(
+            os.path.basename(self.location), source, patch, destination)
+
+    def get_script_stream_decode_command(self, source, patch):
+        return '"{}" -d -q -c --long=31 --patch-from="{}" "{}"'.format(os.path.basename(self.location), source, patch)
+
+    def get_runner_decoder(self):
+        return {
+            'executable': os.path.basename(self.location),
+            'command': 'zstd',
+            'arguments': ['-d', '-c', '-q', '--long=31', '--patch-from={old}', '{patch}'],
+            'stream': True
+        }
+
+
+class BsdiffBackend(DeltaBackend):
+    """ Uses bsdiff for encoding and bspatch for decoding. bsdiff needs memory of many times the size of the files,
+        so it is mostly useful for smaller files.
+    """
+    name = 'bsdiff'
+    patch_ext = 'bsdiff'
+
+    def __init__(self, location, decoder_location, max_size=None):
+        super().__init__(location)
+        self.decoder_location = decoder_location
+        self.max_size = max_size
+
+    def get_executables(self):
+        return [self.decoder_location]
+
+    def get_encode_command(self, source, target, destination, verbosity, size):
+        return [self.location, source, target, destination]
+
+    def get_decode_command(self, source, patch, destination):
+        return [self.decoder_location, source, destination, patch]
+
+    def get_script_decode_command(self, source, patch, destination):
+        return '"{}" "{}" "{}" "{}"'.format(os.path.basename(self.decoder_location), source, destination, patch)
+
+    def get_runner_decoder(self):
+        # bspatch needs to seek in its output, so it can't write to a pipe.
+        return {
+            'executable': os.path.basename(self.decoder_location),
+            'command': 'bspatch',
+            'arguments': ['{old}', '{new}', '{patch}'],
+            'stream': False
+        }
+
+    def get_version(self):
+        # bsdiff has no version switch, so identify it by the size of the executable instead.
+        if self.version is None:
+            try:
+                self.version = 'bsdiff ({} bytes)'.format(os.path.getsize(self.location))
+            except OSError:
+                return None
+
+        return self.version
@@ -3,19 +3,41 @@
 __author__ = 'Soulweaver'
 
 import argparse
+import copy
+import functools
+import json
 import os
 import re
 import time
 import shutil
+import sqlite3
 import colorama
 import subprocess
+import sys
+import threading
 import unicodedata
-import gettext
 import zipfile
 import zlib
+import gettext
 from datetime import datetime
 from dateutil import tz
+from applier import PatchRunner
+from archive import PatchArchive
+from backends import BsdiffBackend, XdeltaBackend, ZstdBackend
+from budget import SizeWatchdog
+from costmodel import CostModel
+from errors import BatchPatchError, ConfigurationError, CrcMismatchError
+from hashing import FileHasher, HashCache, HashingCancelled, MemoryHashCache
+from iosched import IOScheduler
 from logger import LogLevel, Logger
+from manifest import PatchManifest
+from metrics import RunMetrics
+from pairing import DirectoryScanner, FileEntity, FilePair
+from results import BatchResult
+from scratch import ScratchFile
+from segments import Segment, SegmentPlanner, SegmentProgress
+from similarity import ContentSketch, SimilarityIndex
+from watcher import DirectoryWatcher
 
 
 class BatchPatch:
@@ -23,34 +45,119 @@ class BatchPatch:
     PROG_VERSION = '0.3'
     PROG_URL = 'https://github.com/soulweaver91/batchpatch'
     LOCALE_CATALOG = 'batchpatch'
-    CRC_BUFFER_SIZE = 65536
+    # The folder in the target folder for the new files that are shipped as they are.
+    FULL_FILE_DIR = 'full'
+    CHECKSUM_FILENAME = 'batchpatch-checksums.json'
+    CHECKSUM_ALGORITHMS = ('crc32', 'sha256', 'blake2b')
+    SEGMENT_MANIFEST_SUFFIX = '.segments.json'
+    MIB = 1024 * 1024
 
     logger = None
     script_options = {
         'script_lang': 'en_US',
-        'script_name': 'apply'
+        'script_name': 'apply',
+        'runner': False,
+        'compact': False
     }
     patch_options = {
-        'filename_pattern': None
+        'filename_pattern': None,
+        'jobs': 1,
+        'scratch_dir': '',
+        'recursive': False,
+        'backend': 'xdelta3',
+        'auto_sample_size': 16,
+        'auto_time_weight': 0,
+        'bsdiff_max_size': 256 * 1024 * 1024,
+        'profile': None,
+        'deduplicate': True,
+        'all_versions': False,
+        'verify': False,
+        'checksums': False,
+        'device_jobs': 0,
+        'device_map': {},
+        'max_patch_ratio': None,
+        'segment_threshold': None,
+        'segment_size': 512 * 1024 * 1024,
+        'match_content': False,
+        'match_threshold': 0.5
     }
     archive_options = {
         'create_zip': False,
         'zip_name': 'patch'
     }
+    watch_options = {
+        'enabled': False,
+        'interval': 5,
+        'settle_time': 30
+    }
+    plan_options = {
+        'path': None,
+        'calibration': None
+    }
+    cache_options = {
+        'enabled': True,
+        'path': None,
+        'max_entries': HashCache.DEFAULT_MAX_ENTRIES,
+        'max_age_days': 90
+    }
 
     log_level = LogLevel.notice
+    hash_cache = None
+    cost_model = None
+    manifest = None
+    archive = None
+    backends = None
+    duplicates = None
+    stage_timings = None
+    metrics = None
+    result = None
+    executor = None
+    shared_hash_cache = None
+    translation = None
+    full_file_lock = None
     xdelta_location = ''
+    zstd_location = ''
+    bsdiff_location = ''
+    bspatch_location = ''
     locale_dir = ''
 
-    def __init__(self):
+    def __init__(self, executor=None, hash_cache=None):
+        """ An executor and a hash cache can be given to share them between several instances, e.g. when processing
+            many batches in one process. They are not shut down or closed by the instance.
+        """
         colorama.init()
 
+        # Each instance gets its own copy of the defaults, so that batches processed side by side don't mix options.
+        self.script_options = copy.deepcopy(BatchPatch.script_options)
+        self.patch_options = copy.deepcopy(BatchPatch.patch_options)
+        self.archive_options = copy.deepcopy(BatchPatch.archive_options)
+        self.watch_options = copy.deepcopy(BatchPatch.watch_options)
+        self.cache_options = copy.deepcopy(BatchPatch.cache_options)
+        self.plan_options = copy.deepcopy(BatchPatch.plan_options)
+        self.executor = executor
+        self.shared_hash_cache = hash_cache
+        self.translation = gettext.NullTranslations()
+        self.full_file_lock = threading.Lock()
+
         self.xdelta_location = os.path.join(BatchPatch.get_install_path(), 'xdelta3.exe')
+        self.zstd_location = os.path.join(BatchPatch.get_install_path(), 'zstd.exe')
+        self.bsdiff_location = os.path.join(BatchPatch.get_install_path(), 'bsdiff.exe')
+        self.bspatch_location = os.path.join(BatchPatch.get_install_path(), 'bspatch.exe')
+        self.create_backends()
+        self.metrics = RunMetrics()
         self.locale_dir = os.path.join(BatchPatch.get_install_path(), 'i18n')
 
+    def create_backends(self):
+        self.backends = {b.name: b for b in (
+            XdeltaBackend(self.xdelta_location, self.patch_options['profile']),
+            ZstdBackend(self.zstd_location),
+            BsdiffBackend(self.bsdiff_location, self.bspatch_location, self.patch_options['bsdiff_max_size'])
+        )}
+
     def print_welcome(self):
         # Print this even on the highest levels, but not on silent, and without the log prefix
-        if self.log_level != LogLevel.silent:
+        if self.log_level != LogLevel.silent and self.logger.log_format == 'text':
+            self.logger.flush()
             print('{} version {}'.format(self.PROG_NAME, self.PROG_VERSION))
 
     def get_version(self):
@@ -61,11 +168,18 @@ class BatchPatch:
 
     def switch_languages(self, lang):
         try:
-            gettext.translation('batchpatch', self.locale_dir, languages=[lang, 'en_US']).install()
+            self.translation = gettext.translation(self.LOCALE_CATALOG, self.locale_dir, languages=[lang, 'en_US'])
         except OSError as e:
             self.logger.log('Selecting language {} failed: {}'.format(lang, e.strerror), LogLevel.error)
+            self.translation = gettext.NullTranslations()
+
+    def _(self, message):
+        """ Translates a message of the generated script to the language of this instance. """
+        return self.translation.gettext(message)
 
-    def run(self):
+    @classmethod
+    def create_parser(cls):
+        locale_dir = os.path.join(cls.get_install_path(), 'i18n')
         parser = argparse.ArgumentParser(
             description="Generates distribution ready patches for anime batch releases."
         )
@@ -89,7 +203,7 @@ class BatchPatch:
             help='The path where the output should be written to. If not specified, '
                  'a new date stamped subfolder will be written under the current '
                  'working directory.',
-            default=self.get_default_output_folder(),
+            default=cls.get_default_output_folder(),
             metavar='directory'
         )
         parser.add_argument(
@@ -103,14 +217,131 @@ class BatchPatch:
             default='notice',
             metavar='level'
         )
+        parser.add_argument(
+            '--log-format',
+            action='store',
+            help='The format of the log messages. Available values: text (colored, for reading on a console), '
+                 'json (one JSON object per line, for log collectors). Default: text.',
+            choices=Logger.formats,
+            default='text',
+            metavar='format'
+        )
         parser.add_argument(
             '-x', '--xdelta',
             action='store',
             help='An alternative location for the xdelta3 executable to search instead of '
                  'the same directory as the script.',
-            default=self.xdelta_location,
+            default=os.path.join(cls.get_install_path(), 'xdelta3.exe'),
+            metavar='path'
+        )
+        parser.add_argument(
+            '-b', '--backend',
+            action='store',
+            help='The program to create the patches with. \'auto\' tries every available program on a sample of '
+                 'each file pair and picks the best one. Default: xdelta3.',
+            choices=['xdelta3', 'zstd', 'bsdiff', 'auto'],
+            default='xdelta3',
+            metavar='name'
+        )
+        parser.add_argument(
+            '-p', '--profile',
+            action='store',
+            help='Choose the xdelta compression level, windows and secondary compression for each file pair based '
+                 'on its size. Available values: fast, balanced, smallest. By default, the maximum compression level '
+                 'is used with the default windows for all pairs.',
+            choices=XdeltaBackend.profiles,
+            default=None,
+            metavar='profile'
+        )
+        parser.add_argument(
+            '--zstd',
+            action='store',
+            help='The location of the zstd executable. By default, one is expected in the same directory as the '
+                 'script.',
+            default=os.path.join(cls.get_install_path(), 'zstd.exe'),
             metavar='path'
         )
+        parser.add_argument(
+            '--bsdiff',
+            action='store',
+            help='The location of the bsdiff executable. By default, one is expected in the same directory as the '
+                 'script.',
+            default=os.path.join(cls.get_install_path(), 'bsdiff.exe'),
+            metavar='path'
+        )
+        parser.add_argument(
+            '--bspatch',
+            action='store',
+            help='The location of the bspatch executable. By default, one is expected in the same directory as the '
+                 'script.',
+            default=os.path.join(cls.get_install_path(), 'bspatch.exe'),
+            metavar='path'
+        )
+        parser.add_argument(
+            '--bsdiff-max-size',
+            action='store',
+            type=float,
+            help='The size in MiB of the largest file that bsdiff is tried on in auto mode, since it needs many times '
+                 'the size of the files in memory. 0 removes the limit. 256 by default.',
+            default=256,
+            metavar='size'
+        )
+        parser.add_argument(
+            '--auto-sample-size',
+            action='store',
+            type=int,
+            help='The amount of data in MiB from the start of each file to test the programs with in auto mode. '
+                 '16 by default.',
+            default=16,
+            metavar='size'
+        )
+        parser.add_argument(
+            '--auto-time-weight',
+            action='store',
+            type=float,
+            help='How many bytes of patch size one second of encoding time is worth when comparing the programs in '
+                 'auto mode. 0 by default, which picks the smallest patch regardless of time.',
+            default=0,
+            metavar='bytes'
+        )
+        parser.add_argument(
+            '--max-patch-ratio',
+            action='store',
+            type=float,
+            help='Stop the encoder as soon as a patch grows larger than this fraction of the size of its new file, '
+                 'e.g. 0.6, and ship the new file as it is instead. No limit by default.',
+            default=None,
+            metavar='ratio'
+        )
+        parser.add_argument(
+            '--segment-threshold',
+            action='store',
+            type=float,
+            help='Split pairs whose new file is larger than this many MiB into segments, which are encoded in '
+                 'parallel according to --jobs. Only for xdelta3 and zstd. Off by default.',
+            default=0,
+            metavar='size'
+        )
+        parser.add_argument(
+            '--segment-size',
+            action='store',
+            type=float,
+            help='The approximate size of the segments in MiB. Default: 512.',
+            default=512,
+            metavar='size'
+        )
+        parser.add_argument(
+            '--runner',
+            action='store_true',
+            help='Also include a Python script that applies the patches on any operating system, several at once, '
+                 'and verifies the CRC of each patched file.'
+        )
+        parser.add_argument(
+            '--compact-script',
+            action='store_true',
+            help='Write the list of patches into a separate file that the script loops over, instead of writing a '
+                 'block of commands for each file into the script. Keeps the script small for very large batches.'
+        )
         parser.add_argument(
             '-z', '--zip',
             action='store_true',
@@ -121,6 +352,52 @@ class BatchPatch:
             action='store_true',
             help='Verify CRC values of source and target files, if present.'
         )
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Decode every created patch and check that the result matches the new file. The decoded data is '
+                 'only hashed, not written to disk.'
+        )
+        parser.add_argument(
+            '--checksums',
+            action='store_true',
+            help='Write the CRC32, SHA-256 and BLAKE2b of every old file, new file and patch into {}. Each file is '
+                 'read only once for all of them.'.format(BatchPatch.CHECKSUM_FILENAME)
+        )
+        parser.add_argument(
+            '--no-dedup',
+            action='store_true',
+            help='Create a separate patch for every pair, even if the files of several pairs are identical.'
+        )
+        parser.add_argument(
+            '--hash-cache',
+            action='store',
+            help='The location of the database where calculated hashes are remembered between runs.',
+            default=HashCache.get_default_path(),
+            metavar='path'
+        )
+        parser.add_argument(
+            '--no-hash-cache',
+            action='store_true',
+            help='Do not read or write the hash cache.'
+        )
+        parser.add_argument(
+            '--hash-cache-size',
+            action='store',
+            type=int,
+            help='The maximum number of files to remember in the hash cache. {} by default.'.format(
+                HashCache.DEFAULT_MAX_ENTRIES),
+            default=HashCache.DEFAULT_MAX_ENTRIES,
+            metavar='count'
+        )
+        parser.add_argument(
+            '--hash-cache-age',
+            action='store',
+            type=int,
+            help='The number of days after which unused hash cache entries are dropped. 90 by default.',
+            default=90,
+            metavar='days'
+        )
         parser.add_argument(
             '--zip-name',
             action='store',
@@ -133,7 +410,7 @@ class BatchPatch:
             action='store',
             help='The language to use in the generated script.',
             default='en_US',
-            choices=[d for d in os.listdir(self.locale_dir) if os.path.isdir(os.path.join(self.locale_dir, d))],
+            choices=[d for d in os.listdir(locale_dir) if os.path.isdir(os.path.join(locale_dir, d))],
             metavar='lang_code'
         )
         parser.add_argument(
@@ -147,53 +424,418 @@ class BatchPatch:
             '--patch-pattern',
             action='store',
             help='The filename to use for the patch files. Consult README.md for available variables.',
-            default='{name}{specifier_items[0]}_{ep}_v{v_old}v{v_new}.vcdiff',
+            default='{name}{specifier_items[0]}_{ep}_v{v_old}v{v_new}.{patch_ext}',
             metavar='name'
         )
+        parser.add_argument(
+            '-j', '--jobs',
+            action='store',
+            type=int,
+            help='The number of encoder processes or CRC calculations to run at the same time. 1 by default.',
+            default=1,
+            metavar='count'
+        )
+        parser.add_argument(
+            '-r', '--recursive',
+            action='store_true',
+            help='Also look for files in the subfolders of the old and new folders. Files are only paired with '
+                 'files in the same relative subfolder.'
+        )
+        parser.add_argument(
+            '--match-content',
+            action='store_true',
+            help='Pair the files that could not be paired by their names by comparing samples of their contents, '
+                 'e.g. for renamed files or names the script doesn\'t recognize.'
+        )
+        parser.add_argument(
+            '--match-threshold',
+            action='store',
+            type=float,
+            help='The estimated share of content two files must have in common to be paired by --match-content, '
+                 'from 0 to 1. Default: 0.5.',
+            default=0.5,
+            metavar='similarity'
+        )
+        parser.add_argument(
+            '-a', '--all-versions',
+            action='store_true',
+            help='Create patches to the newest version of each file from every older version found in the old '
+                 'folder, instead of only the newest one.'
+        )
+        parser.add_argument(
+            '--device-jobs',
+            action='store',
+            type=int,
+            help='The maximum number of files to read from the same disk or network share at the same time while '
+                 'checking CRCs or creating patches. 1 is a good choice for hard disks. No limit by default.',
+            default=0,
+            metavar='count'
+        )
+        parser.add_argument(
+            '--device-map',
+            action='append',
+            help='Treat every file under the path as being on the named device when applying --device-jobs, '
+                 'e.g. for several shares of the same NAS. Can be given more than once.',
+            default=[],
+            metavar='path=name'
+        )
+        parser.add_argument(
+            '--scratch-dir',
+            action='store',
+            help='The folder to create temporary files in when a filename is not safe for xdelta. Should be on the '
+                 'same filesystem as the old and new files. The current working directory by default.',
+            default='',
+            metavar='directory'
+        )
+        parser.add_argument(
+            '--watch',
+            action='store_true',
+            help='Keep running after the patches have been created, and create patches for new files as soon as they '
+                 'appear in the new folder and have stopped growing. Stop with Ctrl+C.'
+        )
+        parser.add_argument(
+            '--watch-interval',
+            action='store',
+            type=float,
+            help='How often to check for changes in watch mode, in seconds. Default: 5.',
+            default=5,
+            metavar='seconds'
+        )
+        parser.add_argument(
+            '--watch-settle',
+            action='store',
+            type=float,
+            help='How long a new file has to stay the same size in watch mode before a patch is created for it, in '
+                 'seconds. Default: 30.',
+            default=30,
+            metavar='seconds'
+        )
+        parser.add_argument(
+            '--metrics-json',
+            action='store',
+            help='Write timings, I/O volumes and encoder resource usage of the run to this file as JSON.',
+            default=None,
+            metavar='path'
+        )
+        parser.add_argument(
+            '--metrics-prom',
+            action='store',
+            help='Write timings, I/O volumes and encoder resource usage of the run to this file in the Prometheus '
+                 'text format, e.g. for the node_exporter textfile collector.',
+            default=None,
+            metavar='path'
+        )
+        parser.add_argument(
+            '--plan',
+            action='store',
+            help='Don\'t create any patches. Instead, encode a few samples of each pair and write the estimated patch '
+                 'sizes and encoding times, the total time and the size of the archive to this file as JSON.',
+            default=None,
+            metavar='path'
+        )
+        parser.add_argument(
+            '--calibration',
+            action='store',
+            help='Where the estimates of --plan are kept, to be corrected by the results of later runs. Default: '
+                 'batchpatch/calibration.json under $XDG_CACHE_HOME or ~/.cache.',
+            default=None,
+            metavar='path'
+        )
         parser.add_argument(
             '-v', '--version',
             action='version',
-            version="{} version {}".format(self.PROG_NAME, self.PROG_VERSION)
+            version="{} version {}".format(cls.PROG_NAME, cls.PROG_VERSION)
         )
+        return parser
 
-        args = parser.parse_args()
+    @classmethod
+    def create_config(cls, old, new, target=None, **options):
+        """ Creates the settings for process_batch. The options are named after the long forms of the command line
+            switches, with dashes replaced by underscores, e.g. check_crc=True or jobs=4. Options that are not given
+            get the same defaults as on the command line.
+        """
+        argv = ['--old', old, '--new', new]
+        if target is not None:
+            argv += ['--target', target]
+        config = cls.create_parser().parse_args(argv)
+
+        for name, value in options.items():
+            if not hasattr(config, name) or name in ('old', 'new', 'target'):
+                raise TypeError('Unknown option \'{}\'.'.format(name))
+            setattr(config, name, value)
+
+        for item in config.device_map:
+            if '=' not in item:
+                raise ConfigurationError('device_map expects values of the form path=name, got \'{}\'.'.format(item))
+        return config
+
+    def run(self, argv=None):
+        parser = self.create_parser()
+        args = parser.parse_args(argv)
+        for item in args.device_map:
+            if '=' not in item:
+                parser.error('--device-map expects values of the form path=name, got \'{}\'.'.format(item))
+        self.stage_timings = {}
+        self.metrics = RunMetrics()
         self.log_level = LogLevel[args.loglevel]
-        self.logger = Logger(self.log_level)
+        self.logger = Logger(self.log_level, args.log_format)
+        try:
+            self.run_with_args(args)
+        except BatchPatchError:
+            # Already logged where it was raised.
+            sys.exit(1)
+        finally:
+            self.logger.close()
+
+    def process_batch(self, config):
+        """ Processes a single batch with settings made by create_config, and returns a BatchResult. Raises a
+            BatchPatchError if the batch can't be processed. Messages are logged at the level given in the settings,
+            so pass loglevel='silent' to keep the console clean. Watch mode is not available here.
+        """
+        self.stage_timings = {}
+        self.metrics = RunMetrics()
+        self.log_level = LogLevel[config.loglevel]
+        self.logger = Logger(self.log_level, config.log_format)
+        try:
+            self.configure(config)
+            self.check_prerequisites(config)
+            try:
+                return self.process(config)
+            finally:
+                self.write_metrics(config.metrics_json, config.metrics_prom)
+        finally:
+            self.logger.close()
+
+    def run_with_args(self, args):
+        self.configure(args)
+        self.print_welcome()
+        self.check_prerequisites(args)
+
+        try:
+            self.process(args)
+        finally:
+            self.write_metrics(args.metrics_json, args.metrics_prom)
+
+        if self.watch_options['enabled'] and self.plan_options['path'] is None:
+            self.watch(args)
+
+    def configure(self, args):
         self.script_options['script_lang'] = args.script_lang
         self.script_options['script_name'] = args.script_name
+        self.script_options['runner'] = args.runner
+        self.script_options['compact'] = args.compact_script
         self.patch_options['filename_pattern'] = args.patch_pattern
+        self.patch_options['jobs'] = max(1, args.jobs)
+        self.patch_options['scratch_dir'] = args.scratch_dir
+        self.patch_options['recursive'] = args.recursive
+        self.patch_options['all_versions'] = args.all_versions
+        self.patch_options['match_content'] = args.match_content
+        self.patch_options['match_threshold'] = args.match_threshold
+        self.patch_options['backend'] = args.backend
+        self.patch_options['profile'] = args.profile
+        self.patch_options['deduplicate'] = not args.no_dedup
+        self.patch_options['verify'] = args.verify
+        self.patch_options['checksums'] = args.checksums
+        self.patch_options['device_jobs'] = max(0, args.device_jobs)
+        self.patch_options['device_map'] = dict(item.rpartition('=')[::2] for item in args.device_map)
+        self.patch_options['auto_sample_size'] = max(1, args.auto_sample_size)
+        self.patch_options['auto_time_weight'] = args.auto_time_weight
+        self.patch_options['bsdiff_max_size'] = int(args.bsdiff_max_size * self.MIB) \
+            if args.bsdiff_max_size > 0 else None
+        self.patch_options['max_patch_ratio'] = args.max_patch_ratio if args.max_patch_ratio is not None and \
+            args.max_patch_ratio > 0 else None
+        self.patch_options['segment_threshold'] = int(args.segment_threshold * self.MIB) \
+            if args.segment_threshold > 0 else None
+        self.patch_options['segment_size'] = max(SegmentPlanner.MIN_SEGMENT_SIZE, int(args.segment_size * self.MIB))
+        self.archive_options['create_zip'] = args.zip
         self.archive_options['zip_name'] = args.zip_name
+        self.watch_options['enabled'] = args.watch
+        self.watch_options['interval'] = max(0.1, args.watch_interval)
+        self.watch_options['settle_time'] = max(0, args.watch_settle)
+        self.cache_options['enabled'] = not args.no_hash_cache
+        self.cache_options['path'] = args.hash_cache
+        self.cache_options['max_entries'] = args.hash_cache_size
+        self.cache_options['max_age_days'] = args.hash_cache_age
+        self.plan_options['path'] = args.plan
+        self.plan_options['calibration'] = args.calibration if args.calibration is not None else \
+            CostModel.get_default_path()
 
         if args.xdelta is not None:
             self.xdelta_location = args.xdelta
             self.logger.log('Custom xdelta location \'{}\' read from the command line.'.format(args.xdelta),
                             LogLevel.debug)
 
-        self.print_welcome()
-        self.check_prerequisites(args)
-        file_pairs = self.identify_file_pairs_by_name(args.old, args.new)
+        self.zstd_location = args.zstd
+        self.bsdiff_location = args.bsdiff
+        self.bspatch_location = args.bspatch
+        self.create_backends()
+
+    def watch(self, args):
+        """ Waits for files to appear in the new folder, and runs again whenever some of them can be paired and have
+            stopped changing. Patches that are already up to date are skipped thanks to the manifest, so each run
+            only encodes the new pairs before writing the script and the archive again.
+        """
+        watcher = DirectoryWatcher.create(args.new, self.patch_options['recursive'])
+        self.logger.log('Watching {} for new files using {}. Press Ctrl+C to stop.'.format(args.new, watcher.name),
+                        LogLevel.notice)
+        # For each changed file, its last seen size and modification time, and since when they have stayed the same.
+        pending = {}
+
+        try:
+            while True:
+                for relpath in watcher.wait(self.watch_options['interval']):
+                    if self.create_file_entity(relpath, args.new) is not None:
+                        pending[relpath] = None
+
+                settled = self.get_settled_files(pending, args.new)
+                if len(settled) == 0:
+                    continue
+
+                old_keys = set(file.key for file in (
+                    self.create_file_entity(relpath, args.old, entry)
+                    for entry, relpath in DirectoryScanner(self.patch_options['recursive']).scan(args.old)
+                ) if file is not None)
+                matched = [relpath for relpath in settled if self.create_file_entity(relpath, args.new).key in old_keys]
+                for relpath in settled:
+                    if relpath not in matched:
+                        self.logger.log('{} has no equivalent in the old folder, ignoring it.', LogLevel.debug, relpath)
+
+                if len(matched) == 0:
+                    continue
+
+                self.logger.log('New files ready for patching: {}'.format(', '.join(matched)), LogLevel.notice)
+                self.stage_timings = {}
+                self.metrics = RunMetrics()
+                try:
+                    self.process(args)
+                except BatchPatchError:
+                    # Already logged, and the files may well be fixed by the time the next ones arrive.
+                    pass
+                finally:
+                    self.write_metrics(args.metrics_json, args.metrics_prom)
+        except KeyboardInterrupt:
+            self.logger.log('Stopped watching for new files.', LogLevel.notice)
+        finally:
+            watcher.close()
+
+    def get_settled_files(self, pending, base_dir):
+        """ Removes the files that have kept their size and modification time for long enough from pending, and
+            returns them.
+        """
+        settled = []
+        now = time.monotonic()
+        for relpath, previous in list(pending.items()):
+            try:
+                stat = os.stat(os.path.join(base_dir, relpath))
+            except OSError:
+                # Deleted or renamed before it was done, which the watcher will report separately if it matters.
+                del pending[relpath]
+                continue
+
+            state = (stat.st_size, stat.st_mtime_ns)
+            if previous is None or previous[0] != state:
+                pending[relpath] = (state, now)
+            elif now - previous[1] >= self.watch_options['settle_time']:
+                del pending[relpath]
+                settled.append(relpath)
+
+        return settled
+
+    def process(self, args):
+        file_pairs = self.run_stage('pairing', self.identify_file_pairs_by_name, args.old, args.new)
+        if self.patch_options['match_content']:
+            file_pairs += self.run_stage('content_pairing', self.identify_file_pairs_by_content, args.old, args.new,
+                                         file_pairs)
+        self.result = BatchResult(args.target, file_pairs)
+        self.result.stage_timings = self.stage_timings
 
         if len(file_pairs) > 0:
             # Sort in alphabetical order for nicer output all around
-            file_pairs.sort(key=lambda item: item[0])
-
-            if args.check_crc:
-                errors = self.check_crcs(file_pairs)
-                if len(errors) > 0:
-                    self.logger.log('One or more CRC values did not match, cannot proceed.', LogLevel.error)
-                    return
+            file_pairs.sort(key=lambda item: item.source.filename)
 
-            self.generate_patches(file_pairs, args.target)
-            self.generate_win_script(file_pairs, args.target)
-            self.copy_executable(args.target)
+            if self.plan_options['path'] is not None:
+                self.result.plan = self.run_stage('planning', self.plan_batch, file_pairs, args.target)
+                return self.result
 
-            if args.zip:
-                self.create_archive(file_pairs, args.target)
+            self.open_hash_cache()
+            try:
+                self.process_pairs(file_pairs, args)
+            finally:
+                # A stage that failed may have left these open, which would keep the cache database locked and the
+                # archive without its directory, also for the next pass of watch mode.
+                self.close_hash_cache()
+                self.close_archive()
 
             self.logger.log('Done.', LogLevel.notice)
         else:
             self.logger.log('No files to generate patches for.', LogLevel.notice)
 
+        return self.result
+
+    def process_pairs(self, file_pairs, args):
+        """ Runs the stages from checking the CRCs to writing the archive on the pairs found. """
+        if args.check_crc:
+            errors = self.run_stage('crc_check', self.check_crcs, file_pairs)
+            if len(errors) > 0:
+                self.logger.log('One or more CRC values did not match, cannot proceed.', LogLevel.error)
+                raise CrcMismatchError(errors)
+
+        self.duplicates = {}
+        if self.patch_options['deduplicate']:
+            self.run_stage('deduplication', self.deduplicate_pairs, file_pairs)
+
+        if self.patch_options['backend'] == 'auto':
+            self.run_stage('backend_selection', self.select_backends,
+                           [pair for pair in file_pairs if pair.duplicate_of is None])
+
+        self.link_duplicates()
+
+        if self.archive_options['create_zip']:
+            self.open_archive(args.target)
+
+        self.open_cost_model()
+        try:
+            self.run_stage('patch_generation', self.generate_patches, file_pairs, args.target)
+        finally:
+            self.close_cost_model()
+        if self.patch_options['verify']:
+            failed = self.run_stage('verification', self.verify_patches, file_pairs, args.target)
+            self.result.verification_failures = failed
+            if len(failed) > 0:
+                self.logger.log('{} patches failed verification and will be recreated on the next run: {}'.format(
+                    str(len(failed)), ', '.join(failed)), LogLevel.error)
+        if self.patch_options['checksums']:
+            self.run_stage('checksums', self.write_checksums, file_pairs, args.target)
+        self.run_stage('script_generation', self.generate_win_script, file_pairs, args.target)
+        if self.script_options['runner']:
+            self.run_stage('runner_generation', self.generate_runner, file_pairs, args.target)
+        self.close_hash_cache()
+        self.run_stage('executable_copy', self.copy_executables, file_pairs, args.target)
+
+        if self.archive_options['create_zip']:
+            self.run_stage('archiving', self.create_archive, file_pairs, args.target)
+
+    def run_stage(self, name, func, *args):
+        """ Calls one of the steps of the run, and records how long it took in stage_timings. """
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.stage_timings[name] = time.perf_counter() - start
+            self.metrics.add_stage(name, self.stage_timings[name])
+            self.logger.log('Stage {} took {:.3f} s.', LogLevel.debug, name, self.stage_timings[name])
+
+    def write_metrics(self, json_path, prom_path):
+        for path, writer in ((json_path, self.metrics.write_json), (prom_path, self.metrics.write_prometheus)):
+            if path is None:
+                continue
+
+            try:
+                writer(path)
+                self.logger.log('Wrote run metrics to \'{}\'.'.format(path), LogLevel.debug)
+            except (OSError, IOError) as e:
+                self.logger.log('Writing run metrics to \'{}\' failed: {}'.format(path, e.strerror), LogLevel.warning)
+
     def check_prerequisites(self, args):
         self.logger.log('Checking prerequisites.', LogLevel.debug)
         for p in ('old', 'new', 'target'):
@@ -202,27 +844,42 @@ class BatchPatch:
                 path = getattr(args, p)
             except AttributeError:
                 self.logger.log('Expected parameter \'{}\' was missing!'.format(p), LogLevel.error)
-                exit()
+                raise ConfigurationError('Expected parameter \'{}\' was missing!'.format(p))
 
             if not os.path.isdir(path):
                 if p != 'target':
                     self.logger.log('{} is not a valid path!'.format(path), LogLevel.error)
-                    exit()
+                    raise ConfigurationError('{} is not a valid path!'.format(path))
                 else:
                     if os.path.exists(path):
                         self.logger.log('\'{}\' exists and is not a directory!'.format(path), LogLevel.error)
-                        exit()
+                        raise ConfigurationError('\'{}\' exists and is not a directory!'.format(path))
+                    elif self.plan_options['path'] is not None:
+                        self.logger.log('Not creating the output directory \'{}\' for a plan.'.format(path),
+                                        LogLevel.debug)
                     else:
                         self.logger.log('Creating output directory \'{}\'.'.format(path), LogLevel.notice)
                         try:
                             os.makedirs(path)
                         except OSError as e:
-                            self.logger.log('Error while creating directory \'{]\': {}'.format(path, e.strerror),
+                            self.logger.log('Error while creating directory \'{}\': {}'.format(path, e.strerror),
                                             LogLevel.error)
-                            exit()
+                            raise ConfigurationError('Could not create \'{}\': {}'.format(path, e.strerror))
             else:
                 self.logger.log('\'{}\' was found.'.format(path), LogLevel.debug)
 
+        if self.patch_options['backend'] not in ('xdelta3', 'auto'):
+            backend = self.backends[self.patch_options['backend']]
+            self.logger.log('Verifying the {} executables are found.'.format(backend.name), LogLevel.debug)
+            if not backend.is_available():
+                msg = 'The {} executables could not be found at \'{}\' or lack execution permissions!'.format(
+                    backend.name, '\', \''.join(backend.get_encoder_executables() + backend.get_executables()))
+                self.logger.log(msg, LogLevel.error)
+                raise ConfigurationError(msg)
+
+            self.logger.log('Prerequisites OK.', LogLevel.debug)
+            return
+
         self.logger.log('Verifying a xdelta executable is found from the specified location.', LogLevel.debug)
 
         if not os.path.exists(self.xdelta_location) or not os.path.isfile(self.xdelta_location):
@@ -231,93 +888,1116 @@ class BatchPatch:
             self.logger.log('Please download correct version for your system from the xdelta site or', LogLevel.error)
             self.logger.log('compile it yourself, and then add it to the same directory as this script', LogLevel.error)
             self.logger.log('under the name xdelta3.exe.', LogLevel.error)
-            exit()
+            raise ConfigurationError('The xdelta3 executable could not be found at \'{}\'!'.format(
+                self.xdelta_location))
 
         if not os.access(self.xdelta_location, os.X_OK):
-            self.logger.log('The xdelta3 executable at \'{}\' doesn\'t have execution permissions!'.format(
-                self.xdelta_location), LogLevel.error
-            )
-            exit()
+            msg = 'The xdelta3 executable at \'{}\' doesn\'t have execution permissions!'.format(self.xdelta_location)
+            self.logger.log(msg, LogLevel.error)
+            raise ConfigurationError(msg)
+
+        if self.patch_options['backend'] == 'auto':
+            available = [b.name for b in self.backends.values() if b.is_available()]
+            self.logger.log('Backends available for automatic selection: {}'.format(', '.join(available)),
+                            LogLevel.notice)
 
         self.logger.log('Prerequisites OK.', LogLevel.debug)
 
     def check_crcs(self, file_pairs):
+        files = [file for pair in file_pairs for file in [pair.source, pair.target] if file.crc is not None]
         errors = []
-        for pair in file_pairs:
-            for file in [pair[5], pair[6]]:
-                if file["crc"] is None:
-                    continue
+        cancel_event = threading.Event()
+        hasher = self.create_hasher(cancel_event)
 
-                self.logger.log('Calculating CRC for {}...'.format(os.path.basename(file["filename"])), LogLevel.notice)
+        def check_file(file):
+            self.logger.log('Calculating CRC for {}...'.format(os.path.basename(file.filename)), LogLevel.notice)
+            try:
+                crc = hasher.crc32(file.filename)
+            except HashingCancelled:
+                return
+            self.logger.log('CRC of {} is {}, filename says {}.'.format(
+                os.path.basename(file.filename), crc, file.crc), LogLevel.notice)
 
-                with open(file["filename"], 'rb') as f:
-                    buffer = f.read(self.CRC_BUFFER_SIZE)
-                    intermediate = 0
+            if crc.lower() != file.crc.lower():
+                self.logger.log('CRCs don\'t match!', LogLevel.error)
+                errors.append(file.filename)
+                # No point in hashing the rest of the files, since we won't be continuing anyway.
+                cancel_event.set()
 
-                    while len(buffer) > 0:
-                        intermediate = zlib.crc32(buffer, intermediate)
-                        buffer = f.read(self.CRC_BUFFER_SIZE)
+        self.get_io_scheduler().run(check_file, files, lambda file: [file.filename], cancel_event)
 
-                    crc = format(intermediate & 0xFFFFFFFF, '08x')
-                    self.logger.log('CRC is {}, filename says {}.'.format(crc, file["crc"]), LogLevel.notice)
+        if cancel_event.is_set():
+            self.logger.log('Skipped the remaining CRC checks after the first mismatch.', LogLevel.debug)
 
-                    if crc.lower() != file["crc"].lower():
-                        self.logger.log('CRCs don\'t match!', LogLevel.error)
-                        errors.append(file["filename"])
+        self.metrics.add_bytes('crc_check', read=hasher.bytes_read)
 
         return errors
 
+    def create_hasher(self, cancel_event=None):
+        """ Creates a hasher that also calculates the digests of the checksum file whenever it has to read a file, so
+            that writing the checksum file later doesn't read it again.
+        """
+        return FileHasher(cancel_event, self.hash_cache,
+                          self.CHECKSUM_ALGORITHMS if self.patch_options['checksums'] else ())
+
+    def open_hash_cache(self):
+        if self.hash_cache is not None:
+            return
+
+        if not self.cache_options['enabled']:
+            # Still remember the digests until the end of the run, so that no file is hashed twice.
+            self.hash_cache = MemoryHashCache()
+            return
+
+        if self.shared_hash_cache is not None:
+            self.hash_cache = self.shared_hash_cache
+            return
+
+        try:
+            self.hash_cache = HashCache(self.cache_options['path'], self.cache_options['max_entries'],
+                                        self.cache_options['max_age_days'] * 24 * 60 * 60)
+            self.logger.log('Using the hash cache at \'{}\'.'.format(self.cache_options['path']), LogLevel.debug)
+        except (OSError, sqlite3.Error) as e:
+            self.logger.log('Opening the hash cache at \'{}\' failed, continuing without it: {}'.format(
+                self.cache_options['path'], e), LogLevel.warning)
+            self.hash_cache = MemoryHashCache()
+
+    def close_hash_cache(self):
+        if self.hash_cache is None:
+            return
+
+        self.logger.log('Hash cache: {} hits, {} misses.'.format(self.hash_cache.hits, self.hash_cache.misses),
+                        LogLevel.debug)
+        if self.hash_cache is self.shared_hash_cache:
+            # Left open for the other batches using it.
+            self.hash_cache = None
+            return
+
+        try:
+            self.hash_cache.close()
+        except sqlite3.Error as e:
+            self.logger.log('Closing the hash cache failed: {}'.format(e), LogLevel.warning)
+        self.hash_cache = None
+
     def generate_patches(self, file_pairs, target_dir):
         self.logger.log('Generating patches for {} file pairs.'.format(str(len(file_pairs))), LogLevel.debug)
+
+        self.manifest = PatchManifest(target_dir, '{} {}'.format(self.PROG_NAME, self.PROG_VERSION))
+        if not self.manifest.load():
+            self.logger.log('The existing patch manifest in the target folder could not be read, '
+                            'all patches will be recreated.', LogLevel.warning)
+
+        unique_pairs = [pair for pair in file_pairs if pair.duplicate_of is None]
+        pending = []
+        for pair in unique_pairs:
+            if self.is_patch_up_to_date(pair, target_dir):
+                self.logger.log('Patch {} is up to date, skipping.'.format(pair.patch_name), LogLevel.notice)
+                self.result.up_to_date.append(pair.patch_name)
+                entry = self.manifest.get(pair.patch_name)
+                pair.full_file = entry.get('full_file')
+                if entry.get('segments') is not None:
+                    pair.segments = [Segment.from_dict(i, item) for i, item in enumerate(entry['segments'])]
+                self.update_recorded_duplicates(pair)
+                for name in self.get_shipped_files(pair):
+                    self.add_to_archive(target_dir, name)
+            else:
+                pending.append(pair)
+
+        if len(pending) < len(unique_pairs):
+            self.logger.log('{} of {} patches need to be created.'.format(str(len(pending)), str(len(unique_pairs))),
+                            LogLevel.notice)
+
+        jobs = self.patch_options['jobs']
+        if jobs <= 1:
+            # Encoder output can't be written to the console as is when the log is made of JSON lines.
+            buffer_output = self.logger.log_format == 'json'
+            for task in self.get_encoding_tasks(self.group_by_target(pending)):
+                self.run_encoding_task(task, target_dir, buffer_output)
+        else:
+            # Start the largest pairs first so that a single huge file doesn't end up running alone at the very end.
+            queue = self.get_encoding_tasks(self.group_by_target(sorted(pending, key=lambda item: item.get_size(),
+                                                                        reverse=True)))
+            self.logger.log('Running up to {} encoder processes at once.'.format(str(jobs)), LogLevel.debug)
+
+            self.get_io_scheduler().run(lambda task: self.run_encoding_task(task, target_dir, True), queue,
+                                        lambda task: [task[0].source.filename, task[0].target.filename])
+
+        for original, duplicates in self.duplicates.items():
+            for pair in duplicates:
+                pair.full_file = original.full_file
+                pair.segments = original.segments
+
+    def get_encoding_tasks(self, file_pairs):
+        """ Lists the encoder runs needed for the pairs, as (pair, segment, progress) tuples. Pairs that are split into
+            segments get a task for each segment, so that the segments can be encoded in parallel like any other
+            pairs. The segment and progress are None for the pairs encoded as a whole.
+        """
+        tasks = []
+        for pair in file_pairs:
+            segments = self.plan_segments(pair)
+            if segments is None:
+                tasks.append((pair, None, None))
+            else:
+                progress = SegmentProgress(segments)
+                tasks.extend((pair, segment, progress) for segment in segments)
+
+        self.check_segment_scratch_space([segment for _, segment, _ in tasks if segment is not None])
+        return tasks
+
+    def check_segment_scratch_space(self, segments):
+        """ Warns if the scratch folder can't hold the copies of the segments that may be encoded at the same time.
+            Each copy is deleted as soon as its segment is done, so only as many segments as there are jobs matter.
+        """
+        if len(segments) == 0:
+            return
+
+        sizes = sorted((segment.source_length + segment.target_length for segment in segments), reverse=True)
+        needed = sum(sizes[:self.patch_options['jobs']])
+        scratch_dir = self.patch_options['scratch_dir'] or os.getcwd()
+        try:
+            free = shutil.disk_usage(scratch_dir).free
+        except OSError:
+            return
+
+        if needed > free:
+            self.logger.log('Encoding the segments takes up to {:.1f} MiB in the scratch folder \'{}\', but only '
+                            '{:.1f} MiB is free. Consider fewer jobs, a smaller --segment-size or another '
+                            '--scratch-dir.'.format(needed / self.MIB, scratch_dir, free / self.MIB), LogLevel.warning)
+
+    def run_encoding_task(self, task, target_dir, buffer_output):
+        pair, segment, progress = task
+        if segment is None:
+            self.generate_patch(pair, target_dir, buffer_output)
+        else:
+            self.generate_segment(pair, segment, progress, target_dir, buffer_output)
+
+    def should_segment(self, pair, backend=None):
+        """ Whether the pair is split into segments when it is encoded with the given backend, or its own. """
+        backend = backend if backend is not None else pair.backend
+        threshold = self.patch_options['segment_threshold']
+        if threshold is None or backend.get_script_stream_decode_command('', '') is None:
+            return False
+
+        try:
+            return pair.target.get_size() > threshold and pair.source.get_size() > 0
+        except OSError:
+            return False
+
+    def get_largest_input(self, pair, backend):
+        """ The size of the largest file the encoder has to handle at once when the pair is encoded with the given
+            backend. Segments take the surroundings of their range of the old file along, and the last one may be up
+            to half a segment longer.
+        """
+        size = self.get_encoding_size(pair)
+        if self.should_segment(pair, backend):
+            size = min(size, int(self.patch_options['segment_size'] * (1.5 + 2 * SegmentPlanner.OVERLAP)))
+        return size
+
+    def get_segment_size(self, pair):
+        """ The segment size that applies to a pair, or None if it is encoded as a whole. """
+        return self.patch_options['segment_size'] if self.should_segment(pair) else None
+
+    def plan_segments(self, pair):
+        """ Splits a pair into segments if its new file is large enough. Returns None if it should be encoded as a
+            whole.
+        """
+        if not self.should_segment(pair):
+            return None
+
+        try:
+            segments = SegmentPlanner(self.patch_options['segment_size']).plan(pair.source.filename,
+                                                                               pair.target.filename, pair.patch_name)
+        except (OSError, IOError, ValueError) as e:
+            self.logger.log('Splitting {} into segments failed, encoding it as a whole: {}'.format(
+                pair.patch_name, e), LogLevel.warning)
+            return None
+
+        if len(segments) < 2:
+            return None
+
+        self.logger.log('Splitting {} into {} segments.'.format(pair.patch_name, str(len(segments))), LogLevel.notice)
+        for segment in segments:
+            self.logger.log('Segment {}: old {}+{}, new {}+{}', LogLevel.debug, segment.patch_name,
+                            segment.source_offset, segment.source_length, segment.target_offset,
+                            segment.target_length)
+        return segments
+
+    @staticmethod
+    def group_by_target(file_pairs):
+        """ Reorders the pairs so that the pairs sharing a target file follow each other, newest source first. The
+            groups keep the order in which their first pair appears. Encoding them back to back lets the later ones
+            read the target from the page cache, instead of reading it from the disk again after other files have
+            pushed it out.
+        """
+        groups = {}
         for pair in file_pairs:
-            self.logger.log('Creating patch: {} -> {}'.format(pair[0], pair[1]), LogLevel.notice)
-
-            effective_source = pair[0]
-            effective_target = pair[1]
-            temp_source_name = None
-            temp_target_name = None
-            if not pair[4]:
-                temp_source_name = '~' + os.path.basename(pair[2]) + '.src'
-                temp_target_name = '~' + os.path.basename(pair[2]) + '.dst'
-                self.logger.log(('Filename is not safe for xdelta on Windows. Copying files to temporary '
-                                 'names {} and {}.').format(temp_source_name, temp_target_name), LogLevel.notice)
-                shutil.copyfile(pair[0], temp_source_name)
-                shutil.copyfile(pair[1], temp_target_name)
+            groups.setdefault(pair.target.filename, []).append(pair)
+
+        return [pair for group in groups.values() for pair in sorted(group, key=lambda item: item.source.ver,
+                                                                       reverse=True)]
+
+    def generate_patch(self, pair, target_dir, buffer_output=False):
+        """ Creates the patch file for a single pair. If buffer_output is set, the output of the encoder is collected
+            and logged in one go after the process exits, so that the output of parallel jobs doesn't get interleaved.
+        """
+        self.logger.log('Creating patch: {} -> {}'.format(pair.source.filename, pair.target.filename), LogLevel.notice)
+        self.manifest.forget(pair.patch_name)
+
+        effective_source = pair.source.filename
+        effective_target = pair.target.filename
+        temp_source_name = None
+        temp_target_name = None
+        try:
+            if not pair.windows_safe:
+                scratch_dir = self.patch_options['scratch_dir']
+                temp_source_name = os.path.join(scratch_dir, pair.get_temp_name('.src'))
+                temp_target_name = os.path.join(scratch_dir, pair.get_temp_name('.dst'))
+                self.logger.log(('Filename is not safe for xdelta on Windows. Making the files available under '
+                                 'temporary names {} and {}.').format(temp_source_name, temp_target_name),
+                                LogLevel.notice)
+                for original, temporary in ((pair.source.filename, temp_source_name),
+                                            (pair.target.filename, temp_target_name)):
+                    method = ScratchFile.create(original, temporary)
+                    self.logger.log('Created {} using method: {}'.format(temporary, method), LogLevel.debug)
                 effective_source = temp_source_name
                 effective_target = temp_target_name
 
-            cmd = [
-                self.xdelta_location,
-                '-e',        # Create patch
-                '-9',        # Use maximum compression
-                '-s',        # Read from file
-                effective_source,     # Old file
-                effective_target,     # New file
-                os.path.join(target_dir, pair[2])    # Patch destination
-            ]
-
-            if self.log_level.numval <= LogLevel.notice.numval:
-                # Pass verbose flag to xdelta if using a relatively verbose logging level
-                cmd.insert(2, '-v')
-            elif self.log_level.numval == LogLevel.silent.numval:
-                # Pass quiet flag if using the silent logging level
-                cmd.insert(2, '-q')
+            patch_path = os.path.join(target_dir, pair.patch_name)
+            if not os.path.isdir(os.path.dirname(patch_path)):
+                os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+
+            size = self.get_encoding_size(pair)
+            cmd = pair.backend.get_encode_command(effective_source, effective_target, patch_path,
+                                                  self.get_verbosity(), size)
+            if self.patch_options['profile'] is not None:
+                self.logger.log('Encoding {} with {} options: {}'.format(
+                    pair.patch_name, pair.backend.name, ' '.join(pair.backend.get_options(size))), LogLevel.notice)
+
+            IOScheduler.prefetch(effective_source)
+            IOScheduler.prefetch(effective_target)
+            ret, rusage, elapsed, over_budget = self.run_encoder(cmd, patch_path, self.get_patch_size_limit(pair),
+                                                                 pair.patch_name, buffer_output)
+
+            if over_budget:
+                self.ship_full_file(pair, target_dir, cmd)
+            elif ret != 0:
+                self.logger.log('{} returned a non-zero return value {}! '
+                                'This probably means something went wrong.'.format(pair.backend.name, str(ret)),
+                                LogLevel.warning)
+                self.result.failed.append(pair.patch_name)
+            else:
+                self.metrics.add_pair(pair.patch_name, pair.backend.name, pair.source.get_size(),
+                                      pair.target.get_size(), os.path.getsize(patch_path), elapsed, rusage)
+                self.observe_cost(pair, os.path.getsize(patch_path), elapsed)
+                self.record_patch(pair, target_dir, cmd)
+                self.add_to_archive(target_dir, pair.patch_name)
+                self.result.created.append(pair.patch_name)
+        except (OSError, IOError) as e:
+            self.logger.log('Encoding {} failed! {}'.format(pair.patch_name, e.strerror), LogLevel.warning)
+            self.result.failed.append(pair.patch_name)
+        finally:
+            # Also when the encoder couldn't be started or the temporary names couldn't all be created.
+            temp_names = [name for name in (temp_source_name, temp_target_name)
+                          if name is not None and os.path.lexists(name)]
+            if len(temp_names) > 0:
+                self.logger.log('Removing temporary files.', LogLevel.notice)
+                for name in temp_names:
+                    os.unlink(name)
+
+    def run_encoder(self, cmd, patch_path, limit, label, buffer_output):
+        """ Runs an encoder process, stopping it if the patch grows past the limit. Returns the return value, the
+            resource usage, the time taken and whether the limit was exceeded.
+        """
+        self.logger.log('Starting subprocess, command line: {}'.format(" ".join(cmd)), LogLevel.debug)
+        start = time.perf_counter()
+        if buffer_output:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        else:
+            # The encoder writes straight to the console, so get the queued messages out before it does.
+            self.logger.flush()
+            proc = subprocess.Popen(cmd)
+
+        watchdog = SizeWatchdog(proc, patch_path, limit) if limit is not None else None
+        if watchdog is not None:
+            watchdog.start()
+
+        if buffer_output:
+            output = proc.stdout.read()
+            proc.stdout.close()
+        ret, rusage = RunMetrics.wait(proc)
+        elapsed = time.perf_counter() - start
+        over_budget = watchdog is not None and watchdog.stop()
+
+        if buffer_output:
+            for line in output.decode(errors='replace').splitlines():
+                self.logger.log('{}: {}'.format(label, line), LogLevel.notice)
+
+        return ret, rusage, elapsed, over_budget
+
+    def generate_segment(self, pair, segment, progress, target_dir, buffer_output=False):
+        """ Creates the patch of a single segment of a pair. The segment and its range of the old file are copied
+            into the scratch folder, so that the encoder only has to keep the segment in memory, and deleted as soon
+            as the segment is done. The pair is finished once its last segment is done.
+        """
+        cmd = None
+        failed = False
+        over_budget = False
+        elapsed = 0
+        if not progress.is_aborted():
+            self.logger.log('Creating segment {} of {}: {} -> {}'.format(
+                str(segment.index + 1), str(len(progress.segments)), pair.source.filename, pair.target.filename),
+                LogLevel.notice)
+            if segment.index == 0:
+                self.manifest.forget(pair.patch_name)
+
+            scratch_dir = self.patch_options['scratch_dir']
+            temp_source_name = os.path.join(scratch_dir, pair.get_temp_name('.src.{:03d}'.format(segment.index)))
+            temp_target_name = os.path.join(scratch_dir, pair.get_temp_name('.dst.{:03d}'.format(segment.index)))
+            patch_path = os.path.join(target_dir, segment.patch_name)
+            try:
+                ScratchFile.extract(pair.source.filename, temp_source_name, segment.source_offset,
+                                    segment.source_length)
+                ScratchFile.extract(pair.target.filename, temp_target_name, segment.target_offset,
+                                    segment.target_length)
+                os.makedirs(os.path.dirname(patch_path), exist_ok=True)
+
+                cmd = pair.backend.get_encode_command(temp_source_name, temp_target_name, patch_path,
+                                                      self.get_verbosity(),
+                                                      max(segment.source_length, segment.target_length))
+                ratio = self.patch_options['max_patch_ratio']
+                limit = int(ratio * segment.target_length) if ratio is not None else None
+                ret, rusage, elapsed, over_budget = self.run_encoder(cmd, patch_path, limit, segment.patch_name,
+                                                                     buffer_output)
+
+                if not over_budget and ret != 0:
+                    self.logger.log('{} returned a non-zero return value {}! '
+                                    'This probably means something went wrong.'.format(pair.backend.name, str(ret)),
+                                    LogLevel.warning)
+                    failed = True
+                elif not over_budget:
+                    self.metrics.add_pair(segment.patch_name, pair.backend.name, segment.source_length,
+                                          segment.target_length, os.path.getsize(patch_path), elapsed, rusage)
+            except (OSError, IOError) as e:
+                self.logger.log('Encoding the segment {} failed! {}'.format(segment.patch_name, e.strerror),
+                                LogLevel.warning)
+                failed = True
+            finally:
+                for name in (temp_source_name, temp_target_name):
+                    if os.path.isfile(name):
+                        os.unlink(name)
+
+        if progress.finish_segment(cmd, failed, over_budget, elapsed):
+            self.finish_segmented_patch(pair, progress, target_dir)
+
+    def finish_segmented_patch(self, pair, progress, target_dir):
+        if progress.failed:
+            self.result.failed.append(pair.patch_name)
+            return
+
+        if progress.over_budget:
+            for segment in progress.segments:
+                path = os.path.join(target_dir, segment.patch_name)
+                if os.path.isfile(path):
+                    os.unlink(path)
+            self.ship_full_file(pair, target_dir, progress.command)
+            return
+
+        pair.segments = progress.segments
+        try:
+            self.write_segment_manifest(pair, target_dir)
+        except (OSError, IOError) as e:
+            self.logger.log('Writing the segment list of {} failed! {}'.format(pair.patch_name, e.strerror),
+                            LogLevel.warning)
+            self.result.failed.append(pair.patch_name)
+            return
+
+        self.observe_cost(pair, sum(os.path.getsize(os.path.join(target_dir, segment.patch_name))
+                                    for segment in pair.segments), progress.seconds)
+        self.record_patch(pair, target_dir, progress.command)
+        for name in self.get_shipped_files(pair):
+            self.add_to_archive(target_dir, name)
+        self.result.created.append(pair.patch_name)
+
+    def write_segment_manifest(self, pair, target_dir):
+        """ Writes the list of segments next to their patches, so that the patches can be applied by other tools as
+            well. Each segment is decoded against its range of the old file, and the results are joined in order.
+        """
+        path = os.path.join(target_dir, pair.patch_name + self.SEGMENT_MANIFEST_SUFFIX)
+        with open(path, 'w', encoding='utf-8') as fh:
+            json.dump({
+                'generator': '{} {}'.format(self.PROG_NAME, self.PROG_VERSION),
+                'backend': pair.backend.name,
+                'old': pair.source.relpath,
+                'new': pair.target.relpath,
+                'old_size': pair.source.get_size(),
+                'new_size': pair.target.get_size(),
+                'segments': [segment.to_dict() for segment in pair.segments]
+            }, fh, indent=2, ensure_ascii=False)
+
+    def get_shipped_files(self, pair):
+        """ The files in the target folder that make up the patch of a pair. """
+        if pair.full_file is not None:
+            return [pair.full_file]
+
+        if pair.segments is not None:
+            return [pair.patch_name + self.SEGMENT_MANIFEST_SUFFIX] + [segment.patch_name for segment in pair.segments]
+
+        return [pair.patch_name]
+
+    def get_patch_size_limit(self, pair):
+        """ The size in bytes that the patch of a pair may not exceed, or None if there is no limit. """
+        ratio = self.patch_options['max_patch_ratio']
+        if ratio is None:
+            return None
+
+        try:
+            return int(ratio * pair.target.get_size())
+        except OSError:
+            return None
+
+    def ship_full_file(self, pair, target_dir, cmd):
+        """ Replaces a patch that grew past the size limit with a copy of the new file, which the script copies into
+            place instead of decoding a patch.
+        """
+        self.logger.log('The patch {} grew larger than {:.0%} of {}, shipping the new file instead.', LogLevel.notice,
+                        pair.patch_name, self.patch_options['max_patch_ratio'], pair.target.filename)
+        patch_path = os.path.join(target_dir, pair.patch_name)
+        if os.path.isfile(patch_path):
+            os.unlink(patch_path)
+
+        full_file = self.FULL_FILE_DIR + '/' + pair.target.relpath
+        full_path = os.path.join(target_dir, *full_file.split('/'))
+        # Pairs with the same new file, from different old versions, share the copy.
+        with self.full_file_lock:
+            if not os.path.isfile(full_path) or \
+                    PatchManifest.get_file_identity(full_path) != PatchManifest.get_file_identity(pair.target.filename):
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                method = ScratchFile.create(pair.target.filename, full_path, allow_symlink=False)
+                self.logger.log('Created {} using method: {}', LogLevel.debug, full_path, method)
+
+        pair.full_file = full_file
+        self.record_patch(pair, target_dir, cmd)
+        self.add_to_archive(target_dir, full_file)
+        self.result.full_files.append(full_file)
+
+    def verify_patches(self, file_pairs, target_dir):
+        """ Decodes each patch against its source and compares the hash of the result with the hash of the target.
+            The decoded data is read from a pipe, so it never has to be stored. Patches that were up to date and have
+            passed before are not decoded again, so that a rerun or a pass of watch mode only verifies the new
+            patches. Returns the names of the patches that failed.
+        """
+        up_to_date = set(self.result.up_to_date)
+        pairs = [pair for pair in file_pairs if pair.duplicate_of is None and pair.full_file is None and
+                 (pair.segments is not None or os.path.isfile(os.path.join(target_dir, pair.patch_name))) and
+                 not (pair.patch_name in up_to_date and self.manifest.get(pair.patch_name).get('verified'))]
+        hasher = self.create_hasher()
 
+        def verify(pair):
             try:
-                self.logger.log('Starting subprocess, command line: {}'.format(" ".join(cmd)), LogLevel.debug)
-                ret = subprocess.call(cmd)
-                if ret != 0:
-                    self.logger.log('xdelta returned a non-zero return value {}! '
-                                    'This probably means something went wrong.'.format(str(ret)), LogLevel.warning)
-
-                if not pair[4]:
-                    self.logger.log('Removing temporary files.'.format(temp_source_name, temp_target_name),
-                                    LogLevel.notice)
-                    os.unlink(temp_source_name)
-                    os.unlink(temp_target_name)
+                if self.verify_patch(pair, target_dir, hasher):
+                    entry = self.manifest.get(pair.patch_name)
+                    if entry is not None:
+                        self.manifest.record(pair.patch_name, dict(entry, verified=True))
+                    return None
+            except (OSError, IOError) as e:
+                self.logger.log('Verifying {} failed: {}'.format(pair.patch_name, e.strerror), LogLevel.error)
+
+            self.manifest.forget(pair.patch_name)
+            return pair.patch_name
+
+        results = self.get_io_scheduler().run(verify, pairs, lambda pair: [pair.source.filename,
+                                                                           pair.target.filename])
+        return [name for name in results if name is not None]
+
+    def verify_patch(self, pair, target_dir, hasher):
+        start = time.perf_counter()
+        expected = hasher.crc32(pair.target.filename)
+        patch_path = os.path.join(target_dir, pair.patch_name)
+
+        source = pair.source.filename
+        temp_source_name = None
+        if not pair.windows_safe or pair.segments is not None:
+            temp_source_name = os.path.join(self.patch_options['scratch_dir'], pair.get_temp_name('.src'))
+            if pair.segments is None:
+                ScratchFile.create(source, temp_source_name)
+            source = temp_source_name
+
+        try:
+            cmd = pair.backend.get_stream_decode_command(source, patch_path) if pair.segments is None else None
+            state = [0, 0]
+            if pair.segments is not None:
+                # Each segment is decoded against its own range of the old file, and the results hashed in order.
+                ret = 0
+                for segment in pair.segments:
+                    ScratchFile.extract(pair.source.filename, temp_source_name, segment.source_offset,
+                                        segment.source_length)
+                    ret = self.hash_stream(pair.backend.get_stream_decode_command(
+                        temp_source_name, os.path.join(target_dir, segment.patch_name)), state)
+                    if ret != 0:
+                        break
+                actual = format(state[0] & 0xFFFFFFFF, '08x')
+                size = state[1]
+            elif cmd is not None:
+                ret = self.hash_stream(cmd, state)
+                actual = format(state[0] & 0xFFFFFFFF, '08x')
+                size = state[1]
+            else:
+                # The decoder can only write into a file, so the result has to go through the scratch folder.
+                decoded = os.path.join(self.patch_options['scratch_dir'], pair.get_temp_name('.verify'))
+                ret = subprocess.run(pair.backend.get_decode_command(source, patch_path, decoded),
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+                actual = FileHasher().crc32(decoded) if ret == 0 else None
+                size = os.path.getsize(decoded) if ret == 0 else None
+                if os.path.isfile(decoded):
+                    os.unlink(decoded)
+        finally:
+            if temp_source_name is not None and os.path.isfile(temp_source_name):
+                os.unlink(temp_source_name)
+
+        elapsed = time.perf_counter() - start
+        if ret != 0:
+            self.logger.log('{} returned a non-zero return value {} while decoding {}!'.format(
+                pair.backend.name, str(ret), pair.patch_name), LogLevel.error)
+            return False
+
+        if actual != expected or size != pair.target.get_size():
+            self.logger.log('Decoding {} produced {} bytes with CRC {}, expected {} bytes with CRC {}!'.format(
+                pair.patch_name, str(size), actual, str(pair.target.get_size()), expected), LogLevel.error)
+            return False
+
+        self.metrics.add_verification(pair.patch_name, pair.backend.name, size, elapsed)
+        self.logger.log('Verified {} in {:.2f} s ({:.1f} MB/s).'.format(
+            pair.patch_name, elapsed, size / elapsed / 1000000 if elapsed > 0 else 0), LogLevel.notice)
+        return True
+
+    def hash_stream(self, cmd, state):
+        """ Runs a decoder that writes to its standard output, and adds the output to the CRC and the size in state.
+            Returns the return value of the decoder.
+        """
+        self.logger.log('Starting subprocess, command line: {}'.format(" ".join(cmd)), LogLevel.debug)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        with proc.stdout:
+            while True:
+                chunk = proc.stdout.read(FileHasher.CHUNK_SIZE)
+                if not chunk:
+                    break
+                state[0] = zlib.crc32(chunk, state[0])
+                state[1] += len(chunk)
+        return proc.wait()
+
+    def get_io_scheduler(self):
+        return IOScheduler(self.patch_options['jobs'], self.patch_options['device_jobs'],
+                           self.patch_options['device_map'], self.executor)
+
+    def get_verbosity(self):
+        if self.log_level.numval <= LogLevel.notice.numval:
+            # Make the encoder verbose if using a relatively verbose logging level
+            return 'verbose'
+        elif self.log_level.numval == LogLevel.silent.numval:
+            # Make the encoder quiet if using the silent logging level
+            return 'quiet'
+
+        return 'normal'
 
+    @staticmethod
+    def get_encoding_size(pair):
+        """ The file size that the encoder options of a pair are chosen by. """
+        try:
+            return max(pair.source.get_size(), pair.target.get_size())
+        except OSError:
+            return 0
+
+    def get_default_backend(self):
+        name = self.patch_options['backend']
+        return self.backends[name if name != 'auto' else 'xdelta3']
+
+    def deduplicate_pairs(self, file_pairs):
+        """ Finds pairs whose old and new files are identical to those of an earlier pair, and marks them as
+            duplicates of it, so that a single patch can be made for all of them. Only pairs whose file sizes match
+            another pair's are hashed.
+        """
+        by_size = {}
+        for pair in file_pairs:
+            try:
+                by_size.setdefault((pair.source.get_size(), pair.target.get_size()), []).append(pair)
+            except OSError:
+                continue
+
+        candidates = [pair for group in by_size.values() if len(group) > 1 for pair in group]
+        if len(candidates) == 0:
+            return
+
+        hasher = self.create_hasher()
+
+        def fingerprint(pair):
+            try:
+                return hasher.sha256(pair.source.filename), hasher.sha256(pair.target.filename)
             except (OSError, IOError) as e:
-                self.logger.log('Starting the subprocess failed! ' + e.strerror, LogLevel.warning)
+                self.logger.log('Hashing the files of {} failed, not checking it for duplicates: {}'.format(
+                    pair.patch_name, e.strerror), LogLevel.warning)
+                return None
+
+        fingerprints = self.get_io_scheduler().run(fingerprint, candidates,
+                                                   lambda pair: [pair.source.filename, pair.target.filename])
+        self.metrics.add_bytes('deduplication', read=hasher.bytes_read)
+
+        # The pairs are in alphabetical order within each size group, so the first of the identical pairs is kept.
+        originals = {}
+        for pair, digests in zip(candidates, fingerprints):
+            if digests is None:
+                continue
+
+            original = originals.setdefault(digests, pair)
+            if original is not pair:
+                pair.duplicate_of = original
+                self.duplicates.setdefault(original, []).append(pair)
+                self.logger.log('{} -> {} is identical to {} -> {}, reusing its patch.'.format(
+                    pair.source.filename, pair.target.filename, original.source.filename, original.target.filename
+                ), LogLevel.notice)
+
+    def link_duplicates(self):
+        """ Points the duplicate pairs to the patch of their original, once the backend of the original is known. """
+        for original, duplicates in self.duplicates.items():
+            for pair in duplicates:
+                pair.backend = original.backend
+                pair.patch_name = original.patch_name
+
+    def select_backends(self, file_pairs):
+        """ Encodes the beginning of each pair with every available backend that can handle its files, and switches
+            the pair to the one with the lowest cost. The cost is the size of the sample patch plus the encoding time
+            multiplied by the time weight. Pairs that no other backend can handle stay with xdelta3.
+        """
+        candidates = [b for b in self.backends.values() if b.is_available()]
+        if len(candidates) <= 1:
+            return
+
+        def select(pair):
+            usable = []
+            for backend in candidates:
+                size = self.get_largest_input(pair, backend)
+                if backend.supports(size):
+                    usable.append(backend)
+                else:
+                    self.logger.log('Not trying {} for {}, since it would have to encode {:.1f} MiB at once and can '
+                                    'only handle {:.1f} MiB.'.format(backend.name, pair.patch_name, size / self.MIB,
+                                                                     backend.max_size / self.MIB), LogLevel.notice)
+
+            if len(usable) == 0:
+                usable = [self.backends['xdelta3']]
+            if len(usable) == 1:
+                self.logger.log('Selected {} for {}, since it is the only backend that can handle it.'.format(
+                    usable[0].name, pair.patch_name), LogLevel.notice)
+                if usable[0] is not pair.backend:
+                    pair.backend = usable[0]
+                    pair.patch_name = self.get_patch_name(pair.source, pair.target, usable[0])
+                return
+
+            results = []
+            for backend in usable:
+                result = self.encode_sample(pair, backend)
+                if result is not None:
+                    results.append((result[0] + self.patch_options['auto_time_weight'] * result[1], backend, result))
+
+            if len(results) == 0:
+                return
+
+            best = min(results, key=lambda item: item[0])[1]
+            self.logger.log('Selected {} for {} ({}).'.format(best.name, pair.patch_name, ', '.join(
+                ['{}: {} bytes in {:.2f} s'.format(r[1].name, r[2][0], r[2][1]) for r in results]
+            )), LogLevel.notice)
+
+            if best is not pair.backend:
+                pair.backend = best
+                pair.patch_name = self.get_patch_name(pair.source, pair.target, best)
+
+        self.get_io_scheduler().run(select, file_pairs, lambda pair: [pair.source.filename, pair.target.filename])
+
+    def encode_sample(self, pair, backend, region=None):
+        """ Creates a patch between the given regions of the files of a pair, as a (source offset, source length,
+            target offset, target length) tuple, or between their beginnings by default. Returns the size of the patch
+            and the time it took to create, or None if the encoder failed.
+        """
+        if region is None:
+            sample_size = self.patch_options['auto_sample_size'] * 1024 * 1024
+            region = (0, sample_size, 0, sample_size)
+        base = os.path.join(self.patch_options['scratch_dir'], pair.get_temp_name('.' + backend.name))
+        paths = (base + '.src', base + '.dst', base + '.patch')
+
+        try:
+            for original, sample, offset, length in ((pair.source.filename, paths[0], region[0], region[1]),
+                                                     (pair.target.filename, paths[1], region[2], region[3])):
+                ScratchFile.extract(original, sample, offset, length)
+
+            start = time.perf_counter()
+            size = max(os.path.getsize(paths[0]), os.path.getsize(paths[1]))
+            ret = subprocess.call(backend.get_encode_command(paths[0], paths[1], paths[2], 'quiet', size),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - start
+
+            if ret != 0 or not os.path.isfile(paths[2]):
+                self.logger.log('{} failed to encode a sample of {}.'.format(backend.name, pair.patch_name),
+                                LogLevel.debug)
+                return None
+
+            return os.path.getsize(paths[2]), elapsed
+        except (OSError, IOError) as e:
+            self.logger.log('Encoding a sample of {} with {} failed: {}'.format(
+                pair.patch_name, backend.name, e.strerror), LogLevel.warning)
+            return None
+        finally:
+            for path in paths:
+                if os.path.exists(path):
+                    os.unlink(path)
+
+    def plan_batch(self, file_pairs, target_dir):
+        """ Estimates the patch size and the encoding time of each pair from patches of a few samples of it, and
+            writes them into the plan file along with the estimated total time and archive size. Patches that are
+            already up to date in the target folder are not estimated, and neither are identical pairs that would
+            reuse the patch of another. Nothing is written to the target folder.
+        """
+        self.duplicates = {}
+        if self.patch_options['deduplicate']:
+            self.open_hash_cache()
+            try:
+                self.run_stage('deduplication', self.deduplicate_pairs, file_pairs)
+            finally:
+                self.close_hash_cache()
+
+        unique_pairs = [pair for pair in file_pairs if pair.duplicate_of is None]
+        self.manifest = PatchManifest(target_dir, '{} {}'.format(self.PROG_NAME, self.PROG_VERSION))
+        if not self.manifest.load():
+            self.manifest.entries = {}
+        sampled = [0]
+        sampled_lock = threading.Lock()
+
+        def estimate(pair):
+            entry = {
+                'source': pair.source.filename,
+                'target': pair.target.filename,
+                'patch': pair.patch_name,
+                'backend': pair.backend.name,
+                'source_bytes': pair.source.get_size(),
+                'target_bytes': pair.target.get_size(),
+                'up_to_date': self.is_patch_up_to_date(pair, target_dir)
+            }
+            if entry['up_to_date']:
+                entry['patch_bytes'] = self.manifest.get(pair.patch_name).get('size')
+                return entry
+
+            results = []
+            regions = CostModel.get_sample_regions(entry['source_bytes'], entry['target_bytes'])
+            for region in regions:
+                result = self.encode_sample(pair, pair.backend, region)
+                if result is None:
+                    self.logger.log('Could not estimate {}, since encoding a sample failed.'.format(pair.patch_name),
+                                    LogLevel.warning)
+                    return entry
+                results.append(result)
+
+            source_bytes = sum(region[1] for region in regions)
+            target_bytes = sum(region[3] for region in regions)
+            with sampled_lock:
+                sampled[0] += source_bytes + target_bytes
+
+            settings = self.get_cost_settings(pair)
+            raw_size, raw_seconds, size, seconds, observations = self.cost_model.estimate(
+                settings, source_bytes, target_bytes, sum(result[0] for result in results),
+                sum(result[1] for result in results), entry['source_bytes'], entry['target_bytes'])
+            self.cost_model.remember(self.get_cost_identity(pair), settings, raw_size, raw_seconds)
+
+            limit = self.get_patch_size_limit(pair)
+            entry['settings'] = settings
+            entry['calibration_observations'] = observations
+            entry['estimated_patch_bytes'] = int(size)
+            entry['estimated_seconds'] = seconds
+            entry['full_file'] = limit is not None and size > limit
+            entry['patch_bytes'] = entry['target_bytes'] if entry['full_file'] else int(size)
+            entry['segments'] = -(-entry['target_bytes'] // self.patch_options['segment_size']) \
+                if self.should_segment(pair) else None
+            self.logger.log('{}: about {:.1f} MiB in {:.1f} s.'.format(
+                pair.patch_name, entry['patch_bytes'] / self.MIB, seconds), LogLevel.notice)
+            return entry
+
+        self.open_cost_model()
+        try:
+            if self.patch_options['backend'] == 'auto':
+                self.run_stage('backend_selection', self.select_backends, unique_pairs)
+            self.link_duplicates()
+
+            estimates = dict(zip(unique_pairs, self.get_io_scheduler().run(
+                estimate, unique_pairs, lambda pair: [pair.source.filename, pair.target.filename])))
+        finally:
+            # Keeps the estimates made before a failure, so that later runs can still calibrate with them.
+            self.close_cost_model()
+        self.metrics.add_bytes('planning', read=sampled[0])
+
+        entries = []
+        for pair in file_pairs:
+            if pair.duplicate_of is None:
+                entries.append(estimates[pair])
+            else:
+                entries.append({
+                    'source': pair.source.filename,
+                    'target': pair.target.filename,
+                    'patch': pair.patch_name,
+                    'backend': pair.backend.name,
+                    'duplicate_of': [pair.duplicate_of.source.filename, pair.duplicate_of.target.filename]
+                })
+        unique_entries = [estimates[pair] for pair in unique_pairs]
+
+        # Segmented pairs are encoded as several tasks that can run side by side.
+        durations = []
+        for entry in unique_entries:
+            if entry.get('estimated_seconds') is not None:
+                count = entry['segments'] or 1
+                durations += [entry['estimated_seconds'] / count] * count
+
+        executables = set(executable for backend in self.get_used_backends(file_pairs)
+                          for executable in backend.get_executables())
+        patch_bytes = sum(entry.get('patch_bytes') or 0 for entry in unique_entries)
+        plan = {
+            'generator': '{} {}'.format(self.PROG_NAME, self.PROG_VERSION),
+            'created': datetime.now(tz.tzlocal()).isoformat(),
+            'jobs': self.patch_options['jobs'],
+            'pairs': entries,
+            'total': {
+                'pairs': len(entries),
+                'duplicates': len(entries) - len(unique_entries),
+                'to_encode': len([entry for entry in unique_entries if not entry['up_to_date']]),
+                'not_estimated': len([entry for entry in unique_entries if not entry['up_to_date'] and
+                                      entry.get('estimated_seconds') is None]),
+                'patch_bytes': patch_bytes,
+                'archive_bytes': patch_bytes + sum(os.path.getsize(executable) for executable in executables
+                                                   if os.path.isfile(executable)),
+                'encoding_seconds': sum(durations),
+                'estimated_seconds': CostModel.estimate_wall_time(durations, self.patch_options['jobs'])
+            }
+        }
+
+        with open(self.plan_options['path'], 'w', encoding='utf-8') as fh:
+            json.dump(plan, fh, indent=2, ensure_ascii=False)
+
+        total = plan['total']
+        self.logger.log('Estimated {} patches to create in {} with {} jobs, {:.1f} MiB of patches and an archive of '
+                        '{:.1f} MiB. The plan was written to {}.'.format(
+                            str(total['to_encode']), self.format_duration(total['estimated_seconds']),
+                            str(self.patch_options['jobs']), total['patch_bytes'] / self.MIB,
+                            total['archive_bytes'] / self.MIB, self.plan_options['path']), LogLevel.notice)
+        return plan
+
+    def open_cost_model(self):
+        self.cost_model = CostModel(self.plan_options['calibration'])
+        if not self.cost_model.load():
+            self.logger.log('The calibration data at \'{}\' could not be read, starting over.'.format(
+                self.plan_options['calibration']), LogLevel.warning)
+            self.cost_model = CostModel(self.plan_options['calibration'])
+
+    def close_cost_model(self):
+        if self.cost_model is None:
+            return
+
+        try:
+            self.cost_model.save()
+        except OSError as e:
+            self.logger.log('Saving the calibration data to \'{}\' failed: {}'.format(
+                self.plan_options['calibration'], e.strerror), LogLevel.warning)
+        self.cost_model = None
+
+    def get_cost_settings(self, pair):
+        """ The encoder settings that the estimates of a pair are corrected for. """
+        settings = ' '.join([pair.backend.name] + pair.backend.get_options(self.get_encoding_size(pair)))
+        if self.should_segment(pair):
+            settings += ' segments={}'.format(self.patch_options['segment_size'])
+        return settings
+
+    def get_cost_identity(self, pair):
+        return json.dumps([PatchManifest.get_file_identity(pair.source.filename),
+                           PatchManifest.get_file_identity(pair.target.filename),
+                           self.get_cost_settings(pair)], sort_keys=True)
+
+    def observe_cost(self, pair, size, seconds):
+        """ Corrects the estimates with the real results of a patch, if it was estimated by an earlier plan. """
+        if self.cost_model is None:
+            return
+
+        try:
+            if self.cost_model.observe(self.get_cost_identity(pair), size, seconds):
+                self.logger.log('Calibrated the estimates with the results of {}.'.format(pair.patch_name),
+                                LogLevel.debug)
+        except OSError:
+            pass
+
+    @staticmethod
+    def format_duration(seconds):
+        seconds = int(round(seconds))
+        return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+    @staticmethod
+    def get_used_backends(file_pairs):
+        backends = []
+        for pair in file_pairs:
+            # The new files shipped as they are don't need a decoder.
+            if pair.full_file is None and pair.backend not in backends:
+                backends.append(pair.backend)
+        return backends
+
+    def record_patch(self, pair, target_dir, cmd):
+        patch_path = os.path.join(target_dir, pair.patch_name)
+        try:
+            entry = {
+                'source': PatchManifest.get_file_identity(pair.source.filename),
+                'target': PatchManifest.get_file_identity(pair.target.filename),
+                'command': cmd,
+                'backend': pair.backend.name,
+                'backend_version': pair.backend.get_version(),
+                'options': pair.backend.get_options(self.get_encoding_size(pair)),
+                'duplicates': self.get_duplicate_identities(pair),
+                'segment_size': self.get_segment_size(pair)
+            }
+            if pair.full_file is not None:
+                # The copy is not hashed, since it can be as large as any file in the batch.
+                entry['full_file'] = pair.full_file
+                entry['size'] = pair.target.get_size()
+                entry['max_patch_ratio'] = self.patch_options['max_patch_ratio']
+            elif pair.segments is not None:
+                hasher = self.create_hasher()
+                entry['segments'] = []
+                for segment in pair.segments:
+                    path = os.path.join(target_dir, segment.patch_name)
+                    entry['segments'].append(dict(segment.to_dict(), size=os.path.getsize(path),
+                                                  crc32=hasher.crc32(path)))
+                entry['size'] = sum(item['size'] for item in entry['segments'])
+            else:
+                entry['size'] = os.path.getsize(patch_path)
+                entry['crc32'] = self.create_hasher().crc32(patch_path)
+            self.manifest.record(pair.patch_name, entry)
+        except (OSError, IOError) as e:
+            self.logger.log('Recording {} in the patch manifest failed: {}'.format(pair.patch_name, e.strerror),
+                            LogLevel.warning)
+
+    def get_duplicate_identities(self, pair):
+        return [{
+            'source': PatchManifest.get_file_identity(duplicate.source.filename),
+            'target': PatchManifest.get_file_identity(duplicate.target.filename)
+        } for duplicate in self.duplicates.get(pair, [])]
+
+    def update_recorded_duplicates(self, pair):
+        """ Brings the list of pairs sharing an up to date patch in the manifest to match the current run. """
+        entry = self.manifest.get(pair.patch_name)
+        try:
+            duplicates = self.get_duplicate_identities(pair)
+            if entry.get('duplicates') != duplicates:
+                self.manifest.record(pair.patch_name, dict(entry, duplicates=duplicates))
+        except (OSError, IOError) as e:
+            self.logger.log('Recording {} in the patch manifest failed: {}'.format(pair.patch_name, e.strerror),
+                            LogLevel.warning)
+
+    def is_patch_up_to_date(self, pair, target_dir):
+        entry = self.manifest.get(pair.patch_name)
+        if entry is None:
+            return False
+
+        patch_path = os.path.join(target_dir, pair.patch_name)
+        try:
+            if entry.get('source') != PatchManifest.get_file_identity(pair.source.filename) or \
+                    entry.get('target') != PatchManifest.get_file_identity(pair.target.filename):
+                self.logger.log('Source or target of {} has changed since it was created.'.format(pair.patch_name),
+                                LogLevel.debug)
+                return False
+
+            options = pair.backend.get_options(self.get_encoding_size(pair))
+            if entry.get('backend') != pair.backend.name or entry.get('options') != options or \
+                    entry.get('backend_version') != pair.backend.get_version():
+                self.logger.log('{} was created with different encoder settings.'.format(pair.patch_name),
+                                LogLevel.debug)
+                return False
+
+            if entry.get('segment_size') != self.get_segment_size(pair):
+                self.logger.log('{} was created with different segment settings.'.format(pair.patch_name),
+                                LogLevel.debug)
+                return False
+
+            if entry.get('full_file') is not None:
+                full_path = os.path.join(target_dir, *entry['full_file'].split('/'))
+                if entry.get('max_patch_ratio') != self.patch_options['max_patch_ratio']:
+                    self.logger.log('{} was replaced by the new file under a different size limit.'.format(
+                        pair.patch_name), LogLevel.debug)
+                    return False
+                if not os.path.isfile(full_path) or os.path.getsize(full_path) != entry.get('size'):
+                    self.logger.log('The copy of the new file of {} is missing or damaged.'.format(pair.patch_name),
+                                    LogLevel.debug)
+                    return False
+                return True
+
+            limit = self.get_patch_size_limit(pair)
+            if limit is not None and entry.get('size') > limit:
+                self.logger.log('{} is larger than the size limit.'.format(pair.patch_name), LogLevel.debug)
+                return False
+
+            if entry.get('segments') is not None:
+                for item in entry['segments']:
+                    path = os.path.join(target_dir, item['patch'])
+                    if not os.path.isfile(path) or os.path.getsize(path) != item['size'] or \
+                            FileHasher().crc32(path) != item['crc32']:
+                        self.logger.log('Segment {} is missing or damaged.'.format(item['patch']), LogLevel.debug)
+                        return False
+                if not os.path.isfile(patch_path + self.SEGMENT_MANIFEST_SUFFIX):
+                    self.logger.log('The segment list of {} is missing.'.format(pair.patch_name), LogLevel.debug)
+                    return False
+                return True
+
+            if not os.path.isfile(patch_path) or os.path.getsize(patch_path) != entry.get('size') or \
+                    FileHasher().crc32(patch_path) != entry.get('crc32'):
+                self.logger.log('{} is missing or damaged.'.format(pair.patch_name), LogLevel.debug)
+                return False
+        except (OSError, IOError):
+            return False
+
+        return True
+
+    def write_checksums(self, file_pairs, target_dir):
+        """ Writes the digests of the old and new files and of the shipped patches and new files into the checksum
+            file. Files that were already read during the run are not read again.
+        """
+        files = {}
+        for pair in file_pairs:
+            files[('old', pair.source.relpath)] = pair.source.filename
+            files[('new', pair.target.relpath)] = pair.target.filename
+            for name in self.get_shipped_files(pair):
+                if os.path.isfile(os.path.join(target_dir, name)):
+                    files[('patches', name)] = os.path.join(target_dir, name)
+
+        items = list(files.items())
+        hasher = self.create_hasher()
+
+        def get_digests(item):
+            try:
+                return hasher.digests(item[1], self.CHECKSUM_ALGORITHMS), os.path.getsize(item[1])
+            except (OSError, IOError) as e:
+                self.logger.log('Hashing {} failed, leaving it out of the checksum file: {}'.format(
+                    item[1], e.strerror), LogLevel.warning)
+                return None
+
+        results = self.get_io_scheduler().run(get_digests, items, lambda item: [item[1]])
+        self.metrics.add_bytes('checksums', read=hasher.bytes_read)
+
+        checksums = {
+            'generator': '{} {}'.format(self.PROG_NAME, self.PROG_VERSION),
+            'algorithms': list(self.CHECKSUM_ALGORITHMS),
+            'old': {},
+            'new': {},
+            'patches': {}
+        }
+        for ((section, name), path), result in zip(items, results):
+            if result is not None:
+                checksums[section][name] = dict(result[0], size=result[1])
+
+        path = os.path.join(target_dir, self.CHECKSUM_FILENAME)
+        with open(path, 'w', encoding='utf-8') as fh:
+            json.dump(checksums, fh, indent=2, ensure_ascii=False)
+        self.metrics.add_bytes('checksums', written=os.path.getsize(path))
+        self.logger.log('Wrote the checksums of {} files to {}.'.format(
+            str(len(items)), self.CHECKSUM_FILENAME), LogLevel.notice)
 
     def generate_win_script(self, file_pairs, target_dir):
         self.switch_languages(self.script_options['script_lang'])
@@ -336,264 +2016,735 @@ class BatchPatch:
         fh.write('set nnum=0\n')
         fh.write('set fnum=0\n\n')
 
-        fh.write('IF NOT EXIST "{}" (\n'.format(os.path.basename(self.xdelta_location)))
-        fh.write('  echo {msg}\n'.format(
-            msg=_('The xdelta executable was not found! It is required for this script to work!'))
-        )
-        fh.write('  pause\n')
-        fh.write('  exit /b 1\n')
-        fh.write(')\n\n')
+        for backend in self.get_used_backends(file_pairs):
+            for executable in backend.get_executables():
+                fh.write('IF NOT EXIST "{}" (\n'.format(os.path.basename(executable)))
+                if backend.name == 'xdelta3':
+                    msg = self._('The xdelta executable was not found! It is required for this script to work!')
+                else:
+                    msg = self._('{exe} was not found! It is required for this script to work!').format(
+                        exe=self.cmd_escape(os.path.basename(executable)))
+                fh.write('  echo {msg}\n'.format(msg=msg))
+                fh.write('  pause\n')
+                fh.write('  exit /b 1\n')
+                fh.write(')\n\n')
+
+        segmented = any(pair.segments is not None for pair in file_pairs)
+        if segmented:
+            # The segments of the old files are cut out with PowerShell, since cmd has no way to do it.
+            fh.write('where powershell > NUL 2> NUL || (\n')
+            fh.write('  echo {msg}\n'.format(
+                msg=self._('{exe} was not found! It is required for this script to work!').format(exe='PowerShell')))
+            fh.write('  pause\n')
+            fh.write('  exit /b 1\n')
+            fh.write(')\n\n')
+
+        compact = self.script_options['compact']
+        if compact:
+            self.write_script_list(file_pairs, target_dir)
+            fh.write(self.get_compact_script_loop())
+        else:
+            for group in self.group_script_pairs(file_pairs):
+                if len(group) == 1:
+                    fh.write(self.get_script_block(group[0]))
+                else:
+                    fh.write(self.get_script_chain(group))
 
-        for pair in file_pairs:
-            if pair[4]:
-                fh.write(
-                    (
-                        'IF EXIST "{old}" (\n' +
-                        '  IF NOT EXIST "{new}" (\n' +
-                        '    echo {msg}\n'.format(msg=_('Patching {old_esc}...')) +
-                        '    set /a pnum+=1\n' +
-                        '    "{xdelta}" -d -v -s "{old}" "{patch}" "{new}" || (\n' +
-                        '      echo {msg}\n'.format(msg=_('Patching {old_esc} failed!')) +
-                        '      set /a pnum-=1\n' +
-                        '      set /a fnum+=1\n' +
-                        '    )\n' +
-                        '  ) ELSE (\n' +
-                        '    echo {msg}\n'.format(msg=_('{new_esc} already exists, skipping...')) +
-                        '    set /a nnum+=1\n' +
-                        '  )\n' +
-                        ') ELSE (\n' +
-                        '  echo {msg}\n'.format(msg=_('{old_esc} not present in folder, skipping...')) +
-                        '  set /a nnum+=1\n' +
-                        ')\n'
-                    ).format(
-                        old=os.path.basename(pair[0]),
-                        new=os.path.basename(pair[1]),
-                        patch=os.path.basename(pair[2]),
-                        old_esc=self.cmd_escape(os.path.basename(pair[0])),
-                        new_esc=self.cmd_escape(os.path.basename(pair[1])),
-                        xdelta=os.path.basename(self.xdelta_location)
-                    )
-                )
-            else:
-                fh.write(
-                    (
-                        'IF EXIST "{old}" (\n' +
-                        '  IF NOT EXIST "{new}" (\n' +
-                        '    echo {msg}\n'.format(msg=_('Patching {old_esc}...')) +
-                        '    set /a pnum+=1\n' +
-                        '    REM xdelta unicode incompatibility workaround\n' +
-                        '    copy "{old}" "{intermediate_old}" > NUL\n' +
-                        '    "{xdelta}" -d -v -s "{intermediate_old}" "{patch}" "{intermediate_new}" || (\n' +
-                        '      echo {msg}\n'.format(msg=_('Patching {old_esc} failed!')) +
-                        '      set /a pnum-=1\n' +
-                        '      set /a fnum+=1\n' +
-                        '    )\n' +
-                        '    REM xdelta unicode incompatibility workaround\n' +
-                        '    move "{intermediate_new}" "{new}" > NUL\n' +
-                        '    del "{intermediate_old}" > NUL\n' +
-                        '  ) ELSE (\n' +
-                        '    echo {msg}\n'.format(msg=_('{new_esc} already exists, skipping...')) +
-                        '    set /a nnum+=1\n' +
-                        '  )\n' +
-                        ') ELSE (\n' +
-                        '  echo {msg}\n'.format(msg=_('{old_esc} not present in folder, skipping...')) +
-                        '  set /a nnum+=1\n' +
-                        ')\n'
-                    ).format(
-                        old=os.path.basename(pair[0]),
-                        new=os.path.basename(pair[1]),
-                        intermediate_old=('~' + os.path.basename(pair[2]) + '.src'),
-                        intermediate_new=('~' + os.path.basename(pair[2]) + '.dst'),
-                        patch=os.path.basename(pair[2]),
-                        old_esc=self.cmd_escape(os.path.basename(pair[0])),
-                        new_esc=self.cmd_escape(os.path.basename(pair[1])),
-                        xdelta=os.path.basename(self.xdelta_location)
-                    )
-                )
-
-        fh.write('echo {msg}\n'.format(msg=_('Finished, with %pnum% files patched, %nnum% skipped and %fnum% failed.')))
+        fh.write('echo {msg}\n'.format(
+            msg=self._('Finished, with %pnum% files patched, %nnum% skipped and %fnum% failed.')))
         fh.write('pause\n')
         fh.write('chcp %cp% > NUL\n')
+        if compact:
+            fh.write(self.get_compact_script_routines(file_pairs))
+        if segmented:
+            if not compact:
+                fh.write('goto :eof\n')
+            fh.write(self.get_script_segment_routines(file_pairs))
         fh.close()
 
+        written = os.path.getsize(os.path.join(target_dir, self.script_options['script_name'] + '.cmd'))
+        if compact:
+            written += os.path.getsize(os.path.join(target_dir, self.script_options['script_name'] + '.lst'))
+        self.metrics.add_bytes('script_generation', written=written)
+
         self.switch_languages('en_US')
 
-    def copy_executable(self, target_dir):
-        self.logger.log('Copying xdelta to the target folder {}.'.format(target_dir), LogLevel.debug)
-        shutil.copy(os.path.join(os.getcwd(), self.xdelta_location),
-                    os.path.join(target_dir, os.path.basename(self.xdelta_location)))
+    @staticmethod
+    def group_script_pairs(file_pairs):
+        """ Groups the pairs by their target file, newest source first. """
+        groups = {}
+        for pair in file_pairs:
+            groups.setdefault(pair.target.relpath, []).append(pair)
+
+        return [sorted(group, key=lambda item: item.source.ver, reverse=True) for group in groups.values()]
+
+    def get_script_names(self, pair):
+        names = {
+            'old': self.to_win_path(pair.source.relpath),
+            'new': self.to_win_path(pair.target.relpath),
+            'intermediate_old': pair.get_temp_name('.src'),
+            'intermediate_new': pair.get_temp_name('.dst'),
+            'patch': self.to_win_path(pair.patch_name),
+            'old_esc': self.cmd_escape(self.to_win_path(pair.source.relpath)),
+            'new_esc': self.cmd_escape(self.to_win_path(pair.target.relpath))
+        }
+
+        if pair.full_file is not None:
+            names['decode'] = 'copy "{}" "{}" > NUL'.format(self.to_win_path(pair.full_file), names['new'])
+        elif pair.segments is not None:
+            names['decode'] = 'call :{}'.format(self.get_segment_label(pair))
+        elif pair.windows_safe:
+            names['decode'] = pair.backend.get_script_decode_command(names['old'], names['patch'], names['new'])
+        else:
+            names['decode'] = pair.backend.get_script_decode_command(
+                names['intermediate_old'], names['patch'], names['intermediate_new'])
+
+        return names
+
+    def get_script_patch_commands(self, pair, indent):
+        """ The commands applying the patch of a single pair, assuming the old file exists and the new one doesn't. """
+        # copy has no trouble with any filename, so the new files shipped as they are don't need the workaround. Nor
+        # do segmented pairs, whose old file is cut into segments under temporary names anyway.
+        if pair.windows_safe or pair.full_file is not None or pair.segments is not None:
+            template = (
+                '{i}echo {msg}\n'.format(i=indent, msg=self._('Patching {old_esc}...')) +
+                '{i}set /a pnum+=1\n' +
+                '{i}{decode} || (\n' +
+                '{i}  echo {msg}\n'.format(i=indent, msg=self._('Patching {old_esc} failed!')) +
+                '{i}  set /a pnum-=1\n' +
+                '{i}  set /a fnum+=1\n' +
+                '{i})\n'
+            )
+        else:
+            template = (
+                '{i}echo {msg}\n'.format(i=indent, msg=self._('Patching {old_esc}...')) +
+                '{i}set /a pnum+=1\n' +
+                '{i}REM xdelta unicode incompatibility workaround\n' +
+                '{i}copy "{old}" "{intermediate_old}" > NUL\n' +
+                '{i}{decode} || (\n' +
+                '{i}  echo {msg}\n'.format(i=indent, msg=self._('Patching {old_esc} failed!')) +
+                '{i}  set /a pnum-=1\n' +
+                '{i}  set /a fnum+=1\n' +
+                '{i})\n' +
+                '{i}REM xdelta unicode incompatibility workaround\n' +
+                '{i}move "{intermediate_new}" "{new}" > NUL\n' +
+                '{i}del "{intermediate_old}" > NUL\n'
+            )
+
+        return template.format(i=indent, **self.get_script_names(pair))
+
+    def get_script_block(self, pair):
+        """ The script section for a target file that can only be created from a single old file. """
+        names = self.get_script_names(pair)
+        return (
+            'IF EXIST "{old}" (\n' +
+            '  IF NOT EXIST "{new}" (\n'
+        ).format(**names) + self.get_script_patch_commands(pair, '    ') + (
+            '  ) ELSE (\n' +
+            '    echo {msg}\n'.format(msg=self._('{new_esc} already exists, skipping...')) +
+            '    set /a nnum+=1\n' +
+            '  )\n' +
+            ') ELSE (\n' +
+            '  echo {msg}\n'.format(msg=self._('{old_esc} not present in folder, skipping...')) +
+            '  set /a nnum+=1\n' +
+            ')\n'
+        ).format(**names)
+
+    def get_script_chain(self, group):
+        """ The script section for a target file that has patches from several old versions. The patch for the
+            newest old file present is applied.
+        """
+        names = self.get_script_names(group[0])
+        block = (
+            'IF EXIST "{new}" (\n' +
+            '  echo {msg}\n'.format(msg=self._('{new_esc} already exists, skipping...')) +
+            '  set /a nnum+=1\n'
+        ).format(**names)
+
+        for pair in group:
+            block += ') ELSE IF EXIST "{old}" (\n'.format(**self.get_script_names(pair))
+            block += self.get_script_patch_commands(pair, '  ')
+
+        return block + (
+            ') ELSE (\n' +
+            '  echo {msg}\n'.format(msg=self._('No old version of {new_esc} present in folder, skipping...')) +
+            '  set /a nnum+=1\n' +
+            ')\n'
+        ).format(**names)
+
+    def write_script_list(self, file_pairs, target_dir):
+        """ Writes the list of patches the compact script loops over, one line per old file. The lines of each new
+            file follow each other, newest old file first. None of the fields can be empty, since for /f would merge
+            the delimiters around it.
+        """
+        with open(os.path.join(target_dir, self.script_options['script_name'] + '.lst'),
+                  mode='w', newline='\r\n', encoding='utf-8') as fh:
+            for group in self.group_script_pairs(file_pairs):
+                for pair in group:
+                    names = self.get_script_names(pair)
+                    full = pair.full_file is not None
+                    segmented = pair.segments is not None
+                    if full:
+                        kind, patch = 'full', self.to_win_path(pair.full_file)
+                    elif segmented:
+                        kind, patch = 'segments', self.get_segment_label(pair)
+                    else:
+                        kind, patch = pair.backend.name, names['patch']
+                    fh.write('|'.join([
+                        kind,
+                        '1' if pair.windows_safe or full or segmented else '0',
+                        names['old'],
+                        names['new'],
+                        patch,
+                        names['intermediate_old'],
+                        names['intermediate_new'],
+                        # Shown outside of quotes, where & would otherwise split the command.
+                        names['old_esc'].replace('&', '^&'),
+                        names['new_esc'].replace('&', '^&')
+                    ]) + '\n')
+
+    def get_compact_script_loop(self):
+        """ The part of the compact script that reads the list. The fields are copied into variables before calling
+            the routine, since passing them as arguments would double the carets and expand percent signs in them.
+        """
+        return (
+            'set "cur="\n' +
+            'for /f "usebackq eol=| tokens=1-9 delims=|" %%a in ("{}.lst") do (\n'.format(
+                self.script_options['script_name']) +
+            '  set "backend=%%a"\n' +
+            '  set "safe=%%b"\n' +
+            '  set "old=%%c"\n' +
+            '  set "new=%%d"\n' +
+            '  set "patch=%%e"\n' +
+            '  set "intermediate_old=%%f"\n' +
+            '  set "intermediate_new=%%g"\n' +
+            '  set "old_esc=%%h"\n' +
+            '  set "new_esc=%%i"\n' +
+            '  call :pair\n' +
+            ')\n' +
+            'call :finish_target\n\n'
+        )
 
-    def create_archive(self, file_pairs, target_dir):
+    def get_compact_script_routines(self, file_pairs):
+        """ The routines of the compact script. They are written without parenthesized blocks, since variables in a
+            block are expanded before any of its commands run. Only the first old file present of each new file is
+            patched, like in the full script.
+        """
+        decode_lines = ''
+        for backend in self.get_used_backends(file_pairs):
+            decode_lines += 'IF "%backend%"=="{}" {} && set ok=1\n'.format(
+                backend.name, backend.get_script_decode_command('%src%', '%patch%', '%dst%'))
+        if any(pair.full_file is not None for pair in file_pairs):
+            decode_lines += 'IF "%backend%"=="full" copy "%patch%" "%dst%" > NUL && set ok=1\n'
+        if any(pair.segments is not None for pair in file_pairs):
+            decode_lines += 'IF "%backend%"=="segments" call :%patch% && set ok=1\n'
+
+        return (
+            'goto :eof\n\n' +
+            ':pair\n' +
+            'IF "%new%"=="%cur%" goto pair_candidate\n' +
+            'call :finish_target\n' +
+            'set "cur=%new%"\n' +
+            'set "cur_esc=%new_esc%"\n' +
+            'set candidates=0\n' +
+            'set done=0\n' +
+            'IF NOT EXIST "%new%" goto pair_candidate\n' +
+            'echo {}\n'.format(self._('{new_esc} already exists, skipping...').format(new_esc='%new_esc%')) +
+            'set /a nnum+=1\n' +
+            'set done=1\n' +
+            ':pair_candidate\n' +
+            'set /a candidates+=1\n' +
+            'set "last_old_esc=%old_esc%"\n' +
+            'IF "%done%"=="1" goto :eof\n' +
+            'IF NOT EXIST "%old%" goto :eof\n' +
+            'set done=1\n' +
+            'echo {}\n'.format(self._('Patching {old_esc}...').format(old_esc='%old_esc%')) +
+            'set /a pnum+=1\n' +
+            'set "src=%old%"\n' +
+            'set "dst=%new%"\n' +
+            'IF "%safe%"=="1" goto pair_decode\n' +
+            'REM xdelta unicode incompatibility workaround\n' +
+            'copy "%old%" "%intermediate_old%" > NUL\n' +
+            'set "src=%intermediate_old%"\n' +
+            'set "dst=%intermediate_new%"\n' +
+            ':pair_decode\n' +
+            'set ok=0\n' +
+            decode_lines +
+            'IF "%ok%"=="1" goto pair_decoded\n' +
+            'echo {}\n'.format(self._('Patching {old_esc} failed!').format(old_esc='%old_esc%')) +
+            'set /a pnum-=1\n' +
+            'set /a fnum+=1\n' +
+            ':pair_decoded\n' +
+            'IF "%safe%"=="1" goto :eof\n' +
+            'REM xdelta unicode incompatibility workaround\n' +
+            'move "%intermediate_new%" "%new%" > NUL\n' +
+            'del "%intermediate_old%" > NUL\n' +
+            'goto :eof\n\n' +
+            ':finish_target\n' +
+            'IF "%cur%"=="" goto :eof\n' +
+            'IF "%done%"=="1" goto :eof\n' +
+            'IF "%candidates%"=="1" echo {}\n'.format(
+                self._('{old_esc} not present in folder, skipping...').format(old_esc='%last_old_esc%')) +
+            'IF NOT "%candidates%"=="1" echo {}\n'.format(
+                self._('No old version of {new_esc} present in folder, skipping...').format(new_esc='%cur_esc%')) +
+            'set /a nnum+=1\n' +
+            'goto :eof\n'
+        )
+
+    @staticmethod
+    def get_segment_label(pair):
+        """ The name of the script routine that applies the segments of a pair. Pairs sharing a patch get routines of
+            their own, since the routines contain the names of the files.
+        """
+        return 'segments_{:08x}'.format(zlib.crc32((pair.source.relpath + '|' + pair.target.relpath).encode()))
+
+    def get_script_segment_routines(self, file_pairs):
+        """ The routines that apply the segmented patches. Each segment of the old file is cut into a temporary file,
+            and the output of the decoder is appended to the new file, so the segments never have to be joined. The
+            new file is deleted if any segment fails.
+        """
+        routines = ''
+        for pair in file_pairs:
+            if pair.segments is None:
+                continue
+
+            names = self.get_script_names(pair)
+            label = self.get_segment_label(pair)
+            temp = pair.get_temp_name('.seg')
+            routines += (
+                '\n:{label}\n' +
+                'set "cut_source={old}"\n' +
+                'set "cut_target={temp}"\n'
+            ).format(label=label, temp=temp, **names)
+            for segment in pair.segments:
+                routines += (
+                    'set cut_offset={offset}\n' +
+                    'set cut_length={length}\n' +
+                    'call :cut || goto {label}_failed\n' +
+                    '{segment_decode} >> "{new}" || goto {label}_failed\n'
+                ).format(offset=segment.source_offset, length=segment.source_length, label=label,
+                         segment_decode=pair.backend.get_script_stream_decode_command(
+                             temp, self.to_win_path(segment.patch_name)), **names)
+            routines += (
+                'del "{temp}" > NUL\n' +
+                'exit /b 0\n' +
+                ':{label}_failed\n' +
+                'IF EXIST "{temp}" del "{temp}" > NUL\n' +
+                'IF EXIST "{new}" del "{new}" > NUL\n' +
+                'exit /b 1\n'
+            ).format(label=label, temp=temp, **names)
+
+        # The file names are passed in variables, so that they don't need to be quoted for PowerShell.
+        return routines + (
+            '\n:cut\n' +
+            'powershell -NoProfile -NonInteractive -Command "$ErrorActionPreference=\'Stop\'; try { ' +
+            '$i=[IO.File]::OpenRead($env:cut_source); $o=[IO.File]::Create($env:cut_target); ' +
+            '$b=New-Object byte[] 4194304; $n=[int64]$env:cut_length; [void]$i.Seek([int64]$env:cut_offset, 0); ' +
+            'while ($n -gt 0) { $r=$i.Read($b, 0, [Math]::Min($n, $b.Length)); if ($r -le 0) { break }; ' +
+            '$o.Write($b, 0, $r); $n-=$r }; $o.Close(); $i.Close(); if ($n -gt 0) { exit 1 } } catch { exit 1 }" ' +
+            '|| exit /b 1\n' +
+            'exit /b 0\n'
+        )
+
+    def generate_runner(self, file_pairs, target_dir):
+        """ Writes the Python apply runner into the target folder, along with the list of patches it should apply.
+            The list is made of the same groups of pairs as the Windows script.
+        """
+        self.logger.log('Generating the Python apply runner.', LogLevel.debug)
+        groups = self.group_script_pairs(file_pairs)
+        hasher = self.create_hasher()
+
+        def get_crc(file):
+            # Calculated even if the filename has a CRC, as it would be a shame to reject every patched file because
+            # of a typo in a filename.
+            try:
+                return hasher.crc32(file.filename)
+            except (OSError, IOError) as e:
+                self.logger.log('Calculating the CRC of {} failed, the runner won\'t verify it: {}'.format(
+                    file.filename, e.strerror), LogLevel.warning)
+                return None
+
+        crcs = self.get_io_scheduler().run(get_crc, [group[0].target for group in groups], lambda file: [file.filename])
+        self.metrics.add_bytes('runner_generation', read=hasher.bytes_read)
+
+        plan = {
+            'format': PatchRunner.FORMAT_VERSION,
+            'generator': '{} {}'.format(self.PROG_NAME, self.PROG_VERSION),
+            'backends': {backend.name: backend.get_runner_decoder() for backend in self.get_used_backends(file_pairs)},
+            'targets': [{
+                'new': group[0].target.relpath,
+                'crc32': crc,
+                'candidates': [{
+                    'old': pair.source.relpath,
+                    'patch': pair.patch_name if pair.full_file is None and pair.segments is None else None,
+                    'full': pair.full_file,
+                    'segments': [segment.to_dict() for segment in pair.segments] if pair.segments is not None
+                    else None,
+                    'backend': pair.backend.name,
+                    'windows_safe': pair.windows_safe or pair.full_file is not None or pair.segments is not None,
+                    'temp_old': pair.get_own_temp_name('.src'),
+                    'temp_new': pair.get_own_temp_name('.dst'),
+                    'temp_segment': pair.get_own_temp_name('.seg') if pair.segments is not None else None
+                } for pair in group]
+            } for group, crc in zip(groups, crcs)]
+        }
+
+        base_path = os.path.join(target_dir, self.script_options['script_name'])
+        with open(base_path + '.json', 'w', encoding='utf-8') as fh:
+            json.dump(plan, fh, indent=2, ensure_ascii=False)
+        shutil.copy(os.path.join(BatchPatch.get_install_path(), 'applier.py'), base_path + '.py')
+        self.metrics.add_bytes('runner_generation',
+                               written=os.path.getsize(base_path + '.json') + os.path.getsize(base_path + '.py'))
+
+    def copy_executables(self, file_pairs, target_dir):
+        for backend in self.get_used_backends(file_pairs):
+            for executable in backend.get_executables():
+                self.logger.log('Copying {} to the target folder {}.'.format(os.path.basename(executable), target_dir),
+                                LogLevel.debug)
+                # The modification time is kept, so that an archive being extended sees the copy as unchanged.
+                shutil.copy2(os.path.join(os.getcwd(), executable),
+                             os.path.join(target_dir, os.path.basename(executable)))
+
+    def open_archive(self, target_dir):
+        """ Starts the ZIP archive before the patches are created, so that each patch can be added to it as soon as
+            it is done.
+        """
         zip_path = os.path.join(target_dir, self.archive_options['zip_name'])
         self.logger.log('Creating a ZIP archive of the patch to \'{}\'.'.format(zip_path), LogLevel.debug)
-        zipped = zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED)
+        if self.watch_options['enabled']:
+            # Each pass only adds the new patches and writes the scripts again, instead of the whole archive.
+            self.archive = PatchArchive(zip_path, target_dir, self.get_script_files())
+        else:
+            self.archive = PatchArchive(zip_path)
+
+    def get_script_files(self):
+        """ The files written into the target folder after the patches, which change whenever a pair is added. """
+        names = [self.script_options['script_name'] + '.cmd']
+        if self.script_options['compact']:
+            names.append(self.script_options['script_name'] + '.lst')
+        if self.script_options['runner']:
+            names += [self.script_options['script_name'] + '.py', self.script_options['script_name'] + '.json']
+        if self.patch_options['checksums']:
+            names.append(self.CHECKSUM_FILENAME)
+        return names
+
+    def add_to_archive(self, target_dir, name):
+        if self.archive is None:
+            return
+
+        compress_type = self.archive.add(os.path.join(target_dir, name), name)
+        if compress_type is not None:
+            self.logger.log('Wrote {} to the archive ({}).'.format(
+                name, 'stored' if compress_type == zipfile.ZIP_STORED else 'deflated'), LogLevel.debug)
+
+    def close_archive(self):
+        """ Finishes the archive with the files added so far, if the run stopped before it was written in full. """
+        if self.archive is None:
+            return
+
+        self.archive.close()
+        self.archive = None
+
+    def create_archive(self, file_pairs, target_dir):
+        if self.archive is None:
+            self.open_archive(target_dir)
 
         for pair in file_pairs:
-            self.logger.log('Writing: {}...'.format(pair[2]), LogLevel.debug)
-            zipped.write(os.path.join(target_dir, pair[2]), pair[2])
+            for name in self.get_shipped_files(pair):
+                if not self.archive.contains(name) and os.path.isfile(os.path.join(target_dir, name)):
+                    self.add_to_archive(target_dir, name)
 
-        self.logger.log('Writing the patch script...', LogLevel.debug)
-        zipped.write(os.path.join(target_dir, self.script_options['script_name'] + '.cmd'),
-                     self.script_options['script_name'] + '.cmd')
+        self.logger.log('Writing the executables...', LogLevel.debug)
+        for backend in self.get_used_backends(file_pairs):
+            for executable in backend.get_executables():
+                self.add_to_archive(target_dir, os.path.basename(executable))
 
-        self.logger.log('Writing the executable...', LogLevel.debug)
-        zipped.write(os.path.join(target_dir, os.path.basename(self.xdelta_location)),
-                     os.path.basename(self.xdelta_location))
-        zipped.close()
+        # The scripts go last, so that an archive extended in watch mode only has to write them again.
+        self.logger.log('Writing the patch script...', LogLevel.debug)
+        for name in self.get_script_files():
+            self.add_to_archive(target_dir, name)
+        self.archive.close()
+        self.metrics.add_bytes('archiving', written=os.path.getsize(self.archive.path))
+        self.archive = None
 
     def identify_file_pairs_by_name(self, old_dir, new_dir):
         self.logger.log('Identifying potential file pairs for patching.', LogLevel.debug)
 
-        old_files = os.listdir(str(old_dir))
-        new_files = os.listdir(str(new_dir))
+        debug = self.logger.is_enabled(LogLevel.debug)
+        all_versions = self.patch_options['all_versions']
+        scanner = DirectoryScanner(self.patch_options['recursive'])
+        # For each key, the highest versions of the source and the target found so far, and the first source found of
+        # each version.
         filemap = {}
 
-        for file in [self.create_file_entity(f, old_dir) for f in old_files]:
-            if file is not None:
-                self.logger.log('Found potential source file: {}'.format(file['filename']), LogLevel.debug)
-                self.logger.log('  Group {}, series {}, type {} {}, episode {}, version {}'.format(
-                    file['group'],
-                    file['name'],
-                    file['specifier'],
-                    file['ext'],
-                    file['ep'],
-                    file['ver']
-                ), LogLevel.debug)
-
-                key = file.get('key')
-                if key in filemap:
-                    filemap[key][0].append(file)
-                else:
-                    filemap[key] = ([file], [])
-
-        for file in [self.create_file_entity(f, new_dir) for f in new_files]:
-            if file is not None:
-                key = file.get('key')
-                if key in filemap:
-                    self.logger.log('Found potential target file: {}'.format(file['filename']), LogLevel.debug)
-                    self.logger.log('  Group {}, series {}, type {} {}, episode {}, version {}'.format(
-                        file['group'],
-                        file['name'],
-                        file['specifier'],
-                        file['ext'],
-                        file['ep'],
-                        file['ver']
-                    ), LogLevel.debug)
-
-                    filemap[key][1].append(file)
-                else:
-                    # There were no matching files in the old directory, so this won't be a candidate for patching.
-                    self.logger.log('Ignoring target file with no equivalent source: {}'.format(file['filename']),
-                                    LogLevel.debug)
+        for entry, relpath in scanner.scan(old_dir):
+            file = self.create_file_entity(relpath, old_dir, entry)
+            if file is None:
+                continue
+
+            if debug:
+                self.log_file_entity('Found potential source file', file)
 
-        # Let's prune those source files that were found that have no target equivalents.
-        item_cnt = len(filemap)
-        filemap = {k: v for (k, v) in filemap.items() if len(v[1]) >= 1}
+            group = filemap.get(file.key)
+            if group is None:
+                filemap[file.key] = [file, None, {file.ver: file}]
+                continue
 
-        if len(filemap) < item_cnt:
-            diff = item_cnt - len(filemap)
+            if file.ver > group[0].ver:
+                group[0] = file
+            if all_versions:
+                group[2].setdefault(file.ver, file)
 
-            self.logger.log('Dropped {} source candidate{} with no equivalent targets.'.format(
-                str(diff), '' if diff == 1 else 's'), LogLevel.debug)
+        for entry, relpath in scanner.scan(new_dir):
+            file = self.create_file_entity(relpath, new_dir, entry)
+            if file is None:
+                continue
+
+            group = filemap.get(file.key)
+            if group is None:
+                # There were no matching files in the old directory, so this won't be a candidate for patching.
+                self.logger.log('Ignoring target file with no equivalent source: {}', LogLevel.debug, file.filename)
+                continue
+
+            if debug:
+                self.log_file_entity('Found potential target file', file)
+
+            if group[1] is None or file.ver > group[1].ver:
+                group[1] = file
 
         resolved_relations = []
-        for key, group in filemap.items():
-            highest_source = max(group[0], key=lambda x: x['ver'])
-            highest_target = max(group[1], key=lambda x: x['ver'])
-
-            if highest_source['ver'] == highest_target['ver']:
-                self.logger.log('Source and target versions of {} are both {}, ignoring the group.'.format(
-                    key, highest_target['ver']
-                ), LogLevel.debug)
+        dropped = 0
+        for key, (highest_source, highest_target, sources) in filemap.items():
+            if highest_target is None:
+                # Source files that have no target equivalents are pruned.
+                dropped += 1
+                continue
+
+            if highest_source.ver == highest_target.ver:
+                self.logger.log('Source and target versions of {} are both {}, ignoring the group.', LogLevel.debug,
+                                key, highest_target.ver)
                 continue
 
-            patch_name = self.get_patch_name(highest_source, highest_target)
-            # TODO: refactor, these are too complex and confusing to be tuples anymore
-            resolved_relations.append((highest_source['filename'], highest_target['filename'], patch_name,
-                                       highest_target['key'],
-                                       self.is_name_windows_safe(os.path.basename(highest_source['filename'])) and
-                                       self.is_name_windows_safe(os.path.basename(highest_target['filename'])),
-                                       highest_source,
-                                       highest_target))
-            self.logger.log('Queued: {} -> {}, patch name: {}'.format(
-                highest_source['filename'], highest_target['filename'], patch_name
-            ), LogLevel.debug)
+            # The newest source comes first, as its patch is the one the script should prefer.
+            group_sources = [highest_source]
+            if all_versions:
+                group_sources += [sources[ver] for ver in sorted(sources, reverse=True)
+                                  if ver < highest_target.ver and sources[ver] is not highest_source]
+
+            for source in group_sources:
+                backend = self.get_default_backend()
+                patch_name = self.get_patch_name(source, highest_target, backend)
+                resolved_relations.append(FilePair(
+                    source, highest_target, patch_name, highest_target.key,
+                    self.is_name_windows_safe(os.path.basename(source.filename)) and
+                    self.is_name_windows_safe(os.path.basename(highest_target.filename)),
+                    backend
+                ))
+                self.logger.log('Queued: {} -> {}, patch name: {}', LogLevel.debug,
+                                source.filename, highest_target.filename, patch_name)
+
+        if dropped > 0:
+            self.logger.log('Dropped {} source candidate{} with no equivalent targets.', LogLevel.debug,
+                            dropped, '' if dropped == 1 else 's')
 
         return resolved_relations
 
+    def identify_file_pairs_by_content(self, old_dir, new_dir, file_pairs):
+        """ Pairs the files that were left without a pair by their names, by comparing sketches of their contents.
+            Only a few samples of each file are read. Each file is paired at most once, the most similar pairs first.
+            Returns the new pairs.
+        """
+        scanner = DirectoryScanner(self.patch_options['recursive'])
+        old_files = [(old_dir, relpath, entry, self.create_file_entity(relpath, old_dir, entry))
+                     for entry, relpath in scanner.scan(old_dir)]
+        new_files = [(new_dir, relpath, entry, self.create_file_entity(relpath, new_dir, entry))
+                     for entry, relpath in scanner.scan(new_dir)]
+
+        # Files of a group found on both sides already had their chance to be paired by name.
+        paired_keys = set(file.key for _, _, _, file in old_files if file is not None) & \
+            set(file.key for _, _, _, file in new_files if file is not None)
+        old_files = [item for item in old_files if item[3] is None or item[3].key not in paired_keys]
+        new_files = [item for item in new_files if item[3] is None or item[3].key not in paired_keys]
+        if len(old_files) == 0 or len(new_files) == 0:
+            return []
+
+        self.logger.log('Comparing the contents of {} old and {} new files left without a pair.', LogLevel.notice,
+                        len(old_files), len(new_files))
+
+        def sketch(item):
+            base_dir, relpath, entry, _ = item
+            try:
+                size = entry.stat().st_size
+                return ContentSketch.create(os.path.join(base_dir, relpath), size) if size > 0 else None
+            except (OSError, IOError) as e:
+                self.logger.log('Reading {} failed, not pairing it by content: {}'.format(relpath, e.strerror),
+                                LogLevel.warning)
+                return None
+
+        scheduler = self.get_io_scheduler()
+        get_paths = lambda item: [os.path.join(item[0], item[1])]
+        old_sketches = scheduler.run(sketch, old_files, get_paths)
+        new_sketches = scheduler.run(sketch, new_files, get_paths)
+        self.metrics.add_bytes('content_pairing', read=sum(s.bytes_read for s in old_sketches + new_sketches
+                                                           if s is not None))
+
+        index = SimilarityIndex()
+        for item, old_sketch in zip(old_files, old_sketches):
+            if old_sketch is not None:
+                index.add(item, old_sketch)
+
+        candidates = []
+        for item, new_sketch in zip(new_files, new_sketches):
+            if new_sketch is not None:
+                candidates += [(similarity, old_item, item) for old_item, similarity in index.query(new_sketch)]
+
+        threshold = self.patch_options['match_threshold']
+        used_names = set(pair.patch_name for pair in file_pairs)
+        matched = set()
+        resolved_relations = []
+        for similarity, old_item, new_item in sorted(candidates, key=lambda item: item[0], reverse=True):
+            if old_item[1] in matched or new_item[1] in matched:
+                continue
+            if similarity < threshold:
+                self.logger.log('{} and {} are only {:.0%} similar, not pairing them.', LogLevel.debug,
+                                old_item[1], new_item[1], similarity)
+                continue
+
+            matched.update((old_item[1], new_item[1]))
+            source = old_item[3] or self.create_unnamed_file_entity(old_item[1], old_dir, 1, old_item[2])
+            target = new_item[3] or self.create_unnamed_file_entity(new_item[1], new_dir, source.ver + 1, new_item[2])
+            if target.ver <= source.ver:
+                # Unrelated names often parse as the same version, which would make the patch name read like a patch
+                # from a file to itself, e.g. name__v1v1.vcdiff.
+                target.ver = source.ver + 1
+
+            backend = self.get_default_backend()
+            patch_name = self.get_patch_name(source, target, backend)
+            base_name, dot, ext = patch_name.rpartition('.')
+            suffix = 1
+            while patch_name in used_names:
+                suffix += 1
+                patch_name = '{}_{}{}{}'.format(base_name, suffix, dot, ext)
+            used_names.add(patch_name)
+
+            pair = FilePair(source, target, patch_name, target.key,
+                            self.is_name_windows_safe(os.path.basename(source.filename)) and
+                            self.is_name_windows_safe(os.path.basename(target.filename)),
+                            backend)
+            pair.similarity = similarity
+            resolved_relations.append(pair)
+            self.logger.log('Paired by content: {} -> {} ({:.0%} similar), patch name: {}', LogLevel.notice,
+                            source.filename, target.filename, similarity, patch_name)
+
+        for _, relpath, _, _ in new_files:
+            if relpath not in matched:
+                self.logger.log('No old file is similar enough to {}.', LogLevel.debug, relpath)
+
+        return resolved_relations
+
+    def log_file_entity(self, msg, file):
+        self.logger.log('{}: {}', LogLevel.debug, msg, file.filename)
+        self.logger.log('  Group {}, series {}, type {} {}, episode {}, version {}', LogLevel.debug,
+                        file.group, file.name, file.specifier, file.ext, file.ep, file.ver)
+
     @staticmethod
     def cmd_escape(s):
         return re.sub(r'([\[\]\(\)^<>|])', r'^\1', s)
 
-    def get_patch_name(self, source, target):
+    @staticmethod
+    def to_win_path(path):
+        return path.replace('/', '\\')
+
+    def get_patch_name(self, source, target, backend):
         try:
-            return self.patch_options['filename_pattern'].format(
-                raw_group=source['group'],
-                raw_name=source['name'],
-                raw_ep=source['ep'],
-                raw_specifier=source['specifier'],
-                raw_ext=source['ext'],
-                group=BatchPatch.neutralize_str(source['group']),
-                name=BatchPatch.neutralize_str(source['name']),
-                ep=BatchPatch.neutralize_str(source['ep']),
-                specifier=BatchPatch.neutralize_str(source['specifier']),
+            patch_name = self.patch_options['filename_pattern'].format(
+                raw_group=source.group,
+                raw_name=source.name,
+                raw_ep=source.ep,
+                raw_specifier=source.specifier,
+                raw_ext=source.ext,
+                group=BatchPatch.neutralize_str(source.group),
+                name=BatchPatch.neutralize_str(source.name),
+                ep=BatchPatch.neutralize_str(source.ep),
+                specifier=BatchPatch.neutralize_str(source.specifier),
                 specifier_items=[BatchPatch.neutralize_str(s) for s in (
-                    source['specifier'].split() if len(source['specifier']) > 0 else ['']
+                    source.specifier.split() if len(source.specifier) > 0 else ['']
                 )],
-                type=BatchPatch.neutralize_str(source['specifier'] + source['ext']),
-                ext=BatchPatch.neutralize_str(source['ext']),
-                v_old=source['ver'],
-                v_new=target['ver'],
-                hash_old=source['crc'],
-                hash_new=target['crc']
+                type=BatchPatch.neutralize_str(source.specifier + source.ext),
+                ext=BatchPatch.neutralize_str(source.ext),
+                v_old=source.ver,
+                v_new=target.ver,
+                hash_old=source.crc,
+                hash_new=target.crc,
+                patch_ext=backend.patch_ext
             )
         except KeyError as e:
             self.logger.log('Invalid variable {} in patch name pattern!'.format(e.args[0]), LogLevel.error)
-            exit()
+            raise ConfigurationError('Invalid variable {} in patch name pattern!'.format(e.args[0]))
+
+        # Keep the directory structure of recursively scanned files
+        directory = source.relpath.rpartition('/')[0]
+        return directory + '/' + patch_name if directory != '' else patch_name
+
+    FILENAME_MATCHER = re.compile('(?#1. Group shortname)(?:\[([^\]]+?)\] )?'
+                                  '(?#2. Main name)(.+?)'
+                                  '(?#3. Episode specifier)(?: - ([a-zA-Z]*\d*))?'
+                                  '(?#4. Version specifier)(?:v(\d*))?'
+                                  '(?#5. Other specifiers)(?: \(([^\)]*)\))?'
+                                  '(?#6. CRC hash)(?: \[([0-9a-fA-F]{8})\])?'
+                                  '(?#   Eat all extension-looking parts except the last one)(?:\..+)?'
+                                  '\.'
+                                  '(?#   Do not match torrents)(?!torrent$)'
+                                  '(?#7. Get the file extension)([^\.]+)$')
 
     @staticmethod
-    def create_file_entity(filename, basedir):
-        matcher = re.compile('(?#1. Group shortname)(?:\[([^\]]+?)\] )?'
-                             '(?#2. Main name)(.+?)'
-                             '(?#3. Episode specifier)(?: - ([a-zA-Z]*\d*))?'
-                             '(?#4. Version specifier)(?:v(\d*))?'
-                             '(?#5. Other specifiers)(?: \(([^\)]*)\))?'
-                             '(?#6. CRC hash)(?: \[([0-9a-fA-F]{8})\])?'
-                             '(?#   Eat all extension-looking parts except the last one)(?:\..+)?'
-                             '\.'
-                             '(?#   Do not match torrents)(?!torrent$)'
-                             '(?#7. Get the file extension)([^\.]+)$')
-
-        match = matcher.match(filename)
+    def create_file_entity(filename, basedir, entry=None):
+        """ Parses a filename into a FileEntity, or returns None if it doesn't look like a release file. The filename
+            may be a path relative to basedir using forward slashes, in which case the directory becomes part of the
+            key so that only files in the same relative directory are paired.
+        """
+        directory, _, basename = filename.rpartition('/')
+        match = BatchPatch.FILENAME_MATCHER.match(basename)
         if match:
-            path = os.path.join(basedir, match.group(0))
-            ver = match.group(4)
+            group, name, ep, ver, specifier, crc, ext = match.groups()
             if ver is None:
                 ver = 1
-            specifier = match.group(5)
             if specifier is None:
                 specifier = ''
 
-            return {
-                "key": "/".join([match.group(x) for x in [1, 2, 3, 5, 7] if isinstance(match.group(x), str)]),
-                "ver": int(ver),
-                "group": match.group(1),
-                "name": match.group(2),
-                "ep": match.group(3),
-                "specifier": specifier,
-                "crc": match.group(6),
-                "ext": match.group(7),
-                "filename": path
-            }
+            key = "/".join([x for x in (group, name, ep, match.group(5), ext) if isinstance(x, str)])
+            if directory != '':
+                key = directory + '//' + key
+
+            return FileEntity(key, int(ver), group, name, ep, specifier, crc, ext,
+                              os.path.join(basedir, filename), filename, entry)
         else:
             return None
 
+    @staticmethod
+    def create_unnamed_file_entity(filename, basedir, ver, entry=None):
+        """ Creates a FileEntity for a file whose name the filename matcher doesn't recognize, so that it can be
+            paired by its contents. The whole name goes into the name field, and the relative path makes the key.
+        """
+        basename = filename.rpartition('/')[2]
+        name, dot, ext = basename.rpartition('.')
+        if dot == '':
+            name, ext = basename, ''
+
+        return FileEntity('?' + filename, ver, '', name, '', '', None, ext, os.path.join(basedir, filename), filename,
+                          entry)
+
     @staticmethod
     def get_default_output_folder():
         return os.path.join(os.getcwd(), 'batch-' + time.strftime('%Y-%m-%d-%H-%M'))
 
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def neutralize_str(name):
+        if name is None:
+            # Optional parts of the filename that weren't present.
+            return ''
+
         s = unicodedata.normalize('NFKD', name)
         s = u"".join([c for c in s if not unicodedata.combining(c)])
         return re.sub(r'[^a-z0-9_-]', '_', s.casefold())
@@ -617,7 +2768,5 @@ class BatchPatch:
 
 
 if __name__ == "__main__":
-    gettext.install('batchpatch', os.path.join(BatchPatch.get_install_path(), 'i18n'))
-
     prog = BatchPatch()
     prog.run()
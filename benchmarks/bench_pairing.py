@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Times identify_file_pairs_by_name on a synthetic tree of empty files named like fansub releases.
+
+    python benchmarks/bench_pairing.py --files 100000
+"""
+
+__author__ = 'Soulweaver'
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from batchpatch import BatchPatch
+from logger import LogLevel, Logger
+
+
+def create_tree(base_dir, file_count, seasons, seed):
+    """ Writes roughly file_count empty files split between the old and new folders. Most old files get a newer
+        version in the new folder, and some of the names are decoys that won't pair up.
+    """
+    rng = random.Random(seed)
+    specifiers = ['', ' (720p)', ' (1080p 10bit)', ' (BD 1080p FLAC)']
+    extensions = ['mkv', 'mkv', 'mkv', 'mp4', 'ass']
+    old_dir = os.path.join(base_dir, 'old')
+    new_dir = os.path.join(base_dir, 'new')
+
+    written = 0
+    series = 0
+    while written < file_count:
+        series += 1
+        season_dir = 'Season {}'.format(series % seasons + 1) if seasons > 1 else ''
+        for directory in (old_dir, new_dir):
+            os.makedirs(os.path.join(directory, season_dir), exist_ok=True)
+
+        for ep in range(1, 27):
+            specifier = rng.choice(specifiers)
+            ext = rng.choice(extensions)
+            crc = ' [{:08X}]'.format(rng.getrandbits(32))
+            name = '[Group{}] Series {} - {:02d}{{}}{}{}.{}'.format(series % 7, series, ep, specifier, crc, ext)
+
+            open(os.path.join(old_dir, season_dir, name.format('')), 'w').close()
+            written += 1
+            if rng.random() < 0.8:
+                open(os.path.join(new_dir, season_dir, name.format('v2')), 'w').close()
+                written += 1
+
+    return old_dir, new_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the file pairing of BatchPatch.')
+    parser.add_argument('--files', type=int, default=100000, help='The number of files to create. Default: 100000.')
+    parser.add_argument('--seasons', type=int, default=1,
+                        help='Spread the files into this many subfolders and scan recursively. Default: 1.')
+    parser.add_argument('--rounds', type=int, default=3, help='How many times to repeat the pairing. Default: 3.')
+    parser.add_argument('--seed', type=int, default=1, help='The random seed for the file names. Default: 1.')
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix='batchpatch-bench-')
+    try:
+        start = time.perf_counter()
+        old_dir, new_dir = create_tree(base_dir, args.files, args.seasons, args.seed)
+        print('Created {} files in {:.2f} s.'.format(args.files, time.perf_counter() - start))
+
+        prog = BatchPatch()
+        prog.logger = Logger(LogLevel.error)
+        prog.log_level = LogLevel.error
+        prog.patch_options['filename_pattern'] = '{name}{specifier_items[0]}_{ep}_v{v_old}v{v_new}.vcdiff'
+        prog.patch_options['recursive'] = args.seasons > 1
+
+        timings = []
+        pairs = []
+        for _ in range(args.rounds):
+            start = time.perf_counter()
+            pairs = prog.identify_file_pairs_by_name(old_dir, new_dir)
+            timings.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        prog.identify_file_pairs_by_name(old_dir, new_dir)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print('Found {} pairs.'.format(len(pairs)))
+        print('Pairing: best {:.3f} s, worst {:.3f} s, {:.0f} files/s.'.format(
+            min(timings), max(timings), args.files / min(timings)))
+        print('Peak traced memory: {:.1f} MiB.'.format(peak / 1024 / 1024))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Runs BatchPatch from start to end on a synthetic release and records how long each stage took.
+
+    python benchmarks/bench_run.py --files 12 --size 64 --edits 16 --output results.json
+
+    The old files are random data, and each new file is a copy of its old file with a number of byte-level edits
+    applied to it. Both get fansub style names with correct CRCs in them. Unless an xdelta executable is given with
+    --xdelta, a stub encoder is used so that the benchmark can be run anywhere.
+"""
+
+__author__ = 'Soulweaver'
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from backends import XdeltaBackend
+from batchpatch import BatchPatch
+
+STUB_LOCATION = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'stub_delta.py')
+
+
+class StubXdeltaBackend(XdeltaBackend):
+    """ Runs the stub encoder through the current Python interpreter, since it can't be executed directly on every
+        platform.
+    """
+
+    def get_encode_command(self, source, target, destination, verbosity, size):
+        return [sys.executable] + super().get_encode_command(source, target, destination, verbosity, size)
+
+    def get_decode_command(self, source, patch, destination):
+        return [sys.executable] + super().get_decode_command(source, patch, destination)
+
+    def get_version_command(self):
+        return [sys.executable] + super().get_version_command()
+
+
+class BenchmarkBatchPatch(BatchPatch):
+    use_stub = False
+
+    def create_backends(self):
+        super().create_backends()
+        if self.use_stub:
+            self.backends['xdelta3'] = StubXdeltaBackend(self.xdelta_location, self.patch_options['profile'])
+
+
+class CorpusGenerator:
+    """ Writes a synthetic release. The same seed always produces the same files. """
+    SPECIFIERS = ['(720p)', '(1080p)', '(BD 1080p 10bit)']
+
+    def __init__(self, seed, file_count, size, edits, edit_size, insert_ratio):
+        self.rng = random.Random(seed)
+        self.file_count = file_count
+        self.size = size
+        self.edits = edits
+        self.edit_size = edit_size
+        self.insert_ratio = insert_ratio
+
+    def generate(self, base_dir):
+        old_dir = os.path.join(base_dir, 'old')
+        new_dir = os.path.join(base_dir, 'new')
+        os.makedirs(old_dir)
+        os.makedirs(new_dir)
+
+        specifier = self.rng.choice(self.SPECIFIERS)
+        total = 0
+        for ep in range(1, self.file_count + 1):
+            old_data = self.rng.randbytes(self.size)
+            new_data = self.edit(old_data)
+            total += len(old_data) + len(new_data)
+
+            for directory, data, version in ((old_dir, old_data, ''), (new_dir, new_data, 'v2')):
+                name = '[Bench] Synthetic Series - {:02d}{} {} [{:08X}].mkv'.format(
+                    ep, version, specifier, zlib.crc32(data) & 0xFFFFFFFF)
+                with open(os.path.join(directory, name), 'wb') as f:
+                    f.write(data)
+
+        return old_dir, new_dir, total
+
+    def edit(self, data):
+        """ Overwrites or inserts random runs of bytes at random positions. Insertions shift the rest of the file,
+            which is the harder case for delta encoders.
+        """
+        result = bytearray(data)
+        for _ in range(self.edits):
+            position = self.rng.randrange(0, max(1, len(result)))
+            replacement = self.rng.randbytes(self.edit_size)
+            if self.rng.random() < self.insert_ratio:
+                result[position:position] = replacement
+            else:
+                result[position:position + self.edit_size] = replacement
+        return bytes(result)
+
+
+def summarize(runs):
+    stages = []
+    for run in runs:
+        for stage in run:
+            if stage not in stages:
+                stages.append(stage)
+
+    return {stage: {
+        'min': min(run[stage] for run in runs if stage in run),
+        'median': statistics.median(run[stage] for run in runs if stage in run),
+        'max': max(run[stage] for run in runs if stage in run)
+    } for stage in stages}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the stages of a complete BatchPatch run.')
+    parser.add_argument('--files', type=int, default=6, help='The number of episodes to create. Default: 6.')
+    parser.add_argument('--size', type=float, default=16, help='The size of each file in MiB. Default: 16.')
+    parser.add_argument('--edits', type=int, default=8, help='The number of edits made to each new file. Default: 8.')
+    parser.add_argument('--edit-size', type=int, default=4096, help='The size of each edit in bytes. Default: 4096.')
+    parser.add_argument('--insert-ratio', type=float, default=0.5,
+                        help='The share of edits that insert data instead of overwriting it. Default: 0.5.')
+    parser.add_argument('--seed', type=int, default=1, help='The random seed for the data. Default: 1.')
+    parser.add_argument('--repeat', type=int, default=3, help='How many times to run BatchPatch. Default: 3.')
+    parser.add_argument('--xdelta', help='Use a real xdelta executable instead of the stub encoder.')
+    parser.add_argument('--work-dir', help='Where to create the synthetic files. Default: a temporary folder.')
+    parser.add_argument('--output', help='Write the results to this JSON file in addition to printing them.')
+    parser.add_argument('batchpatch_args', nargs=argparse.REMAINDER,
+                        help='Extra arguments passed to BatchPatch after "--", e.g. -- -j 4 -z.')
+    args = parser.parse_args()
+
+    extra_args = args.batchpatch_args[1:] if args.batchpatch_args[:1] == ['--'] else args.batchpatch_args
+    base_dir = tempfile.mkdtemp(prefix='batchpatch-bench-', dir=args.work_dir)
+
+    try:
+        start = time.perf_counter()
+        generator = CorpusGenerator(args.seed, args.files, int(args.size * 1024 * 1024), args.edits, args.edit_size,
+                                    args.insert_ratio)
+        old_dir, new_dir, total = generator.generate(base_dir)
+        print('Generated {} MiB of input in {:.2f} s.'.format(total // (1024 * 1024), time.perf_counter() - start))
+
+        runs = []
+        for i in range(args.repeat):
+            target_dir = os.path.join(base_dir, 'target-{}'.format(i))
+            prog = BenchmarkBatchPatch()
+            prog.use_stub = args.xdelta is None
+            argv = ['-o', old_dir, '-n', new_dir, '-t', target_dir, '-l', 'silent', '-c', '-z', '--no-hash-cache',
+                    '-x', args.xdelta if args.xdelta is not None else STUB_LOCATION] + extra_args
+
+            start = time.perf_counter()
+            prog.run(argv)
+            timings = dict(prog.stage_timings)
+            timings['total'] = time.perf_counter() - start
+            runs.append(timings)
+            print('Run {}: {}'.format(i + 1, ', '.join('{} {:.3f} s'.format(k, v) for k, v in timings.items())))
+
+        results = {
+            'config': {
+                'files': args.files,
+                'size_mib': args.size,
+                'edits': args.edits,
+                'edit_size': args.edit_size,
+                'insert_ratio': args.insert_ratio,
+                'seed': args.seed,
+                'encoder': args.xdelta if args.xdelta is not None else 'stub',
+                'batchpatch_args': extra_args
+            },
+            'environment': {
+                'batchpatch_version': BatchPatch.PROG_VERSION,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count()
+            },
+            'runs': runs,
+            'summary': summarize(runs)
+        }
+
+        if args.output is not None:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+            print('Results written to {}.'.format(args.output))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Compares encoding a large file as a whole with encoding it in segments.
+
+    python benchmarks/bench_segments.py --size 1024 --segment-size 128 --jobs 8 --xdelta /usr/bin/xdelta3
+
+    A single pair of synthetic files is generated, and BatchPatch is run on it once as usual and once with
+    --segment-threshold, with the same number of jobs. The wall time, the total size of the shipped patch files and the
+    peak memory use of the encoder processes are reported for both. The stub encoder used without --xdelta or --zstd
+    doesn't create real deltas, so only its timings mean anything.
+"""
+
+__author__ = 'Soulweaver'
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+
+from bench_run import STUB_LOCATION, BenchmarkBatchPatch, CorpusGenerator
+from batchpatch import BatchPatch
+
+
+def run_mode(name, old_dir, new_dir, target_dir, args, extra_args):
+    prog = BenchmarkBatchPatch()
+    prog.use_stub = args.xdelta is None and args.zstd is None
+    argv = ['-o', old_dir, '-n', new_dir, '-t', target_dir, '-l', 'silent', '--no-hash-cache',
+            '-j', str(args.jobs)] + extra_args
+    if args.zstd is not None:
+        argv += ['-b', 'zstd', '--zstd', args.zstd]
+    else:
+        argv += ['-x', args.xdelta if args.xdelta is not None else STUB_LOCATION]
+
+    start = time.perf_counter()
+    prog.run(argv)
+    elapsed = time.perf_counter() - start
+
+    patch_bytes = sum(os.path.getsize(os.path.join(target_dir, shipped)) for pair in prog.result.pairs
+                      for shipped in prog.get_shipped_files(pair))
+    rss = [entry['max_rss_bytes'] for entry in prog.metrics.pairs if entry['max_rss_bytes'] is not None]
+    result = {
+        'seconds': elapsed,
+        'encoding_seconds': prog.stage_timings.get('patch_generation'),
+        'patch_bytes': patch_bytes,
+        'encoder_processes': len(prog.metrics.pairs),
+        'max_encoder_rss_bytes': max(rss) if len(rss) > 0 else None,
+        'failed': list(prog.result.failed)
+    }
+    print('{}: {:.2f} s, {} bytes of patches from {} encoder runs, peak encoder memory {}'.format(
+        name, result['seconds'], result['patch_bytes'], result['encoder_processes'],
+        '{} MiB'.format(result['max_encoder_rss_bytes'] // (1024 * 1024))
+        if result['max_encoder_rss_bytes'] is not None else 'unknown'))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares whole file and segmented encoding of a large file.')
+    parser.add_argument('--size', type=float, default=256, help='The size of the file in MiB. Default: 256.')
+    parser.add_argument('--segment-size', type=float, default=32, help='The segment size in MiB. Default: 32.')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='The number of parallel jobs in both runs. Default: the number of CPUs.')
+    parser.add_argument('--edits', type=int, default=64, help='The number of edits made to the new file. Default: 64.')
+    parser.add_argument('--edit-size', type=int, default=65536, help='The size of each edit in bytes. Default: 65536.')
+    parser.add_argument('--insert-ratio', type=float, default=0.5,
+                        help='The share of edits that insert data instead of overwriting it. Default: 0.5.')
+    parser.add_argument('--seed', type=int, default=1, help='The random seed for the data. Default: 1.')
+    parser.add_argument('--xdelta', help='Use a real xdelta executable instead of the stub encoder.')
+    parser.add_argument('--zstd', help='Use the zstd backend with this executable instead of xdelta.')
+    parser.add_argument('--work-dir', help='Where to create the synthetic files. Default: a temporary folder.')
+    parser.add_argument('--output', help='Write the results to this JSON file in addition to printing them.')
+    parser.add_argument('batchpatch_args', nargs=argparse.REMAINDER,
+                        help='Extra arguments passed to BatchPatch in both runs after "--", e.g. -- -p balanced.')
+    args = parser.parse_args()
+
+    extra_args = args.batchpatch_args[1:] if args.batchpatch_args[:1] == ['--'] else args.batchpatch_args
+    base_dir = tempfile.mkdtemp(prefix='batchpatch-bench-', dir=args.work_dir)
+
+    try:
+        start = time.perf_counter()
+        generator = CorpusGenerator(args.seed, 1, int(args.size * 1024 * 1024), args.edits, args.edit_size,
+                                    args.insert_ratio)
+        old_dir, new_dir, total = generator.generate(base_dir)
+        print('Generated {} MiB of input in {:.2f} s.'.format(total // (1024 * 1024), time.perf_counter() - start))
+
+        whole = run_mode('whole', old_dir, new_dir, os.path.join(base_dir, 'whole'), args, extra_args)
+        segmented = run_mode('segmented', old_dir, new_dir, os.path.join(base_dir, 'segmented'), args,
+                             extra_args + ['--segment-threshold', str(min(args.size, args.segment_size) / 2),
+                                           '--segment-size', str(args.segment_size)])
+        if whole['seconds'] > 0 and whole['patch_bytes'] > 0:
+            print('Segmented: {:.2f}x the speed, {:+.1%} patch size.'.format(
+                whole['seconds'] / segmented['seconds'], segmented['patch_bytes'] / whole['patch_bytes'] - 1))
+
+        if args.output is not None:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'config': {
+                        'size_mib': args.size,
+                        'segment_size_mib': args.segment_size,
+                        'jobs': args.jobs,
+                        'edits': args.edits,
+                        'edit_size': args.edit_size,
+                        'insert_ratio': args.insert_ratio,
+                        'seed': args.seed,
+                        'encoder': args.zstd or args.xdelta or 'stub',
+                        'batchpatch_args': extra_args
+                    },
+                    'environment': {
+                        'batchpatch_version': BatchPatch.PROG_VERSION,
+                        'python': platform.python_version(),
+                        'platform': platform.platform(),
+                        'cpu_count': os.cpu_count()
+                    },
+                    'whole': whole,
+                    'segmented': segmented
+                }, f, indent=2)
+            print('Results written to {}.'.format(args.output))
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == '__main__':
+    main()
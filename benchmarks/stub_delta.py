@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" A stand-in for xdelta3 for running the benchmarks on machines without it. It understands just enough of the
+    xdelta3 command line to be driven by BatchPatch. The "patch" is the target file compressed with zlib, so the
+    timings reflect reading and writing the data rather than real delta encoding.
+"""
+
+__author__ = 'Soulweaver'
+
+import sys
+import zlib
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def main(args):
+    if '-V' in args:
+        sys.stderr.write('Xdelta version 3 (benchmark stub)\n')
+        return 0
+
+    files = args[args.index('-s') + 1:]
+    if len(files) != 3:
+        sys.stderr.write('usage: stub_delta.py (-e|-d) [options] -s source input output\n')
+        return 1
+
+    source, data, output = files
+    # Read through the source like a real encoder would.
+    with open(source, 'rb') as f:
+        while f.read(CHUNK_SIZE):
+            pass
+
+    with open(data, 'rb') as src, open(output, 'wb') as dst:
+        processor = zlib.compressobj(1) if '-e' in args else zlib.decompressobj()
+        chunk = src.read(CHUNK_SIZE)
+        while chunk:
+            dst.write(processor.compress(chunk) if '-e' in args else processor.decompress(chunk))
+            chunk = src.read(CHUNK_SIZE)
+        dst.write(processor.flush())
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import os
+import threading
+
+
+class SizeWatchdog:
+    """ Kills an encoder as soon as the patch it is writing grows past a size limit, e.g. when the new file is a
+        complete re-encode and the patch would end up nearly as large as the file itself.
+    """
+    INTERVAL = 0.5
+
+    def __init__(self, proc, path, limit):
+        self.proc = proc
+        self.path = path
+        self.limit = limit
+        self.exceeded = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.watch, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def watch(self):
+        while not self.stopped.wait(self.INTERVAL):
+            if self.check():
+                try:
+                    self.proc.kill()
+                except OSError:
+                    pass
+                return
+
+    def check(self):
+        try:
+            self.exceeded = self.exceeded or os.path.getsize(self.path) > self.limit
+        except OSError:
+            # Not created yet.
+            pass
+        return self.exceeded
+
+    def stop(self):
+        """ Stops watching once the process has exited. Returns whether the limit was exceeded, including by a patch
+            that was finished between two checks.
+        """
+        self.stopped.set()
+        self.thread.join()
+        return self.check()
@@ -0,0 +1,15 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import os
+
+
+class CacheDirectory:
+    """ The folder under the user's cache directory where BatchPatch keeps the data it remembers between runs. """
+    NAME = 'batchpatch'
+
+    @staticmethod
+    def get_path(filename):
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(cache_home, CacheDirectory.NAME, filename)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import heapq
+import json
+import os
+import threading
+import time
+
+from cachedir import CacheDirectory
+
+
+class CostModel:
+    """ Estimates the patch size and the encoding time of a pair from patches of a few samples of it. The estimates
+        made while planning are remembered, and when a later run actually creates the patch, the difference is used
+        to correct the estimates for the same encoder settings from then on. The samples are too small for the
+        encoder to find everything it would in the full files, and starting the encoder takes a while, so the
+        uncorrected estimates tend to be off in the same direction every time.
+    """
+    FORMAT_VERSION = 1
+    # How much each new observation moves the correction factors.
+    LEARNING_RATE = 0.3
+    MAX_PREDICTIONS = 10000
+    SAMPLE_COUNT = 3
+    SAMPLE_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.factors = {}
+        self.predictions = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Reads the calibration data, if there is any. Returns False if it was present but could not be used. """
+        if not os.path.isfile(self.path):
+            return True
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return False
+
+        if not isinstance(data, dict) or data.get('format') != self.FORMAT_VERSION:
+            return False
+
+        self.factors = data.get('factors', {})
+        self.predictions = data.get('predictions', {})
+        return True
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+
+            if len(self.predictions) > self.MAX_PREDICTIONS:
+                # Estimates for patches that were never created are dropped, oldest first.
+                for key in heapq.nsmallest(len(self.predictions) - self.MAX_PREDICTIONS, self.predictions,
+                                           key=lambda item: self.predictions[item]['time']):
+                    del self.predictions[key]
+
+            data = {
+                'format': self.FORMAT_VERSION,
+                'factors': self.factors,
+                'predictions': self.predictions
+            }
+
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as fh:
+                json.dump(data, fh, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+            self.changed = False
+
+    def estimate(self, settings, sample_source_bytes, sample_target_bytes, sample_patch_bytes, sample_seconds,
+                 source_size, target_size):
+        """ Scales the results of the samples up to the full files. Returns the uncorrected and the corrected patch
+            size and encoding time, and the number of observations the correction is based on.
+        """
+        size = target_size * sample_patch_bytes / sample_target_bytes if sample_target_bytes > 0 else 0
+        seconds = (source_size + target_size) * sample_seconds / (sample_source_bytes + sample_target_bytes) \
+            if sample_source_bytes + sample_target_bytes > 0 else 0
+
+        with self.lock:
+            factors = self.factors.get(settings, {'size': 1.0, 'time': 1.0, 'observations': 0})
+
+        return size, seconds, size * factors['size'], seconds * factors['time'], factors['observations']
+
+    def remember(self, identity, settings, size, seconds):
+        """ Stores the uncorrected estimates for a pair, to be compared with the real patch once it is created. """
+        with self.lock:
+            self.predictions[identity] = {'settings': settings, 'size': size, 'seconds': seconds, 'time': time.time()}
+            self.changed = True
+
+    def observe(self, identity, size, seconds):
+        """ Updates the correction factors with the real size and encoding time of a patch, if it was estimated
+            before. Returns True if it was.
+        """
+        with self.lock:
+            prediction = self.predictions.pop(identity, None)
+            if prediction is None:
+                return False
+
+            self.changed = True
+            factors = self.factors.setdefault(prediction['settings'], {'size': 1.0, 'time': 1.0, 'observations': 0})
+            for name, actual, predicted in (('size', size, prediction['size']),
+                                            ('time', seconds, prediction['seconds'])):
+                if predicted is None or predicted <= 0 or actual is None:
+                    continue
+                ratio = actual / predicted
+                # The first observation replaces the neutral default outright.
+                rate = 1.0 if factors['observations'] == 0 else self.LEARNING_RATE
+                factors[name] = factors[name] * (1 - rate) + ratio * rate
+            factors['observations'] += 1
+            return True
+
+    @staticmethod
+    def get_sample_regions(source_size, target_size):
+        """ Picks regions of the new file spread evenly over it, each to be encoded against a region of the old file
+            twice as long around the same relative position, so that data that has moved a little is still found.
+            Returns (source offset, source length, target offset, target length) tuples. Small files are encoded
+            whole.
+        """
+        if target_size <= CostModel.SAMPLE_COUNT * CostModel.SAMPLE_SIZE:
+            return [(0, source_size, 0, target_size)]
+
+        regions = []
+        source_length = min(source_size, 2 * CostModel.SAMPLE_SIZE)
+        step = (target_size - CostModel.SAMPLE_SIZE) / (CostModel.SAMPLE_COUNT - 1)
+        for i in range(CostModel.SAMPLE_COUNT):
+            target_offset = int(i * step)
+            center = int((target_offset + CostModel.SAMPLE_SIZE / 2) * source_size / target_size)
+            source_offset = min(max(0, center - source_length // 2), source_size - source_length)
+            regions.append((source_offset, source_length, target_offset, CostModel.SAMPLE_SIZE))
+        return regions
+
+    @staticmethod
+    def estimate_wall_time(durations, jobs):
+        """ The time it takes to run tasks of the given durations on the given number of workers, when the longest
+            tasks are started first like the patches are.
+        """
+        workers = [0.0] * max(1, jobs)
+        for duration in sorted(durations, reverse=True):
+            heapq.heapreplace(workers, workers[0] + duration)
+        return max(workers)
+
+    @staticmethod
+    def get_default_path():
+        return CacheDirectory.get_path('calibration.json')
@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+
+class BatchPatchError(Exception):
+    """ Raised when a batch can't be processed. The reason has already been logged by the time it is raised. """
+
+
+class ConfigurationError(BatchPatchError):
+    """ The folders, executables or options given for a batch are not usable. """
+
+
+class CrcMismatchError(BatchPatchError):
+    """ The CRC in the name of a file doesn't match its contents. """
+
+    def __init__(self, filenames):
+        super().__init__('CRC mismatch in: {}'.format(', '.join(filenames)))
+        self.filenames = filenames
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from cachedir import CacheDirectory
+
+
+class HashingCancelled(Exception):
+    pass
+
+
+class Crc32:
+    """ zlib.crc32 behind the same interface as the hash objects of hashlib. """
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return format(self.value & 0xFFFFFFFF, '08x')
+
+
+class FileHasher:
+    CHUNK_SIZE = 8 * 1024 * 1024
+    ALGORITHMS = {
+        'crc32': Crc32,
+        'sha256': hashlib.sha256,
+        'blake2b': hashlib.blake2b
+    }
+
+    def __init__(self, cancel_event=None, cache=None, extra_algorithms=()):
+        """ The extra algorithms are calculated whenever a file has to be read for any digest, and stored in the
+            cache, so that asking for them later doesn't read the file again.
+        """
+        self.cancel_event = cancel_event
+        self.cache = cache
+        self.extra_algorithms = extra_algorithms
+        self.bytes_read = 0
+        self.lock = threading.Lock()
+
+    def crc32(self, path):
+        """ Calculates the CRC32 of a file, returned as an 8 character lowercase hex string. """
+        return self.digests(path, ['crc32'])['crc32']
+
+    def sha256(self, path):
+        """ Calculates the SHA-256 of a file as a lowercase hex string, for when files need to be told apart with
+            more certainty than a CRC gives.
+        """
+        return self.digests(path, ['sha256'])['sha256']
+
+    def digests(self, path, algorithms):
+        """ Calculates several digests of a file in a single read, and returns them by algorithm as lowercase hex
+            strings. The file is memory mapped if possible, and each digest is fed large slices of it so that it can
+            do its work without holding the GIL.
+        """
+        wanted = list(dict.fromkeys(list(algorithms) + list(self.extra_algorithms)))
+        results = {}
+        stat = None
+        if self.cache is not None:
+            stat = os.stat(path)
+            for algorithm in wanted:
+                digest = self.cache.get(stat, algorithm)
+                if digest is not None:
+                    results[algorithm] = digest
+
+        states = {algorithm: self.ALGORITHMS[algorithm]() for algorithm in wanted if algorithm not in results}
+        if len(states) > 0:
+            def update(chunk):
+                for state in states.values():
+                    state.update(chunk)
+
+            self.feed(path, update)
+            for algorithm, state in states.items():
+                results[algorithm] = state.hexdigest()
+                if self.cache is not None:
+                    self.cache.put(stat, algorithm, results[algorithm])
+
+        return {algorithm: results[algorithm] for algorithm in algorithms}
+
+    def feed(self, path, consumer):
+        """ Reads the file at the given path from start to end, passing each chunk to the consumer. The chunks are
+            only valid during the call and must not be stored.
+        """
+        def counting_consumer(chunk):
+            consumer(chunk)
+            with self.lock:
+                self.bytes_read += len(chunk)
+
+        with open(path, 'rb') as f:
+            FileHasher.advise_sequential(f.fileno())
+
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files and some special filesystems can't be mapped, so fall back to plain reads.
+                mapped = None
+
+            if mapped is None:
+                buffer = bytearray(self.CHUNK_SIZE)
+                with memoryview(buffer) as view:
+                    while True:
+                        self.check_cancelled()
+                        count = f.readinto(buffer)
+                        if not count:
+                            break
+                        with view[:count] as chunk:
+                            counting_consumer(chunk)
+                return
+
+            with mapped:
+                if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+                with memoryview(mapped) as view:
+                    for offset in range(0, len(mapped), self.CHUNK_SIZE):
+                        self.check_cancelled()
+                        with view[offset:offset + self.CHUNK_SIZE] as chunk:
+                            counting_consumer(chunk)
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise HashingCancelled()
+
+    @staticmethod
+    def advise_sequential(fd):
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+
+
+class HashCache:
+    """ A persistent store of file digests, so that files that haven't changed between runs don't need to be read
+        again. Files are identified by their device, inode, size and modification time, so renaming or moving a
+        file within the same filesystem keeps its entry valid, while any modification invalidates it.
+    """
+    DEFAULT_MAX_ENTRIES = 100000
+    DEFAULT_MAX_AGE = 90 * 24 * 60 * 60
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, max_age=DEFAULT_MAX_AGE):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        # When the entries found were last used, written in one go instead of a transaction for every hit.
+        self.used = {}
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            '  device INTEGER NOT NULL,'
+            '  inode INTEGER NOT NULL,'
+            '  size INTEGER NOT NULL,'
+            '  mtime_ns INTEGER NOT NULL,'
+            '  algorithm TEXT NOT NULL,'
+            '  digest TEXT NOT NULL,'
+            '  last_used REAL NOT NULL,'
+            '  PRIMARY KEY (device, inode, size, mtime_ns, algorithm)'
+            ')'
+        )
+        self.connection.commit()
+
+    def get(self, stat, algorithm):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT digest FROM digests WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? '
+                'AND algorithm = ?', HashCache.get_key(stat) + (algorithm,)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.used[HashCache.get_key(stat) + (algorithm,)] = time.time()
+            return row[0]
+
+    def put(self, stat, algorithm, digest):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO digests (device, inode, size, mtime_ns, algorithm, digest, last_used) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', HashCache.get_key(stat) + (algorithm, digest, time.time())
+            )
+            self.connection.commit()
+
+    def evict(self):
+        """ Drops entries that haven't been used within the maximum age, and then the least recently used ones
+            until at most the maximum number of entries remain. Returns the number of removed entries.
+        """
+        with self.lock:
+            self.write_used()
+            removed = self.connection.execute(
+                'DELETE FROM digests WHERE last_used < ?', (time.time() - self.max_age,)
+            ).rowcount
+            removed += self.connection.execute(
+                'DELETE FROM digests WHERE rowid IN ('
+                '  SELECT rowid FROM digests ORDER BY last_used DESC LIMIT -1 OFFSET ?'
+                ')', (self.max_entries,)
+            ).rowcount
+            self.connection.commit()
+            return removed
+
+    def write_used(self):
+        """ Stores the times the entries found since the last call were used. Expects the lock to be held. """
+        if len(self.used) == 0:
+            return
+
+        self.connection.executemany(
+            'UPDATE digests SET last_used = ? WHERE device = ? AND inode = ? AND size = ? AND mtime_ns = ? '
+            'AND algorithm = ?', [(last_used,) + key for key, last_used in self.used.items()]
+        )
+        self.connection.commit()
+        self.used = {}
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+    @staticmethod
+    def get_key(stat):
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def get_default_path():
+        return CacheDirectory.get_path('hashes.sqlite')
+
+
+class MemoryHashCache:
+    """ Keeps the digests calculated during a single run, when the persistent hash cache is disabled or can't be
+        opened, so that a file is still read only once per run.
+    """
+
+    def __init__(self):
+        self.digests = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, stat, algorithm):
+        with self.lock:
+            digest = self.digests.get(HashCache.get_key(stat) + (algorithm,))
+            if digest is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return digest
+
+    def put(self, stat, algorithm, digest):
+        with self.lock:
+            self.digests[HashCache.get_key(stat) + (algorithm,)] = digest
+
+    def close(self):
+        self.digests = {}
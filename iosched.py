@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import collections
+import concurrent.futures
+import functools
+import os
+import threading
+
+
+class IOScheduler:
+    """ Runs tasks that read files on a pool of threads, allowing only a limited number of tasks to read from each
+        device at the same time. Reading several large files at once from a single hard disk or network share is much
+        slower than reading them one after another, while tasks on different devices can still run side by side.
+
+        Devices are told apart by the st_dev of the folders the files are in. A mapping of path prefixes to device
+        names can be given for the cases where that isn't enough, e.g. several shares exported from the same NAS.
+    """
+    # How much of the start of a file to ask the kernel to read ahead before an external program opens it.
+    PREFETCH_SIZE = 32 * 1024 * 1024
+
+    def __init__(self, workers, device_limit=0, device_map=None, executor=None):
+        self.workers = max(1, workers)
+        # A pool shared with other schedulers. No more than workers tasks of this scheduler are put into it at once.
+        self.executor = executor
+        self.device_limit = device_limit
+        # Longest prefixes first, so that the most specific mapping wins.
+        self.device_map = sorted(((os.path.abspath(prefix), name) for prefix, name in (device_map or {}).items()),
+                                 key=lambda item: len(item[0]), reverse=True)
+        self.devices = {}
+
+    def get_device(self, path):
+        path = os.path.abspath(path)
+        for prefix, name in self.device_map:
+            if path == prefix or path.startswith(prefix.rstrip(os.sep) + os.sep):
+                return name
+
+        directory = os.path.dirname(path)
+        device = self.devices.get(directory)
+        if device is None:
+            try:
+                device = os.stat(directory).st_dev
+            except OSError:
+                device = directory
+            self.devices[directory] = device
+        return device
+
+    def run(self, func, items, get_paths, cancel_event=None):
+        """ Calls func for each item and returns the results in the same order. get_paths returns the files an item
+            reads. Items are started in the given order, except that an item is passed over while any of its devices
+            is at the limit. If the cancel event is set, the items not started yet are skipped and get None as their
+            result. The first exception raised by func is raised again once every started item has finished.
+        """
+        if len(items) == 0:
+            return []
+
+        devices = [set(self.get_device(path) for path in get_paths(item)) for item in items]
+        pending = list(range(len(items)))
+        busy = collections.Counter()
+        running = [0]
+        started = []
+        changed = threading.Condition()
+
+        def finished(index, _):
+            with changed:
+                running[0] -= 1
+                busy.subtract(devices[index])
+                changed.notify()
+
+        executor = self.executor or concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            with changed:
+                while len(pending) > 0 and (cancel_event is None or not cancel_event.is_set()):
+                    index = self.pick(pending, devices, busy) if running[0] < self.workers else None
+                    if index is None:
+                        changed.wait()
+                        continue
+
+                    pending.remove(index)
+                    running[0] += 1
+                    busy.update(devices[index])
+                    future = executor.submit(func, items[index])
+                    future.add_done_callback(functools.partial(finished, index))
+                    started.append((index, future))
+
+            concurrent.futures.wait([future for _, future in started])
+        finally:
+            if executor is not self.executor:
+                executor.shutdown()
+
+        results = [None] * len(items)
+        for index, future in started:
+            results[index] = future.result()
+        return results
+
+    def pick(self, pending, devices, busy):
+        if self.device_limit <= 0:
+            return pending[0]
+
+        for index in pending:
+            if all(busy[device] < self.device_limit for device in devices[index]):
+                return index
+        return None
+
+    @staticmethod
+    def prefetch(path, length=PREFETCH_SIZE):
+        """ Asks the kernel to start reading the beginning of a file into the page cache, for files that are about to
+            be read by another process. Read-ahead hints given through our own descriptor don't carry over to theirs,
+            but the cached pages do.
+        """
+        if not hasattr(os, 'posix_fadvise'):
+            return
+
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return
+
+        try:
+            os.posix_fadvise(fd, 0, length, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
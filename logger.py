@@ -2,9 +2,14 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Soulweaver'
 
+from datetime import datetime
 from enum import Enum
+import json
+import queue
 import re
+import sys
 import colorama
+import threading
 import time
 
 
@@ -26,22 +31,124 @@ class LogLevel(Enum):
 
 
 class Logger:
+    """ Writes log messages to the standard output, either as colored text or as JSON lines. Messages below the log
+        level are dropped before they are formatted, so callers can pass the arguments of the message separately to
+        avoid building strings that are never shown. The accepted messages are written by a background thread, in
+        batches, so that logging doesn't hold up the caller on a slow console.
+    """
     log_level = None
+    formats = ['text', 'json']
 
-    def __init__(self, log_level=LogLevel.notice):
+    # How many queued messages are written out at most with a single write call.
+    BATCH_SIZE = 256
+
+    def __init__(self, log_level=LogLevel.notice, log_format='text'):
         self.log_level = log_level
+        self.log_format = log_format
+        self.line_format = "{}[{}] {:>" + str(LogLevel.max_width()) + "}: {}{}\n"
+        self.queue = queue.Queue()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.timestamp_second = None
+        self.timestamp = None
+
+    def is_enabled(self, level):
+        return level.numval >= self.log_level.numval
+
+    def log(self, msg, level, *args):
+        """ Queues a message for writing if the level is high enough. If any args are given, the message is used as
+            a format string for them.
+        """
+        if level.numval < self.log_level.numval:
+            return
+
+        if len(args) > 0:
+            msg = msg.format(*args)
+
+        self.queue.put((time.time(), msg, level))
+        if self.writer is None:
+            self.start_writer()
+
+    def flush(self):
+        """ Waits until every message queued so far has been written out. """
+        if self.writer is not None:
+            self.queue.join()
+
+    def close(self):
+        """ Writes out the remaining messages and stops the background thread. """
+        with self.writer_lock:
+            writer = self.writer
+            self.writer = None
 
-    def log(self, msg, level):
+        if writer is not None:
+            self.queue.put(None)
+            writer.join()
+
+    def start_writer(self):
+        with self.writer_lock:
+            if self.writer is None:
+                # A daemon thread, so that a forgotten close() can't keep the program from exiting.
+                self.writer = threading.Thread(target=self.write_queued, name='logger', daemon=True)
+                self.writer.start()
+
+    def write_queued(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < Logger.BATCH_SIZE:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            records = [record for record in batch if record is not None]
+            stopping = len(records) < len(batch)
+            try:
+                self.write(records)
+            except OSError:
+                # The output has gone away, e.g. the reading end of a pipe was closed. There's nowhere to report
+                # that to, so keep emptying the queue to not block anyone waiting on it.
+                pass
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def write(self, records):
+        lines = [self.format_record(*record) for record in records]
         try:
-            if level.numval >= self.log_level.numval:
-                print(("{}[{}] {:>" + str(LogLevel.max_width()) + "}: {}{}").format(
-                    level.log_color,
-                    time.strftime('%Y-%m-%d %H:%M:%S'),
-                    level.log_prefix,
-                    msg,
-                    colorama.Style.RESET_ALL
-                ))
+            sys.stdout.write(''.join(lines))
         except UnicodeEncodeError:
-            self.log('A message sent to the logger could not be printed properly due to an encoding problem. '
-                     'An ASCII-safe version of the original message follows.', LogLevel.warning)
-            self.log(re.sub(r'[^\u0000-\u007f]', '?', msg), level)
+            # Find the offending messages by writing them out one at a time.
+            for line, (now, msg, level) in zip(lines, records):
+                try:
+                    sys.stdout.write(line)
+                except UnicodeEncodeError:
+                    sys.stdout.write(self.format_record(
+                        now, 'A message sent to the logger could not be printed properly due to an encoding problem. '
+                             'An ASCII-safe version of the original message follows.', LogLevel.warning))
+                    sys.stdout.write(self.format_record(now, re.sub(r'[^\u0000-\u007f]', '?', msg), level))
+        sys.stdout.flush()
+
+    def format_record(self, now, msg, level):
+        if self.log_format == 'json':
+            return json.dumps({
+                'time': datetime.fromtimestamp(now).astimezone().isoformat(timespec='milliseconds'),
+                'level': level.name,
+                'message': msg
+            }) + '\n'
+
+        return self.line_format.format(
+            level.log_color,
+            self.get_timestamp(now),
+            level.log_prefix,
+            msg,
+            colorama.Style.RESET_ALL
+        )
+
+    def get_timestamp(self, now):
+        # Messages tend to come in bursts, so the formatted time is reused for as long as the second stays the same.
+        second = int(now)
+        if second != self.timestamp_second:
+            self.timestamp_second = second
+            self.timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(second))
+        return self.timestamp
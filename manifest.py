@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import json
+import os
+import threading
+
+
+class PatchManifest:
+    """ Keeps track of the patches that have been written to a target directory, and what they were created from.
+        The manifest is saved after every change, so that an interrupted run can later continue from where it left
+        off instead of starting over.
+    """
+    FILENAME = 'batchpatch-manifest.json'
+    FORMAT_VERSION = 1
+
+    def __init__(self, target_dir, generator):
+        self.path = os.path.join(target_dir, self.FILENAME)
+        self.generator = generator
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """ Reads the existing manifest, if there is one. Returns False if a manifest was present but could not be
+            used, in which case the run continues as if it was missing.
+        """
+        if not os.path.isfile(self.path):
+            return True
+
+        try:
+            with open(self.path, 'r', encoding='utf-8') as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return False
+
+        if not isinstance(data, dict) or data.get('format') != self.FORMAT_VERSION:
+            return False
+
+        self.entries = data.get('patches', {})
+        return True
+
+    def save(self):
+        with self.lock:
+            data = {
+                'format': self.FORMAT_VERSION,
+                'generator': self.generator,
+                'patches': self.entries
+            }
+
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as fh:
+                json.dump(data, fh, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+
+    def get(self, patch_name):
+        with self.lock:
+            return self.entries.get(patch_name)
+
+    def record(self, patch_name, entry):
+        with self.lock:
+            self.entries[patch_name] = entry
+        self.save()
+
+    def forget(self, patch_name):
+        with self.lock:
+            if self.entries.pop(patch_name, None) is None:
+                return
+        self.save()
+
+    @staticmethod
+    def get_file_identity(path):
+        stat = os.stat(path)
+        return {
+            'path': os.path.abspath(path),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns
+        }
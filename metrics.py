@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+
+class RunMetrics:
+    """ Collects timings, I/O volumes and encoder resource usage over a run, and writes them out either as JSON or in
+        the Prometheus text format for the node_exporter textfile collector.
+    """
+    PREFIX = 'batchpatch_'
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        self.stage_bytes = {}
+        self.pairs = []
+        self.verifications = []
+        self.lock = threading.Lock()
+
+    def add_stage(self, name, seconds):
+        with self.lock:
+            self.stages[name] = seconds
+
+    def add_bytes(self, stage, read=0, written=0):
+        with self.lock:
+            counts = self.stage_bytes.setdefault(stage, {'read': 0, 'written': 0})
+            counts['read'] += read
+            counts['written'] += written
+
+    def add_pair(self, patch_name, backend, source_size, target_size, patch_size, seconds, rusage=None):
+        entry = {
+            'patch': patch_name,
+            'backend': backend,
+            'source_bytes': source_size,
+            'target_bytes': target_size,
+            'patch_bytes': patch_size,
+            'seconds': seconds,
+            'throughput_mb_s': (source_size + target_size) / seconds / 1000000 if seconds > 0 else None,
+            'size_ratio': patch_size / target_size if target_size > 0 else None,
+            'user_cpu_seconds': None,
+            'system_cpu_seconds': None,
+            'max_rss_bytes': None
+        }
+
+        if rusage is not None:
+            entry['user_cpu_seconds'] = rusage.ru_utime
+            entry['system_cpu_seconds'] = rusage.ru_stime
+            # macOS reports the peak RSS in bytes, everything else in kilobytes.
+            entry['max_rss_bytes'] = rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+        with self.lock:
+            self.pairs.append(entry)
+        self.add_bytes('patch_generation', source_size + target_size, patch_size)
+
+    def add_verification(self, patch_name, backend, target_size, seconds):
+        with self.lock:
+            self.verifications.append({
+                'patch': patch_name,
+                'backend': backend,
+                'target_bytes': target_size,
+                'seconds': seconds,
+                'throughput_mb_s': target_size / seconds / 1000000 if seconds > 0 else None
+            })
+        self.add_bytes('verification', read=target_size)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'started': self.started,
+                'stages': {name: {
+                    'seconds': seconds,
+                    'bytes_read': self.stage_bytes.get(name, {}).get('read', 0),
+                    'bytes_written': self.stage_bytes.get(name, {}).get('written', 0)
+                } for name, seconds in self.stages.items()},
+                'pairs': list(self.pairs),
+                'verifications': list(self.verifications)
+            }
+
+    def write_json(self, path):
+        RunMetrics.write_atomically(path, json.dumps(self.to_dict(), indent=2))
+
+    def write_prometheus(self, path):
+        data = self.to_dict()
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append('# HELP {}{} {}'.format(self.PREFIX, name, help_text))
+            lines.append('# TYPE {}{} gauge'.format(self.PREFIX, name))
+            for labels, value in samples:
+                if value is None:
+                    continue
+                label_str = ','.join('{}="{}"'.format(k, RunMetrics.escape_label(v)) for k, v in labels.items())
+                lines.append('{}{}{} {}'.format(self.PREFIX, name, '{' + label_str + '}' if label_str else '',
+                                                repr(float(value))))
+
+        metric('last_run_timestamp_seconds', 'The time the last run was started.', [({}, data['started'])])
+        stages = data['stages'].items()
+        metric('stage_duration_seconds', 'Wall time spent in each stage of the run.',
+               [({'stage': k}, v['seconds']) for k, v in stages])
+        metric('stage_read_bytes', 'Bytes read in each stage of the run.',
+               [({'stage': k}, v['bytes_read']) for k, v in stages])
+        metric('stage_written_bytes', 'Bytes written in each stage of the run.',
+               [({'stage': k}, v['bytes_written']) for k, v in stages])
+
+        pairs = [({'patch': p['patch'], 'backend': p['backend']}, p) for p in data['pairs']]
+        metric('pair_duration_seconds', 'Wall time spent encoding each patch.',
+               [(labels, p['seconds']) for labels, p in pairs])
+        metric('pair_throughput_megabytes_per_second', 'Input megabytes encoded per second for each patch.',
+               [(labels, p['throughput_mb_s']) for labels, p in pairs])
+        metric('pair_size_ratio', 'Size of each patch relative to the size of its target file.',
+               [(labels, p['size_ratio']) for labels, p in pairs])
+        metric('pair_cpu_seconds', 'CPU time used by the encoder for each patch.',
+               [(dict(labels, mode='user'), p['user_cpu_seconds']) for labels, p in pairs] +
+               [(dict(labels, mode='system'), p['system_cpu_seconds']) for labels, p in pairs])
+        metric('pair_max_rss_bytes', 'Peak resident memory of the encoder for each patch.',
+               [(labels, p['max_rss_bytes']) for labels, p in pairs])
+
+        verifications = [({'patch': v['patch'], 'backend': v['backend']}, v) for v in data['verifications']]
+        metric('verify_duration_seconds', 'Wall time spent decoding and checking each patch.',
+               [(labels, v['seconds']) for labels, v in verifications])
+        metric('verify_throughput_megabytes_per_second', 'Decoded megabytes checked per second for each patch.',
+               [(labels, v['throughput_mb_s']) for labels, v in verifications])
+
+        RunMetrics.write_atomically(path, '\n'.join(lines) + '\n')
+
+    @staticmethod
+    def escape_label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def write_atomically(path, text):
+        # The textfile collector may read the file at any moment, so never let it see a half written one.
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as fh:
+            fh.write(text)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def wait(proc):
+        """ Waits for a subprocess to exit and returns its return code and resource usage. The resource usage is
+            None on platforms without wait4.
+        """
+        if not hasattr(os, 'wait4'):
+            return proc.wait(), None
+
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        return proc.returncode, rusage
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import os
+import zlib
+
+
+class FileEntity:
+    """ A single file recognized by the filename matcher. """
+    __slots__ = ('key', 'ver', 'group', 'name', 'ep', 'specifier', 'crc', 'ext', 'filename', 'relpath', 'entry',
+                 'size')
+
+    def __init__(self, key, ver, group, name, ep, specifier, crc, ext, filename, relpath, entry=None):
+        self.key = key
+        self.ver = ver
+        self.group = group
+        self.name = name
+        self.ep = ep
+        self.specifier = specifier
+        self.crc = crc
+        self.ext = ext
+        self.filename = filename
+        self.relpath = relpath
+        self.entry = entry
+        self.size = None
+
+    def get_size(self):
+        """ Returns the size of the file, reusing the stat data of the directory entry it was found from. """
+        if self.size is None:
+            self.size = self.entry.stat().st_size if self.entry is not None else os.path.getsize(self.filename)
+        return self.size
+
+
+class FilePair:
+    """ A source and a target file that a patch will be created for. """
+    __slots__ = ('source', 'target', 'patch_name', 'key', 'windows_safe', 'backend', 'duplicate_of',
+                 'full_file', 'similarity', 'segments')
+
+    def __init__(self, source, target, patch_name, key, windows_safe, backend=None):
+        self.source = source
+        self.target = target
+        self.patch_name = patch_name
+        self.key = key
+        self.windows_safe = windows_safe
+        self.backend = backend
+        # Another pair with the same contents, whose patch is used for this pair as well.
+        self.duplicate_of = None
+        # The path of a copy of the new file in the target folder, shipped instead of a patch that grew too large.
+        self.full_file = None
+        # The estimated share of content in common, for the pairs that were matched by their contents.
+        self.similarity = None
+        # The segments the pair was split into, if its new file was large enough to be encoded in parts.
+        self.segments = None
+
+    def get_size(self):
+        try:
+            return self.source.get_size() + self.target.get_size()
+        except OSError:
+            return 0
+
+    def get_temp_name(self, suffix):
+        """ The name used for the files of this pair when their real names can't be passed to xdelta. """
+        return '~' + self.patch_name.replace('/', '_') + suffix
+
+    def get_own_temp_name(self, suffix):
+        """ Like get_temp_name, but different for each of the pairs sharing a patch, so that they can be applied at
+            the same time.
+        """
+        key = zlib.crc32((self.source.relpath + '|' + self.target.relpath).encode())
+        return '~{}.{:08x}{}'.format(self.patch_name.replace('/', '_'), key, suffix)
+
+
+class DirectoryScanner:
+    """ Lists the files in a directory with os.scandir, optionally descending into subdirectories. The entries are
+        yielded together with their path relative to the scanned directory, using forward slashes as separators.
+    """
+
+    def __init__(self, recursive=False):
+        self.recursive = recursive
+
+    def scan(self, base_dir):
+        pending = [(str(base_dir), '')]
+        while len(pending) > 0:
+            directory, prefix = pending.pop()
+            subdirectories = []
+
+            with os.scandir(directory) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        if self.recursive:
+                            subdirectories.append((entry.path, prefix + entry.name + '/'))
+                        continue
+
+                    yield entry, prefix + entry.name
+
+            # Reversed so that popping from the end visits the subdirectories in the order they were listed.
+            pending.extend(reversed(subdirectories))
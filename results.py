@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+
+class BatchResult:
+    """ The outcome of processing a single batch. The patch lists hold the names of the patches relative to the
+        target folder.
+    """
+
+    def __init__(self, target_dir, pairs=None):
+        self.target_dir = target_dir
+        # Every pair found, including the duplicates that share the patch of another pair.
+        self.pairs = pairs if pairs is not None else []
+        self.created = []
+        self.up_to_date = []
+        self.failed = []
+        # The new files shipped as they are, because their patches grew too large.
+        self.full_files = []
+        self.verification_failures = []
+        self.stage_timings = {}
+        # The estimates written in place of the patches when only a plan was asked for.
+        self.plan = None
+
+    def succeeded(self):
+        return len(self.failed) == 0 and len(self.verification_failures) == 0
+
+    def to_dict(self):
+        return {
+            'target': self.target_dir,
+            'pairs': [{
+                'source': pair.source.filename,
+                'target': pair.target.filename,
+                'patch': pair.patch_name,
+                'backend': pair.backend.name if pair.backend is not None else None,
+                'full_file': pair.full_file,
+                'segments': len(pair.segments) if pair.segments is not None else None,
+                'similarity': pair.similarity,
+                'duplicate': pair.duplicate_of is not None
+            } for pair in self.pairs],
+            'created': list(self.created),
+            'up_to_date': list(self.up_to_date),
+            'failed': list(self.failed),
+            'full_files': list(self.full_files),
+            'verification_failures': list(self.verification_failures),
+            'stage_timings': dict(self.stage_timings),
+            'plan': self.plan
+        }
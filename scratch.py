@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ScratchFile:
+    """ Makes a file available under another name, for tools that cannot open the original name. The cheapest method
+        that works on the platform and filesystem is used, and the data is only copied if nothing else works.
+    """
+    # From linux/fs.h: _IOW(0x94, 9, int)
+    FICLONE = 0x40049409
+    COPY_CHUNK_SIZE = 64 * 1024 * 1024
+
+    @staticmethod
+    def create(source, destination, allow_symlink=True):
+        """ Makes the contents of source available at destination. Returns the name of the method used. Symbolic links
+            should not be allowed when the destination is meant to be shipped.
+        """
+        if os.path.lexists(destination):
+            os.unlink(destination)
+
+        for method in (ScratchFile.hardlink, ScratchFile.reflink, ScratchFile.symlink, ScratchFile.copy_range):
+            if method is ScratchFile.symlink and not allow_symlink:
+                continue
+
+            try:
+                if method(source, destination):
+                    return method.__name__
+            except (OSError, AttributeError, NotImplementedError):
+                pass
+
+            if os.path.lexists(destination):
+                os.unlink(destination)
+
+        shutil.copyfile(source, destination)
+        return 'copy'
+
+    @staticmethod
+    def extract(source, destination, offset, length):
+        """ Copies a range of a file into a file of its own. The data is copied inside the kernel where possible. """
+        if os.path.lexists(destination):
+            os.unlink(destination)
+
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    position = offset
+                    remaining = length
+                    while remaining > 0:
+                        copied = os.copy_file_range(src.fileno(), dst.fileno(),
+                                                    min(remaining, ScratchFile.COPY_CHUNK_SIZE), position)
+                        if copied == 0:
+                            break
+                        position += copied
+                        remaining -= copied
+                    return
+                except OSError:
+                    dst.seek(0)
+                    dst.truncate()
+
+            src.seek(offset)
+            remaining = length
+            while remaining > 0:
+                chunk = src.read(min(remaining, ScratchFile.COPY_CHUNK_SIZE))
+                if not chunk:
+                    break
+                dst.write(chunk)
+                remaining -= len(chunk)
+
+    @staticmethod
+    def hardlink(source, destination):
+        os.link(source, destination)
+        return True
+
+    @staticmethod
+    def reflink(source, destination):
+        if fcntl is None:
+            return False
+
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), ScratchFile.FICLONE, src.fileno())
+        return True
+
+    @staticmethod
+    def symlink(source, destination):
+        os.symlink(os.path.abspath(source), destination)
+        return True
+
+    @staticmethod
+    def copy_range(source, destination):
+        """ Copies the data inside the kernel, which lets filesystems that support it share the extents instead. """
+        if not hasattr(os, 'copy_file_range'):
+            return False
+
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), min(remaining, ScratchFile.COPY_CHUNK_SIZE))
+                if copied == 0:
+                    return False
+                remaining -= copied
+        return True
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import mmap
+import threading
+import zlib
+
+from similarity import ContentSketch
+
+
+class Segment:
+    """ A range of the new file that is encoded into a patch of its own, against the range of the old file that holds
+        the same content.
+    """
+    __slots__ = ('index', 'source_offset', 'source_length', 'target_offset', 'target_length', 'patch_name')
+
+    def __init__(self, index, source_offset, source_length, target_offset, target_length, patch_name):
+        self.index = index
+        self.source_offset = source_offset
+        self.source_length = source_length
+        self.target_offset = target_offset
+        self.target_length = target_length
+        self.patch_name = patch_name
+
+    def to_dict(self):
+        return {
+            'patch': self.patch_name,
+            'source_offset': self.source_offset,
+            'source_length': self.source_length,
+            'target_offset': self.target_offset,
+            'target_length': self.target_length
+        }
+
+    @staticmethod
+    def from_dict(index, data):
+        return Segment(index, data['source_offset'], data['source_length'], data['target_offset'],
+                       data['target_length'], data['patch'])
+
+
+class SegmentPlanner:
+    """ Splits a pair of files into segments at content defined boundaries. A boundary is placed near every multiple of
+        the segment size in the new file, at the start of the chunk with the smallest hash around it, and the same
+        chunk is then looked for in the old file close to where it is expected to be. Data inserted into or removed
+        from the new file only changes the segments it falls into, so the rest still line up with the old file.
+    """
+    ANCHOR_WINDOW = 1024 * 1024
+    MIN_ANCHOR_SIZE = 32
+    MAX_ANCHOR_SIZE = 1024
+    # How far from its expected position the anchor of a boundary is looked for in the old file. The search widens
+    # step by step, so that the usual case of a nearby anchor only reads a small part of the file.
+    SEARCH_RADII = (64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024)
+    # The ranges of the old file are extended by this share of the segment size on both sides, so that data moved
+    # across a boundary can still be found.
+    OVERLAP = 0.125
+    MIN_SEGMENT_SIZE = 4 * ANCHOR_WINDOW
+
+    def __init__(self, segment_size):
+        self.segment_size = max(self.MIN_SEGMENT_SIZE, segment_size)
+
+    def plan(self, source, target, patch_name):
+        """ Returns the segments of the pair, named after the patch name. Only the surroundings of each boundary are
+            read.
+        """
+        with open(source, 'rb') as source_file, open(target, 'rb') as target_file:
+            source_map = mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+            target_map = mmap.mmap(target_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                source_cuts, target_cuts = self.find_cuts(source_map, target_map)
+            finally:
+                source_map.close()
+                target_map.close()
+
+        margin = int(self.segment_size * self.OVERLAP)
+        segments = []
+        for i in range(len(target_cuts) - 1):
+            source_start = max(0, source_cuts[i] - margin)
+            source_end = min(source_cuts[-1], source_cuts[i + 1] + margin)
+            segments.append(Segment(i, source_start, source_end - source_start, target_cuts[i],
+                                    target_cuts[i + 1] - target_cuts[i], '{}.{:03d}'.format(patch_name, i)))
+
+        return segments
+
+    def find_cuts(self, source_map, target_map):
+        """ Returns the offsets of the boundaries in both files, including the start and the end of the files. """
+        source_cuts = [0]
+        target_cuts = [0]
+        nominal = self.segment_size
+        # The last segment may be up to half a segment longer, rather than leaving a small one at the end.
+        while nominal + self.segment_size // 2 < len(target_map):
+            cut, anchor = self.find_anchor(target_map, nominal)
+            if cut <= target_cuts[-1]:
+                nominal += self.segment_size
+                continue
+
+            expected = source_cuts[-1] + cut - target_cuts[-1]
+            position = self.find_in_source(source_map, anchor, expected) if anchor is not None else None
+            if position is None:
+                position = expected
+            source_cuts.append(min(max(position, source_cuts[-1]), len(source_map)))
+            target_cuts.append(cut)
+            nominal += self.segment_size
+
+        source_cuts.append(len(source_map))
+        target_cuts.append(len(target_map))
+        return source_cuts, target_cuts
+
+    def find_anchor(self, data, nominal):
+        """ Picks the boundary closest in content to the nominal offset. Returns the offset and the bytes of the chunk
+            starting there, or the nominal offset and None if there are no usable chunks around it.
+        """
+        start = max(0, nominal - self.ANCHOR_WINDOW // 2)
+        window = data[start:start + self.ANCHOR_WINDOW]
+        chunks = window.translate(ContentSketch.BOUNDARY_TABLE).split(b'\x00')
+
+        best = None
+        offset = len(chunks[0]) + 1
+        # The first and last chunk are cut at an arbitrary spot, so they would not be found at the same spot again.
+        for chunk in chunks[1:-1]:
+            if len(chunk) >= self.MIN_ANCHOR_SIZE:
+                value = zlib.crc32(chunk)
+                if best is None or value < best[0]:
+                    best = (value, offset, len(chunk))
+            offset += len(chunk) + 1
+
+        if best is None:
+            return nominal, None
+
+        _, offset, length = best
+        return start + offset, window[offset:offset + min(length, self.MAX_ANCHOR_SIZE)]
+
+    def find_in_source(self, source_map, anchor, expected):
+        """ Returns the offset of the occurrence of the anchor closest to the expected offset, or None. """
+        expected = min(max(0, expected), len(source_map))
+        for radius in self.SEARCH_RADII:
+            low = max(0, expected - radius)
+            high = min(len(source_map), expected + radius + len(anchor))
+            before = source_map.rfind(anchor, low, min(high, expected + len(anchor)))
+            after = source_map.find(anchor, expected, high)
+            found = [position for position in (before, after) if position >= 0]
+            if len(found) > 0:
+                return min(found, key=lambda position: abs(position - expected))
+
+        return None
+
+
+class SegmentProgress:
+    """ Keeps track of the segments of a pair while they are being encoded, possibly in parallel. Once one of them
+        has failed or grown past the size limit, the segments that haven't started yet are skipped.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.remaining = len(segments)
+        self.failed = False
+        self.over_budget = False
+        self.command = None
+        self.seconds = 0
+        self.lock = threading.Lock()
+
+    def is_aborted(self):
+        with self.lock:
+            return self.failed or self.over_budget
+
+    def finish_segment(self, command, failed=False, over_budget=False, seconds=0):
+        """ Returns True for the last segment to finish. """
+        with self.lock:
+            self.seconds += seconds
+            self.failed = self.failed or failed
+            self.over_budget = self.over_budget or over_budget
+            if command is not None:
+                self.command = command
+            self.remaining -= 1
+            return self.remaining == 0
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import collections
+import heapq
+import zlib
+
+
+class ContentSketch:
+    """ A MinHash sketch of the contents of a file, made from a few samples spread evenly over it so that large files
+        don't have to be read in full. Each sample is cut into chunks at content defined boundaries, which keeps most
+        chunks intact when data has been inserted or removed, and the smallest hashes of the chunks form the sketch.
+    """
+    SAMPLES = 16
+    SAMPLE_SIZE = 64 * 1024
+    SIZE = 128
+    # Chunks end at any of these bytes, which gives chunks of about 50 bytes in compressed data and roughly words in
+    # text. Shorter chunks are left out, since the same ones turn up in nearly every file.
+    CHUNK_BOUNDARIES = b'\x00\n \xff'
+    MIN_CHUNK_SIZE = 16
+    # Turns every boundary into a zero byte, so that the data can be cut with a plain split, which is much faster than
+    # splitting with a regular expression.
+    BOUNDARY_TABLE = bytes.maketrans(CHUNK_BOUNDARIES, bytes(len(CHUNK_BOUNDARIES)))
+
+    def __init__(self, hashes, size, bytes_read=0):
+        self.hashes = hashes
+        self.members = frozenset(hashes)
+        self.size = size
+        self.bytes_read = bytes_read
+
+    @staticmethod
+    def create(path, size):
+        if size <= ContentSketch.SAMPLES * ContentSketch.SAMPLE_SIZE:
+            offsets = [0]
+            length = size
+        else:
+            step = (size - ContentSketch.SAMPLE_SIZE) / (ContentSketch.SAMPLES - 1)
+            offsets = [int(i * step) for i in range(ContentSketch.SAMPLES)]
+            length = ContentSketch.SAMPLE_SIZE
+
+        hashes = set()
+        bytes_read = 0
+        with open(path, 'rb') as fh:
+            for offset in offsets:
+                fh.seek(offset)
+                data = fh.read(length)
+                bytes_read += len(data)
+                # The first and last chunk of a sample are cut at an arbitrary spot, so they are not comparable.
+                chunks = data.translate(ContentSketch.BOUNDARY_TABLE).split(b'\x00')[1:-1]
+                hashes.update(map(zlib.crc32, [c for c in chunks if len(c) >= ContentSketch.MIN_CHUNK_SIZE]))
+
+        return ContentSketch(heapq.nsmallest(ContentSketch.SIZE, hashes), size, bytes_read)
+
+    def similarity(self, other):
+        """ Estimates the share of chunks the two files have in common, from 0 to 1. """
+        union = heapq.nsmallest(self.SIZE, self.members | other.members)
+        if len(union) == 0:
+            return 0.0
+
+        return sum(1 for value in union if value in self.members and value in other.members) / len(union)
+
+
+class SimilarityIndex:
+    """ Finds the most similar of the added sketches through an inverted index of their hashes, so that a sketch is
+        only compared with the ones that share at least one hash with it.
+    """
+    # Files whose sizes differ more than this are not expected to be versions of each other.
+    MAX_SIZE_RATIO = 2.0
+
+    def __init__(self):
+        self.items = []
+        self.sketches = []
+        self.postings = {}
+
+    def add(self, item, sketch):
+        index = len(self.items)
+        self.items.append(item)
+        self.sketches.append(sketch)
+        for value in sketch.hashes:
+            self.postings.setdefault(value, []).append(index)
+
+    def query(self, sketch, limit=5):
+        """ Returns up to limit (item, similarity) tuples for the most similar sketches, most similar first. """
+        counts = collections.Counter()
+        for value in sketch.hashes:
+            counts.update(self.postings.get(value, ()))
+
+        results = []
+        for index, _ in counts.most_common():
+            other = self.sketches[index]
+            if max(sketch.size, other.size) > self.MAX_SIZE_RATIO * max(1, min(sketch.size, other.size)):
+                continue
+
+            results.append((self.items[index], sketch.similarity(other)))
+            if len(results) >= limit:
+                break
+
+        results.sort(key=lambda item: item[1], reverse=True)
+        return results
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+__author__ = 'Soulweaver'
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from pairing import DirectoryScanner
+
+
+class DirectoryWatcher:
+    """ Reports the files that have been added or changed in a directory. Uses inotify on Linux, and compares
+        directory listings at regular intervals everywhere else.
+    """
+
+    def __init__(self, base_dir, recursive=False):
+        self.base_dir = base_dir
+        self.recursive = recursive
+
+    def wait(self, timeout):
+        """ Waits up to the given number of seconds, and returns the relative paths of the files that changed in the
+            meantime, with forward slashes as separators.
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def create(base_dir, recursive=False):
+        try:
+            return InotifyWatcher(base_dir, recursive)
+        except OSError:
+            return PollingWatcher(base_dir, recursive)
+
+
+class PollingWatcher(DirectoryWatcher):
+    name = 'polling'
+
+    def __init__(self, base_dir, recursive=False):
+        super().__init__(base_dir, recursive)
+        self.scanner = DirectoryScanner(recursive)
+        self.snapshot = self.take_snapshot()
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        snapshot = self.take_snapshot()
+        changed = set(relpath for relpath, state in snapshot.items() if self.snapshot.get(relpath) != state)
+        self.snapshot = snapshot
+        return changed
+
+    def take_snapshot(self):
+        snapshot = {}
+        for entry, relpath in self.scanner.scan(self.base_dir):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            snapshot[relpath] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+
+class InotifyWatcher(DirectoryWatcher):
+    name = 'inotify'
+
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_ISDIR = 0x40000000
+    EVENT_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, base_dir, recursive=False):
+        super().__init__(base_dir, recursive)
+        library = ctypes.util.find_library('c')
+        if library is None:
+            raise OSError('The C library could not be found.')
+
+        self.libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not supported on this system.')
+
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+        # Maps the watch descriptors to the relative paths of the directories they are watching.
+        self.watches = {}
+        try:
+            self.add_watch('')
+            if recursive:
+                for directory, subdirectories, _ in os.walk(base_dir):
+                    for subdirectory in subdirectories:
+                        path = os.path.join(directory, subdirectory)
+                        self.add_watch(os.path.relpath(path, base_dir).replace(os.sep, '/') + '/')
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_watch(self, prefix):
+        path = os.fsencode(os.path.join(self.base_dir, prefix))
+        wd = self.libc.inotify_add_watch(self.fd, path, self.EVENT_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path)
+        self.watches[wd] = prefix
+
+    def add_directory(self, prefix):
+        """ Starts watching a directory that appeared after the watcher was created. Returns the files that were
+            already in it by the time the watch was in place, since no events will come for them.
+        """
+        try:
+            self.add_watch(prefix)
+            scanner = DirectoryScanner(True)
+            return [prefix + relpath for _, relpath in scanner.scan(os.path.join(self.base_dir, prefix))]
+        except OSError:
+            return []
+
+    def wait(self, timeout):
+        changed = set()
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            readable, _, _ = select.select([self.fd], [], [], max(0, remaining))
+            if len(readable) == 0:
+                return changed
+
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+
+                prefix = self.watches.get(wd)
+                if prefix is None or name == '':
+                    continue
+
+                if mask & self.IN_ISDIR:
+                    if self.recursive and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                        changed.update(self.add_directory(prefix + name + '/'))
+                    continue
+
+                changed.add(prefix + name)
+
+            # Events tend to arrive in a rapid succession while a file is being written, so keep collecting them
+            # until the timeout is up instead of returning after each one.
+            if remaining <= 0:
+                return changed
+
+    def close(self):
+        os.close(self.fd)